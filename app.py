@@ -10,12 +10,48 @@ import tempfile
 import shutil
 import base64
 import concurrent.futures
-from flask import Flask, request, jsonify, after_this_request, send_file, Response, render_template, session, redirect, url_for, send_from_directory
+from concurrent.futures.process import BrokenProcessPool
+import threading
+import queue
+import collections
+import collections.abc
+import itertools
+import atexit
+import contextlib
+import socket
+import sqlite3
+import wave
+import array
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from flask import Flask, request, jsonify, after_this_request, send_file, Response, render_template, session, redirect, url_for, send_from_directory, g
 import math
 from werkzeug.middleware.proxy_fix import ProxyFix
 import io
 from dotenv import load_dotenv
 
+# Optional dependencies for the in-process ONNX synthesis engine (TTS_ENGINE=onnx)
+try:
+    import numpy as np
+    import onnxruntime
+except ImportError:
+    np = None
+    onnxruntime = None
+try:
+    import piper_phonemize
+except ImportError:
+    piper_phonemize = None
+# Optional: rewrites models with external weights that onnxruntime memory-maps (ONNX_MMAP_WEIGHTS)
+try:
+    import onnx
+except ImportError:
+    onnx = None
+# Optional in-process MP3 encoder; ffmpeg is used when it is not installed
+try:
+    import lameenc
+except ImportError:
+    lameenc = None
+
 # Load environment variables from .env file if it exists
 load_dotenv()
 
@@ -43,20 +79,18 @@ app.wsgi_app = ProxyFix(
 # Security configuration
 import hashlib
 import secrets
-from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
 import ipaddress
 
-# Rate limiting storage
-request_counts = {}
-blocked_ips = {}
-blocked_user_agents = set()
 
 # Security settings
 MAX_REQUESTS_PER_MINUTE = 10
 MAX_REQUESTS_PER_HOUR = 100
 BLOCK_DURATION_MINUTES = 30
 MAX_TEXT_LENGTH = 5000
+RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory').lower()  # memory or sqlite
+RATE_LIMIT_MAX_TRACKED_IPS = int(os.environ.get('RATE_LIMIT_MAX_TRACKED_IPS', 10000))
+RATE_LIMIT_SQLITE_PATH = os.environ.get('RATE_LIMIT_SQLITE_PATH', os.path.join(tempfile.gettempdir(), 'piper_rate_limit.sqlite3'))
 
 # Suspicious user agents patterns
 SUSPICIOUS_USER_AGENTS = [
@@ -116,8 +150,13 @@ os.makedirs(temp_audio_folder, exist_ok=True)
 os.makedirs(model_folder, exist_ok=True)
 
 # Function to load models from individual .onnx.json files
-def extract_and_save_image(model_id, base64_image):
-    """Extract and save base64 image to static files."""
+def extract_and_save_image(model_id, base64_image, source_mtime_ns=None):
+    """
+    Extract and save base64 image to static files.
+
+    When source_mtime_ns (the .onnx.json mtime) is given and the image file is
+    at least as new, the file is left as it is.
+    """
     if not base64_image:
         return None
         
@@ -134,87 +173,233 @@ def extract_and_save_image(model_id, base64_image):
         safe_model_id = re.sub(r'[^a-zA-Z0-9]', '_', model_id)
         filename = f"{safe_model_id}_image.{img_format}"
         filepath = os.path.join(static_images_dir, filename)
+        image_url = f'/static/model_images/{filename}'
         
-        # Save the image
-        with open(filepath, 'wb') as f:
+        try:
+            if source_mtime_ns is not None and os.stat(filepath).st_mtime_ns >= source_mtime_ns:
+                return image_url
+        except OSError:
+            pass
+        
+        # Save the image; written aside and renamed so it is never served half-written
+        temp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as f:
             f.write(base64.b64decode(data))
+        os.replace(temp_path, filepath)
             
-        return f'/static/model_images/{filename}'
+        return image_url
     except Exception as e:
         logging.error(f"Error saving image for model {model_id}: {e}")
         return None
 
-def load_models():
-    global model_configs, existing_models, model_id_to_filename_map
-    model_configs = {}
-    existing_models = []
-    model_id_to_filename_map = {}  # Maps JSON ID to filename-based key
+def model_file_state(model_filename_key):
+    """(mtime_ns, size) of a model's .onnx.json and .onnx files, None for a missing file."""
+    state = []
+    for suffix in ('.onnx.json', '.onnx'):
+        try:
+            stat = os.stat(os.path.join(model_folder, model_filename_key + suffix))
+            state.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            state.append(None)
+    return tuple(state)
+
+def scan_model_files():
+    """Filename key -> file state for every .onnx.json in the models folder."""
+    return {
+        filename[:-10]: model_file_state(filename[:-10])  # Remove .onnx.json (e.g., "es_MX-lilith-9494")
+        for filename in os.listdir(model_folder) if filename.endswith('.onnx.json')
+    }
+
+def load_model_config(model_filename_key, state=None):
+    """Parse models/<key>.onnx.json; returns None when the .onnx file is missing."""
+    json_path = os.path.join(model_folder, f"{model_filename_key}.onnx.json")
+    with open(json_path, 'r', encoding='utf-8') as f:
+        model_data = json.load(f)
+    
+    # Get model info from modelcard section
+    modelcard = model_data.get('modelcard', {})
+    json_model_id = modelcard.get('id', model_filename_key)  # e.g., "es_MX-lilith"
+    
+    # Check if ONNX file exists
+    onnx_path = os.path.join(model_folder, f"{model_filename_key}.onnx")
+    if not os.path.exists(onnx_path):
+        return None
+    
+    # Get model-specific replacements from modelcard, or use defaults
+    model_replacements = modelcard.get('replacements', [('\n', ' . '), ('*', ''), (')', ',')])
+    # Convert to tuples if they're lists
+    if model_replacements and isinstance(model_replacements[0], list):
+        model_replacements = [tuple(item) for item in model_replacements]
+    
+    # Extract and save image if it exists (unless already extracted from this version of the file)
+    image_url = None
+    if 'image' in modelcard:
+        json_mtime_ns = state[0][0] if state and state[0] else None
+        image_url = extract_and_save_image(json_model_id, modelcard['image'], json_mtime_ns)
     
+    model_config = {
+        "model_path_onnx": onnx_path,
+        "replacements": model_replacements,
+        "id": json_model_id,
+        "name": modelcard.get('name') or json_model_id,
+        "description": modelcard.get('description') or json_model_id,
+        "language": modelcard.get('language', 'Not available'),
+        "voiceprompt": modelcard.get('voiceprompt', 'Not available'),
+        "filename_key": model_filename_key,
+        "image": image_url,  # Store the URL to the static image
+        "sha256": modelcard.get('sha256'),
+        "sample_rate": model_data.get('audio', {}).get('sample_rate', 22050),
+        # Phonemization data used by the in-process ONNX engine
+        "synthesis_config": {
+            "phoneme_type": model_data.get('phoneme_type', 'espeak'),
+            "espeak_voice": model_data.get('espeak', {}).get('voice', 'en-us'),
+            "phoneme_id_map": model_data.get('phoneme_id_map', {}),
+            "num_speakers": model_data.get('num_speakers', 1),
+        }
+    }
+    logging.info(f"Loaded model: {model_filename_key} (ID: {json_model_id}) - {modelcard.get('name', model_filename_key)}")
+    return model_config
+
+def parse_model_entry(model_filename_key, state):
+    """(state, model config or None) for one model; errors are logged, not raised."""
+    try:
+        return state, load_model_config(model_filename_key, state)
+    except Exception as e:
+        logging.error(f"Error loading model {model_filename_key}: {e}")
+        return state, None
+
+# Parsed model configs cached between starts; empty disables the manifest
+MODEL_MANIFEST_PATH = os.environ.get('MODEL_MANIFEST_PATH', os.path.join(model_folder, '.manifest.json'))
+MODEL_MANIFEST_VERSION = 1
+
+def load_model_manifest():
+    """Filename key -> (file state, model config) from the manifest, {} when unusable."""
+    if not MODEL_MANIFEST_PATH:
+        return {}
+    try:
+        with open(MODEL_MANIFEST_PATH, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if manifest.get('version') != MODEL_MANIFEST_VERSION:
+            return {}
+        entries = {}
+        for model_filename_key, item in manifest['models'].items():
+            # JSON turns tuples into lists; states must compare equal to model_file_state()
+            state = tuple(tuple(part) if part is not None else None for part in item['state'])
+            model_config = item['config']
+            model_config["model_path_onnx"] = os.path.join(model_folder, f"{model_filename_key}.onnx")
+            model_config["replacements"] = [tuple(item) if isinstance(item, list) else item
+                                            for item in model_config["replacements"]]
+            entries[model_filename_key] = (state, model_config)
+        return entries
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logging.warning(f"Ignoring model manifest {MODEL_MANIFEST_PATH}: {e}")
+        return {}
+
+def save_model_manifest(entries):
+    """Write the parsed models to the manifest; failures are logged, not raised."""
+    if not MODEL_MANIFEST_PATH:
+        return
+    models = {}
+    for model_filename_key, (state, model_config) in entries.items():
+        # Failed models are not cached, so they are retried on the next start
+        if model_config is not None:
+            models[model_filename_key] = {
+                "state": state,
+                "config": {name: value for name, value in model_config.items() if name != "model_path_onnx"},
+            }
+    temp_path = f"{MODEL_MANIFEST_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": MODEL_MANIFEST_VERSION, "models": models}, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temp_path, MODEL_MANIFEST_PATH)
+    except Exception as e:
+        logging.warning(f"Could not write model manifest {MODEL_MANIFEST_PATH}: {e}")
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+
+def cached_model_entry(cached, state):
+    """The manifest entry when it matches the files on disk and its image still exists."""
+    if cached is None or cached[0] != state:
+        return None
+    image_url = cached[1].get("image")
+    if image_url and not os.path.exists(os.path.join(static_images_dir, os.path.basename(image_url))):
+        return None
+    return cached
+
+def build_model_catalog(entries):
+    """model_configs, existing_models and model_id_to_filename_map for parsed entries."""
+    configs, names, id_map = {}, [], {}
+    for model_filename_key, (state, model_config) in entries.items():
+        if model_config is None:
+            continue
+        # Store model config using filename-based key
+        configs[model_filename_key] = model_config
+        names.append(model_filename_key)
+        
+        # Create mapping from JSON ID to filename key (if they're different)
+        json_model_id = model_config["id"]
+        if json_model_id != model_filename_key:
+            id_map[json_model_id] = model_filename_key
+            # Also store config using JSON ID for direct access
+            configs[json_model_id] = model_config
+            names.append(json_model_id)
+    return configs, names, id_map
+
+def publish_models(entries):
+    """
+    Swap in the catalog built from entries.
+
+    Readers use the three globals without a lock, so model_configs is widened
+    to cover both catalogs while existing_models and model_id_to_filename_map
+    are replaced, and narrowed last. This only narrows the window: a reader
+    still holding a name from the previous lists can find a removed model
+    gone from model_configs, and has to treat it as not found.
+    """
+    global model_entries, model_configs, existing_models, model_id_to_filename_map
+    configs, names, id_map = build_model_catalog(entries)
+    model_configs = {**model_configs, **configs}
+    existing_models, model_id_to_filename_map = names, id_map
+    model_configs = configs
+    model_entries = entries
+
+def load_models():
+    """
+    Publish every model in the models folder.
+
+    Models whose files match the manifest are taken from it; only new and
+    changed ones are parsed, and the manifest is rewritten when any were.
+    """
+    entries = {}
+    cached = load_model_manifest()
+    parsed = newly_cached = 0
     try:
         # Scan models directory for .onnx.json files
-        for filename in os.listdir(model_folder):
-            if filename.endswith('.onnx.json'):
-                model_filename_key = filename[:-10]  # Remove .onnx.json (e.g., "es_MX-lilith-9494")
-                json_path = os.path.join(model_folder, filename)
-                
-                try:
-                    with open(json_path, 'r', encoding='utf-8') as f:
-                        model_data = json.load(f)
-                    
-                    # Get model info from modelcard section
-                    modelcard = model_data.get('modelcard', {})
-                    json_model_id = modelcard.get('id', model_filename_key)  # e.g., "es_MX-lilith"
-                    
-                    # Check if ONNX file exists
-                    onnx_path = os.path.join(model_folder, f"{model_filename_key}.onnx")
-                    if os.path.exists(onnx_path):
-                        # Get model-specific replacements from modelcard, or use defaults
-                        model_replacements = modelcard.get('replacements', [('\n', ' . '), ('*', ''), (')', ',')])
-                        # Convert to tuples if they're lists
-                        if model_replacements and isinstance(model_replacements[0], list):
-                            model_replacements = [tuple(item) for item in model_replacements]
-                        
-                        # Extract and save image if it exists
-                        image_url = None
-                        if 'image' in modelcard:
-                            image_url = extract_and_save_image(json_model_id, modelcard['image'])
-                        
-                        model_config = {
-                            "model_path_onnx": onnx_path,
-                            "replacements": model_replacements,
-                            "id": json_model_id,
-                            "name": modelcard.get('name') or json_model_id,
-                            "description": modelcard.get('description') or json_model_id,
-                            "language": modelcard.get('language', 'Not available'),
-                            "voiceprompt": modelcard.get('voiceprompt', 'Not available'),
-                            "filename_key": model_filename_key,
-                            "image": image_url  # Store the URL to the static image
-                        }
-                        
-                        # Store model config using filename-based key
-                        model_configs[model_filename_key] = model_config
-                        existing_models.append(model_filename_key)
-                        
-                        # Create mapping from JSON ID to filename key (if they're different)
-                        if json_model_id != model_filename_key:
-                            model_id_to_filename_map[json_model_id] = model_filename_key
-                            # Also store config using JSON ID for direct access
-                            model_configs[json_model_id] = model_config
-                            existing_models.append(json_model_id)
-                        
-                        logging.info(f"Loaded model: {model_filename_key} (ID: {json_model_id}) - {modelcard.get('name', model_filename_key)}")
-                    
-                except Exception as e:
-                    logging.error(f"Error loading model {model_filename_key}: {e}")
-    
+        for model_filename_key, state in scan_model_files().items():
+            entry = cached_model_entry(cached.get(model_filename_key), state)
+            if entry is None:
+                entry = parse_model_entry(model_filename_key, state)
+                parsed += 1
+                newly_cached += entry[1] is not None
+            entries[model_filename_key] = entry
     except Exception as e:
         logging.error(f"Error scanning models directory: {e}")
-        model_configs = {}
-        existing_models = []
-        model_id_to_filename_map = {}
+        entries = {}
+    publish_models(entries)
+    reused = len(entries) - parsed
+    if reused:
+        logging.info(f"Loaded {reused} models from the manifest, parsed {parsed}")
+    if newly_cached or set(cached) - set(entries):
+        save_model_manifest(entries)
 
 # Initial model loading
-model_id_to_filename_map = {}  # Global mapping variable
+model_configs = {}
+existing_models = []
+model_id_to_filename_map = {}  # Maps JSON ID to filename-based key
+model_entries = {}  # Filename key -> (file state, model config or None)
 load_models()
 
 @app.route('/')
@@ -308,80 +493,731 @@ def load_global_replacements():
 
 global_replacements = load_global_replacements()
 
-MAX_WORKERS = min(32, math.ceil((os.cpu_count() or 1) * 1.5))
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', min(32, math.ceil((os.cpu_count() or 1) * 1.5))))
 logging.info(f"Initializing ThreadPoolExecutor with {MAX_WORKERS} workers.")
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
 
+class Metrics:
+    """Thread-safe counters and rolling latency summaries, exposed on /admin/metrics."""
+
+    def __init__(self, window=1000):
+        self._lock = threading.Lock()
+        self._counters = collections.Counter()
+        self._timings = collections.defaultdict(lambda: collections.deque(maxlen=window))
+
+    def increment(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe(self, name, seconds):
+        with self._lock:
+            self._timings[name].append(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {}
+            for name, values in self._timings.items():
+                ordered = sorted(values)
+                if not ordered:
+                    continue
+                timings[name] = {
+                    'count': len(ordered),
+                    'avg': round(sum(ordered) / len(ordered), 6),
+                    'p50': round(ordered[len(ordered) // 2], 6),
+                    'p95': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))], 6),
+                    'max': round(ordered[-1], 6),
+                }
+            return {'counters': dict(self._counters), 'timings': timings}
+
+metrics = Metrics()
+
+# Fair scheduling of synthesis jobs across requests and client classes
+SCHEDULER_MAX_PER_REQUEST = int(os.environ.get('SCHEDULER_MAX_PER_REQUEST', max(1, math.ceil(MAX_WORKERS * 0.75))))
+SCHEDULER_CLASS_WEIGHTS = {
+    'user': float(os.environ.get('SCHEDULER_USER_WEIGHT', 2)),
+    'anonymous': float(os.environ.get('SCHEDULER_ANONYMOUS_WEIGHT', 1)),
+}
+SCHEDULER_AGING_CHARS_PER_SECOND = float(os.environ.get('SCHEDULER_AGING_CHARS_PER_SECOND', 200))
+
+class ScheduledRequest:
+    """The jobs one conversion has handed to the scheduler."""
+
+    def __init__(self, client_class):
+        self.client_class = client_class
+        self.opened = time.monotonic()
+        self.jobs = collections.deque()  # (cost, future, fn, args, submitted_at)
+        self.pending_cost = 0
+        self.running = 0
+        self.cancelled = threading.Event()
+        self.busy_seconds = 0.0  # Worker time of finished jobs
+        self._running_since = {}  # future -> start time of jobs on a worker now
+        self._processes = set()
+        self._process_lock = threading.Lock()
+
+    def add_process(self, process):
+        """Track a subprocess working for this request; killed at once if the request is cancelled."""
+        with self._process_lock:
+            self._processes.add(process)
+        if self.cancelled.is_set():
+            self.kill_processes()
+
+    def discard_process(self, process):
+        with self._process_lock:
+            self._processes.discard(process)
+
+    def kill_processes(self):
+        with self._process_lock:
+            processes = list(self._processes)
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+
+_job_context = threading.local()
+
+def current_job_request():
+    """The ScheduledRequest whose job runs on this thread, or None outside scheduled jobs."""
+    return getattr(_job_context, 'scheduled', None)
+
+def job_cancelled():
+    scheduled = current_job_request()
+    return scheduled is not None and scheduled.cancelled.is_set()
+
+@contextlib.contextmanager
+def cancellable_process(process):
+    """Let cancellation of the current job's request kill process while it runs."""
+    scheduled = current_job_request()
+    if scheduled is None or process is None:
+        yield
+        return
+    scheduled.add_process(process)
+    try:
+        yield
+    finally:
+        scheduled.discard_process(process)
+
+class SchedulerShutdown(Exception):
+    pass
+
+class FairScheduler:
+    """
+    Decides which request's job runs next on the shared executor.
+
+    At most max_in_flight jobs are handed to the executor at a time, so its own
+    FIFO queue never builds up. When a slot frees:
+      - the client class ('user' for logged-in sessions, 'anonymous' otherwise)
+        with the least weighted service so far is chosen (weighted fair queuing);
+      - inside that class, the request with the least remaining work goes first,
+        discounted by how long it has waited so long texts are not starved;
+      - a request never has more than per_request_cap jobs running at once.
+    Jobs of one request keep their submission order. Queue wait per class is
+    recorded as scheduler.queue_wait_seconds.<class>.
+
+    After shutdown() nothing more is handed to the executor and queued or newly
+    submitted jobs fail with SchedulerShutdown, so no caller waits forever.
+    """
+
+    def __init__(self, executor, max_in_flight, per_request_cap, class_weights, aging_chars_per_second):
+        self.executor = executor
+        self.max_in_flight = max_in_flight
+        self.per_request_cap = max(1, per_request_cap)
+        self.class_weights = class_weights
+        self.aging = aging_chars_per_second
+        self._lock = threading.Lock()
+        self._requests = collections.OrderedDict()  # ScheduledRequest -> None, in arrival order
+        self._virtual_time = collections.defaultdict(float)
+        self._in_flight = 0
+        self._shut_down = False
+
+    def open_request(self, client_class):
+        scheduled = ScheduledRequest(client_class if client_class in self.class_weights else 'anonymous')
+        with self._lock:
+            # A class returning from idle starts level with the busiest one instead of with saved-up credit
+            active = [self._virtual_time[r.client_class] for r in self._requests]
+            if active and scheduled.client_class not in {r.client_class for r in self._requests}:
+                self._virtual_time[scheduled.client_class] = max(self._virtual_time[scheduled.client_class], min(active))
+            self._requests[scheduled] = None
+        return scheduled
+
+    def close_request(self, scheduled):
+        with self._lock:
+            self._requests.pop(scheduled, None)
+            for _, future, _, _, _ in scheduled.jobs:
+                future.cancel()
+            scheduled.jobs.clear()
+            scheduled.pending_cost = 0
+
+    def cancel_request(self, scheduled):
+        """
+        Stop all work of scheduled: queued jobs are dropped, subprocesses of running
+        jobs are killed. Returns the worker seconds the request had consumed, which
+        is recorded as cancel.wasted_cpu_seconds (each job keeps one core busy).
+        """
+        scheduled.cancelled.set()
+        self.close_request(scheduled)
+        scheduled.kill_processes()
+        now = time.monotonic()
+        with self._lock:
+            wasted = scheduled.busy_seconds + sum(now - started for started in scheduled._running_since.values())
+        metrics.increment('cancel.requests')
+        metrics.increment('cancel.wasted_cpu_seconds', round(wasted, 3))
+        logging.info(f"[SCHEDULER] Cancelled request ({scheduled.client_class}); {wasted:.2f} worker seconds wasted")
+        return wasted
+
+    def submit(self, scheduled, cost, fn, *args):
+        """Queue fn(*args) for scheduled; cost is its size in characters. Returns a Future."""
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._shut_down:
+                future.set_exception(SchedulerShutdown())
+                return future
+            if scheduled not in self._requests:
+                future.cancel()  # Closed or cancelled while its jobs were still being planned
+                return future
+            scheduled.jobs.append((cost, future, fn, args, time.monotonic()))
+            scheduled.pending_cost += cost
+        self._dispatch()
+        return future
+
+    def shutdown(self):
+        """Stop dispatching and fail every queued job; jobs already on the executor finish."""
+        with self._lock:
+            self._shut_down = True
+            queued = [job for scheduled in self._requests for job in scheduled.jobs]
+            for scheduled in self._requests:
+                scheduled.jobs.clear()
+                scheduled.pending_cost = 0
+        for _, future, _, _, _ in queued:
+            if future.set_running_or_notify_cancel():
+                future.set_exception(SchedulerShutdown())
+        if queued:
+            logging.info(f"[SCHEDULER] Shut down with {len(queued)} queued jobs failed")
+
+    def _pick_locked(self):
+        now = time.monotonic()
+        best_key, best = None, None
+        for scheduled in self._requests:
+            if not scheduled.jobs or scheduled.running >= self.per_request_cap:
+                continue
+            key = (self._virtual_time[scheduled.client_class],
+                   scheduled.pending_cost - self.aging * (now - scheduled.opened))
+            if best is None or key < best_key:
+                best_key, best = key, scheduled
+        return best
+
+    def _dispatch(self):
+        while True:
+            with self._lock:
+                if self._shut_down or self._in_flight >= self.max_in_flight:
+                    return
+                scheduled = self._pick_locked()
+                if scheduled is None:
+                    return
+                cost, future, fn, args, submitted_at = scheduled.jobs.popleft()
+                scheduled.pending_cost -= cost
+                if not future.set_running_or_notify_cancel():
+                    continue  # Cancelled while queued
+                scheduled.running += 1
+                self._in_flight += 1
+                self._virtual_time[scheduled.client_class] += max(1, cost) / self.class_weights[scheduled.client_class]
+            metrics.observe(f'scheduler.queue_wait_seconds.{scheduled.client_class}', time.monotonic() - submitted_at)
+            try:
+                self.executor.submit(self._run, scheduled, future, fn, args)
+            except RuntimeError:
+                # The executor shut down after this job was picked
+                with self._lock:
+                    scheduled.running -= 1
+                    self._in_flight -= 1
+                future.set_exception(SchedulerShutdown())
+                return
+
+    def _run(self, scheduled, future, fn, args):
+        started = time.monotonic()
+        with self._lock:
+            scheduled._running_since[future] = started
+        _job_context.scheduled = scheduled
+        try:
+            future.set_result(fn(*args))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            _job_context.scheduled = None
+            with self._lock:
+                scheduled._running_since.pop(future, None)
+                scheduled.busy_seconds += time.monotonic() - started
+                scheduled.running -= 1
+                self._in_flight -= 1
+            self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            by_class = collections.defaultdict(lambda: {'requests': 0, 'queued_jobs': 0, 'running_jobs': 0})
+            for scheduled in self._requests:
+                entry = by_class[scheduled.client_class]
+                entry['requests'] += 1
+                entry['queued_jobs'] += len(scheduled.jobs)
+                entry['running_jobs'] += scheduled.running
+            return {'in_flight': self._in_flight, 'classes': dict(by_class)}
+
+scheduler = FairScheduler(executor, MAX_WORKERS, SCHEDULER_MAX_PER_REQUEST, SCHEDULER_CLASS_WEIGHTS, SCHEDULER_AGING_CHARS_PER_SECOND)
+
+# Synthesis engine: 'piper' (binary, default) or 'onnx' (in-process onnxruntime)
+TTS_ENGINE = os.environ.get('TTS_ENGINE', 'piper').lower()
+ONNX_INTRA_OP_THREADS = int(os.environ.get('ONNX_INTRA_OP_THREADS', 1))
+# Batched inference (TTS_ENGINE=onnx): ONNX_BATCH_MAX_SIZE=1 disables batching
+ONNX_BATCH_MAX_SIZE = int(os.environ.get('ONNX_BATCH_MAX_SIZE', 8))
+ONNX_BATCH_MAX_TOKENS = int(os.environ.get('ONNX_BATCH_MAX_TOKENS', 2048))
+ONNX_BATCH_BUCKETS = (32, 64, 128, 256, 512)
+# Weight sharing between serving processes (TTS_ENGINE=onnx)
+ONNX_PREFORK_SESSIONS = os.environ.get('ONNX_PREFORK_SESSIONS', '1') == '1'  # Build sessions in the gunicorn master
+ONNX_MMAP_WEIGHTS = os.environ.get('ONNX_MMAP_WEIGHTS', '0') == '1'  # Run from memory-mapped weights (slower, no prepacking)
+ONNX_MMAP_DIR = os.environ.get('ONNX_MMAP_DIR', os.path.join(temp_audio_folder, 'onnx_mmap'))
+
+# Piper worker pool settings
+# PIPER_POOL_SIZE=0 desactiva el pool y vuelve a lanzar un proceso piper por oración
+PIPER_POOL_SIZE = int(os.environ.get('PIPER_POOL_SIZE', min(4, os.cpu_count() or 1)))
+PIPER_POOL_MAX_PROCESSES = int(os.environ.get('PIPER_POOL_MAX_PROCESSES', MAX_WORKERS))
+PIPER_WORKER_IDLE_SECONDS = int(os.environ.get('PIPER_WORKER_IDLE_SECONDS', 300))
+PIPER_POOL_ACQUIRE_TIMEOUT = int(os.environ.get('PIPER_POOL_ACQUIRE_TIMEOUT', 60))
+PIPER_POOL_CHECK_INTERVAL = 30
+
+class PiperWorker:
+    """Long-lived piper process fed one JSON line per sentence (--json-input)."""
+
+    def __init__(self, model_path, scales):
+        self.model_path = model_path
+        self.scales = scales  # (noise_scale, length_scale, noise_w) are per-process piper arguments
+        self.process = None
+        self.started_at = self.last_used = time.monotonic()
+        self.jobs_done = 0
+        self._lines = queue.Queue()
+        self._stderr_tail = collections.deque(maxlen=20)
+
+    @property
+    def key(self):
+        return (self.model_path,) + self.scales
+
+    def start(self):
+        noise_scale, length_scale, noise_w = self.scales
+        command = [
+            piper_binary_path, '-m', self.model_path, '--json-input',
+            '--noise-scale', str(noise_scale),
+            '--length-scale', str(length_scale),
+            '--noise-w', str(noise_w),
+        ]
+        logging.debug(f"[PIPER-POOL] Starting worker: {' '.join(command)}")
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE, text=True, encoding='utf-8', bufsize=1,
+        )
+        # Drain stdout/stderr in background so piper never blocks on a full pipe
+        threading.Thread(target=self._read_stdout, args=(self.process,), daemon=True).start()
+        threading.Thread(target=self._read_stderr, args=(self.process,), daemon=True).start()
+
+    def _read_stdout(self, process):
+        for line in process.stdout:
+            self._lines.put(line.strip())
+        self._lines.put(None)  # EOF: the process exited
+
+    def _read_stderr(self, process):
+        for line in process.stderr:
+            self._stderr_tail.append(line.rstrip())
+
+    def is_healthy(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stderr_tail(self):
+        return '\n'.join(self._stderr_tail)
+
+    def synthesize(self, text, output_file, speaker=0, timeout=60):
+        """Synthesize one sentence into output_file; raises on crash or timeout."""
+        request_line = json.dumps({
+            'text': text,
+            'output_file': os.path.abspath(output_file),
+            'speaker_id': int(speaker),
+        }, ensure_ascii=False)
+        self.process.stdin.write(request_line + '\n')
+        self.process.stdin.flush()
+        try:
+            line = self._lines.get(timeout=timeout)
+        except queue.Empty:
+            raise subprocess.TimeoutExpired(self.process.args, timeout)
+        if line is None:
+            raise RuntimeError(f"Piper worker exited with code {self.process.poll()}. Stderr: {self.stderr_tail()}")
+        self.jobs_done += 1
+        self.last_used = time.monotonic()
+        return line
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            if self.process.poll() is None:
+                self.process.stdin.close()
+                self.process.wait(timeout=2)
+        except Exception:
+            pass
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class PiperWorkerPool:
+    """Pool of PiperWorker processes keyed by (model_path, noise_scale, length_scale, noise_w)."""
+
+    def __init__(self, size, max_processes, idle_timeout):
+        self.size = size
+        self.max_processes = max(max_processes, 1)
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._idle = {}    # key -> [PiperWorker]
+        self._counts = {}  # key -> workers alive (idle + busy)
+        self._total = 0
+        self._retired = {}  # model_path -> when its file was replaced or removed
+        self.restarts = 0
+
+    @staticmethod
+    def make_key(model_path, settings):
+        return (
+            model_path,
+            float(settings.get('noise_scale', 0.667)),
+            float(settings.get('length_scale', 1.0)),
+            float(settings.get('noise_w', 0.8)),
+        )
+
+    def acquire(self, model_path, settings, timeout=PIPER_POOL_ACQUIRE_TIMEOUT):
+        key = self.make_key(model_path, settings)
+        deadline = time.monotonic() + timeout
+        to_stop = []
+        try:
+            with self._cond:
+                while True:
+                    idle = self._idle.get(key)
+                    while idle:
+                        worker = idle.pop()
+                        if worker.is_healthy():
+                            return worker
+                        # Crashed while idle: drop it and start a fresh one below
+                        logging.warning(f"[PIPER-POOL] Idle worker for {os.path.basename(model_path)} died (code {worker.process.poll()}), restarting")
+                        self.restarts += 1
+                        self._forget_locked(worker)
+                        to_stop.append(worker)
+                    if self._counts.get(key, 0) < self.size:
+                        if self._total < self.max_processes or self._evict_oldest_idle_locked(to_stop):
+                            self._counts[key] = self._counts.get(key, 0) + 1
+                            self._total += 1
+                            break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError(f"No piper worker available for {os.path.basename(model_path)} after {timeout}s")
+                    self._cond.wait(remaining)
+        finally:
+            for worker in to_stop:
+                worker.stop()
+
+        worker = PiperWorker(key[0], key[1:])
+        try:
+            worker.start()
+        except Exception:
+            with self._cond:
+                self._forget_locked(worker)
+                self._cond.notify_all()
+            raise
+        return worker
+
+    def release(self, worker, healthy=True):
+        with self._cond:
+            retired = worker.started_at <= self._retired.get(worker.model_path, float('-inf'))
+            if healthy and worker.is_healthy() and not retired:
+                worker.last_used = time.monotonic()
+                self._idle.setdefault(worker.key, []).append(worker)
+                worker = None
+            else:
+                if not retired:
+                    self.restarts += 1
+                self._forget_locked(worker)
+            self._cond.notify_all()
+        if worker is not None:
+            worker.stop()
+
+    def _forget_locked(self, worker):
+        key = worker.key
+        self._counts[key] = self._counts.get(key, 1) - 1
+        if self._counts[key] <= 0:
+            self._counts.pop(key, None)
+        self._total -= 1
+
+    def _evict_oldest_idle_locked(self, to_stop):
+        oldest = None
+        for workers in self._idle.values():
+            for worker in workers:
+                if oldest is None or worker.last_used < oldest.last_used:
+                    oldest = worker
+        if oldest is None:
+            return False
+        self._idle[oldest.key].remove(oldest)
+        self._forget_locked(oldest)
+        to_stop.append(oldest)
+        return True
+
+    def model_processes(self, model_path):
+        """Piper processes alive (idle or busy) for a model file, across all scale settings."""
+        with self._cond:
+            return sum(count for key, count in self._counts.items() if key[0] == model_path)
+
+    def retire(self, model_path):
+        """Stop the idle workers of a model file; busy ones are stopped when released."""
+        to_stop = []
+        with self._cond:
+            self._retired[model_path] = time.monotonic()
+            for key in [key for key in self._idle if key[0] == model_path]:
+                for worker in self._idle.pop(key):
+                    self._forget_locked(worker)
+                    to_stop.append(worker)
+            self._cond.notify_all()
+        for worker in to_stop:
+            worker.stop()
+
+    def maintain(self):
+        """Health check idle workers and evict the ones idle for too long."""
+        now = time.monotonic()
+        to_stop = []
+        with self._cond:
+            for key, workers in list(self._idle.items()):
+                for worker in list(workers):
+                    if not worker.is_healthy():
+                        logging.warning(f"[PIPER-POOL] Worker for {os.path.basename(worker.model_path)} died (code {worker.process.poll()}). Stderr: {worker.stderr_tail()}")
+                        self.restarts += 1
+                    elif now - worker.last_used < self.idle_timeout:
+                        continue
+                    workers.remove(worker)
+                    self._forget_locked(worker)
+                    to_stop.append(worker)
+                if not workers:
+                    del self._idle[key]
+            if to_stop:
+                self._cond.notify_all()
+        for worker in to_stop:
+            logging.debug(f"[PIPER-POOL] Stopping worker for {os.path.basename(worker.model_path)}")
+            worker.stop()
+
+    def shutdown(self):
+        with self._cond:
+            workers = [worker for idle in self._idle.values() for worker in idle]
+            self._idle.clear()
+        for worker in workers:
+            worker.stop()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'processes': self._total,
+                'idle': sum(len(workers) for workers in self._idle.values()),
+                'restarts': self.restarts,
+            }
+
+def _piper_pool_maintenance_loop():
+    while True:
+        time.sleep(PIPER_POOL_CHECK_INTERVAL)
+        try:
+            piper_pool.maintain()
+        except Exception as e:
+            logging.error(f"[PIPER-POOL] Maintenance error: {e}")
+
+piper_pool = None
+
+def start_piper_pool():
+    """Create this process's piper worker pool and its maintenance thread."""
+    global piper_pool
+    if PIPER_POOL_SIZE <= 0 or piper_pool is not None:
+        return piper_pool
+    logging.info(f"Initializing piper worker pool: {PIPER_POOL_SIZE} workers per model, {PIPER_POOL_MAX_PROCESSES} max processes.")
+    piper_pool = PiperWorkerPool(PIPER_POOL_SIZE, PIPER_POOL_MAX_PROCESSES, PIPER_WORKER_IDLE_SECONDS)
+    threading.Thread(target=_piper_pool_maintenance_loop, daemon=True).start()
+    return piper_pool
+
+atexit.register(lambda: piper_pool and piper_pool.shutdown())
+
 def random_string(length=8):
     return ''.join(random.choices(string.ascii_letters + string.digits, k=length))
 
-def multiple_replace(text, replacements):
+def replacement_pattern(old):
     """
-    Apply text replacements with proper word boundary handling to avoid partial matches.
-    Only replaces complete words/phrases separated by spaces, not partial matches.
-    
-    Args:
-        text (str): Input text to process
-        replacements (list): List of (find, replace) tuples
-    
-    Returns:
-        str: Text with replacements applied
+    Build the regex for one (old, new) replacement.
+    Only complete words/phrases separated by spaces are matched, not partial matches.
     """
-    if not text or not replacements:
-        return text
-    
-    logging.debug(f"[REPLACEMENTS] Starting text: '{text[:100]}{'...' if len(text) > 100 else ''}'")
-    original_text = text
-    
-    for old, new in replacements:
-        if not old:  # Skip empty find strings
-            continue
-            
-        # Count occurrences before replacement for logging
-        before_count = text.count(old)
-        
-        # Always use word boundaries for intelligent replacement
-        # This ensures we only replace complete words/phrases, not partial matches
-        
-        # Special handling for abbreviations ending with period
-        if old.endswith('.'):
-            # For abbreviations like "Mr.", "Dr.", use exact match with word boundary before
-            pattern = r'\b' + re.escape(old)
-            text = re.sub(pattern, new, text, flags=re.IGNORECASE)
-        elif ' ' in old:
-            # For multi-word phrases like "1 día", "2 días", use exact phrase matching
-            # This prevents "15 días" from being affected by "1" -> "uno" and "5" -> "cinco"
-            pattern = r'\b' + re.escape(old) + r'\b'
-            text = re.sub(pattern, new, text, flags=re.IGNORECASE)
-        else:
-            # For single words/numbers, use strict word boundaries
-            # Avoid replacing numbers that are part of larger numbers or have commas/decimals
-            if old.isdigit():
-                # Don't replace if the number is part of a larger number, decimal, or comma-separated
-                # BUT allow replacement when followed by period (enumeration context)
-                pattern = r'\b' + re.escape(old) + r'(?![0-9,]|\.(?!\s))'
-                text = re.sub(pattern, new, text, flags=re.IGNORECASE)
-            else:
-                # For non-numeric replacements, use standard word boundaries
-                pattern = r'\b' + re.escape(old) + r'\b'
-                text = re.sub(pattern, new, text, flags=re.IGNORECASE)
-        
-        # Count occurrences after replacement for logging
-        after_count = text.count(old)
-        replacements_made = before_count - after_count
-        
-        if replacements_made > 0:
-            logging.debug(f"[REPLACEMENTS] '{old}' → '{new}' ({replacements_made} replacements)")
-    
-    if text != original_text:
-        logging.debug(f"[REPLACEMENTS] Final text: '{text[:100]}{'...' if len(text) > 100 else ''}'")
+    # Special handling for abbreviations ending with period
+    if old.endswith('.'):
+        # For abbreviations like "Mr.", "Dr.", use exact match with word boundary before
+        return r'\b' + re.escape(old)
+    elif ' ' in old:
+        # For multi-word phrases like "1 día", "2 días", use exact phrase matching
+        # This prevents "15 días" from being affected by "1" -> "uno" and "5" -> "cinco"
+        return r'\b' + re.escape(old) + r'\b'
+    elif old.isdigit():
+        # Don't replace if the number is part of a larger number, decimal, or comma-separated
+        # BUT allow replacement when followed by period (enumeration context)
+        return r'\b' + re.escape(old) + r'(?![0-9,]|\.(?!\s))'
     else:
-        logging.debug(f"[REPLACEMENTS] No changes made to text")
-    
-    return text
+        # For non-numeric replacements, use standard word boundaries
+        return r'\b' + re.escape(old) + r'\b'
+
+class ReplacementEngine:
+    """
+    A replacement list compiled into as few regex passes as possible.
+
+    Applying the list one pair at a time costs one full scan per pair.
+    Consecutive pairs are instead packed into one alternation, dispatched on
+    m.lastgroup, whenever that is provably equivalent to applying them in list
+    order. No two packed patterns may overlap in any text. No packed pattern
+    may match text produced by an earlier replacement in the pass. And no
+    replacement may change the boundary context a later pattern sees next to
+    it. Pairs that fail the checks, or whose replacement is a regex template
+    (contains a backslash), start a new pass.
+    """
+
+    # Neighbouring characters that decide \b and the digit look-ahead
+    LEFT_CONTEXTS = ('', ' ', 'a')
+    RIGHT_CONTEXTS = ('', ' ', 'a', '0', ',', '. ', '.a')
+    _ids = itertools.count(1)
+
+    def __init__(self, replacements):
+        self.set_id = next(self._ids)  # Stable identity for caches keyed by replacement set
+        self.passes = []
+        entries = []
+        for old, new in replacements:
+            if not old:  # Skip empty find strings
+                continue
+            entries.append((old, new, re.compile(replacement_pattern(old), re.IGNORECASE)))
+        group = []
+        for entry in entries:
+            if group and ('\\' in entry[1] or not all(self._independent(earlier, entry) for earlier in group)):
+                self._add_pass(group)
+                group = []
+            group.append(entry)
+            if '\\' in entry[1]:
+                self._add_pass(group)
+                group = []
+        if group:
+            self._add_pass(group)
+
+    def _add_pass(self, group):
+        if len(group) == 1:
+            old, new, pattern = group[0]
+            self.passes.append((pattern, new, {None: old}))
+            return
+        # Every pattern starts with \b; hoisting it and a first-character class out of the
+        # alternation lets the scanner skip most positions without trying each branch
+        alternatives = '|'.join(f'(?P<r{k}>{entry[2].pattern[2:]})' for k, entry in enumerate(group))
+        first_chars = ''.join(sorted({re.escape(entry[0][0]) for entry in group}))
+        values = {f'r{k}': entry[1] for k, entry in enumerate(group)}
+        pattern = re.compile(rf'\b(?=[{first_chars}])(?:{alternatives})', re.IGNORECASE)
+        self.passes.append((pattern, lambda m: values[m.lastgroup], {f'r{k}': entry[0] for k, entry in enumerate(group)}))
+
+    @staticmethod
+    def _matches(pattern, text, start, length):
+        match = pattern.match(text, start)
+        return match is not None and match.end() == start + length
+
+    @staticmethod
+    def _placements(base, old):
+        """Yield (offset, merged) for every way old can overlap or straddle base without contradicting it."""
+        base_lower, old_lower = base.lower(), old.lower()
+        for offset in range(1 - len(old), max(len(base), 1)):
+            if not base and offset == 0:
+                continue
+            overlap_start, overlap_end = max(0, offset), min(len(base), offset + len(old))
+            if base_lower[overlap_start:overlap_end] != old_lower[overlap_start - offset:overlap_end - offset]:
+                continue
+            prefix = old[:max(0, -offset)]
+            suffix = old[len(base) - offset:] if offset + len(old) > len(base) else ''
+            yield offset, prefix + base + suffix
+
+    def _independent(self, earlier, later):
+        old_i, new_i, pattern_i = earlier
+        old_j, new_j, pattern_j = later
+        for left in self.LEFT_CONTEXTS:
+            for right in self.RIGHT_CONTEXTS:
+                # The two patterns must never match overlapping text
+                for offset, merged in self._placements(old_i, old_j):
+                    text = left + merged + right
+                    start_i = len(left) + max(0, -offset)
+                    if (self._matches(pattern_i, text, start_i, len(old_i)) and
+                            self._matches(pattern_j, text, start_i + offset, len(old_j))):
+                        return False
+                # The later pattern must never match (part of) the earlier replacement
+                for offset, merged in self._placements(new_i, old_j):
+                    text = left + merged + right
+                    start_new = len(left) + max(0, -offset)
+                    if not self._matches(pattern_j, text, start_new + offset, len(old_j)):
+                        continue
+                    source = text[:start_new] + old_i + text[start_new + len(new_i):]
+                    if self._matches(pattern_i, source, start_new, len(old_i)):
+                        return False
+                # The earlier replacement must not change what the later pattern sees beside it
+                for middle in ('', '.'):
+                    before = left + old_j + middle
+                    original, replaced = before + old_i + right, before + new_i + right
+                    if (self._matches(pattern_i, original, len(before), len(old_i)) and
+                            self._matches(pattern_j, original, len(left), len(old_j)) !=
+                            self._matches(pattern_j, replaced, len(left), len(old_j))):
+                        return False
+                original, replaced = left + old_i + old_j + right, left + new_i + old_j + right
+                if (self._matches(pattern_i, original, len(left), len(old_i)) and
+                        self._matches(pattern_j, original, len(left) + len(old_i), len(old_j)) !=
+                        self._matches(pattern_j, replaced, len(left) + len(new_i), len(old_j))):
+                    return False
+        return True
+
+    def apply(self, text):
+        debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        for pattern, replacement, olds in self.passes:
+            if not debug:
+                text = pattern.sub(replacement, text)
+                continue
+            counts = collections.Counter()
+            if callable(replacement):
+                def counting(m, replacement=replacement):
+                    counts[m.lastgroup] += 1
+                    return replacement(m)
+                text = pattern.sub(counting, text)
+            else:
+                text, counts[None] = pattern.subn(replacement, text)
+            for name, count in counts.items():
+                if count:
+                    logging.debug(f"[REPLACEMENTS] '{olds[name]}' ({count} replacements)")
+        return text
+
+@lru_cache(maxsize=64)
+def _compiled_replacements(replacements):
+    return ReplacementEngine(replacements)
+
+def get_replacement_engine(replacements):
+    """Return the compiled engine for a replacement list, built once per distinct list."""
+    return _compiled_replacements(tuple(tuple(pair) for pair in replacements))
+
+# Model replacement lists are compiled on first use; the shared global list up front
+if global_replacements:
+    get_replacement_engine(global_replacements)
+
+# Normalization patterns, compiled once at import
+CODE_BLOCK_RE = re.compile(r'```[^`\n]*\n.*?```', re.DOTALL)
+LINE_END_PUNCTUATION_RE = re.compile(r'[.!?,:;]$')
+LINE_BREAK_FIXUPS = [
+    (re.compile(r'(\))(?![.,;!?"\'])(?=\s|$)'), r'\1,'), # Add comma after ')' if not followed by punctuation
+    (re.compile(r'(\.)(\s*\.)+'), r'\1'), # Collapse multiple periods
+    (re.compile(r'(\s\.)'), r'.'), # Remove space before period
+    (re.compile(r'(\s,)'), r','), # Remove space before comma
+    # Evitar secuencias problemáticas como ",."
+    (re.compile(r',\s*\.'), ','), # Remove period after comma
+    # Reemplazar puntos después de números (tanto en texto como dígitos) con comas para evitar segmentación
+    # Incluir números hasta 30 y algunos números mayores comunes
+    (re.compile(r'\b(uno|dos|tres|cuatro|cinco|seis|siete|ocho|nueve|diez|once|doce|trece|catorce|quince|dieciséis|diecisiete|dieciocho|diecinueve|veinte|veintiuno|veintidós|veintitrés|veinticuatro|veinticinco|veintiséis|veintisiete|veintiocho|veintinueve|treinta)\.\s+'), r'\1, '),
+    # También reemplazar números en dígitos seguidos de punto
+    (re.compile(r'\b(\d{1,2})\.\s+'), r'\1, '),
+]
+WHITESPACE_RE = re.compile(r'\s+')
 
 def filter_code_blocks(text):
-    return re.sub(r'```[^`\n]*\n.*?```', '', text, flags=re.DOTALL)
+    return CODE_BLOCK_RE.sub('', text)
 
 def process_line_breaks(text):
     lines = [line.strip() for line in text.splitlines() if line.strip()]
@@ -390,26 +1226,116 @@ def process_line_breaks(text):
     processed = []
     for i, line in enumerate(lines):
         # Si no es la última línea y no termina en puntuación, agregar coma (no punto)
-        if i < len(lines) - 1 and not re.search(r'[.!?,:;]$', line):
+        if i < len(lines) - 1 and not LINE_END_PUNCTUATION_RE.search(line):
             processed.append(line + ',')
         else:
             processed.append(line)
     processed_text = ' '.join(processed)
     # Refine punctuation placement
-    processed_text = re.sub(r'(\))(?![.,;!?"\'])(?=\s|$)', r'\1,', processed_text) # Add comma after ')' if not followed by punctuation
-    processed_text = re.sub(r'(\.)(\s*\.)+', r'\1', processed_text) # Collapse multiple periods
-    processed_text = re.sub(r'(\s\.)', r'.', processed_text) # Remove space before period
-    processed_text = re.sub(r'(\s,)', r',', processed_text) # Remove space before comma
-    # Evitar secuencias problemáticas como ",."
-    processed_text = re.sub(r',\s*\.', ',', processed_text) # Remove period after comma
-    # Reemplazar puntos después de números (tanto en texto como dígitos) con comas para evitar segmentación
-    # Incluir números hasta 30 y algunos números mayores comunes
-    processed_text = re.sub(r'\b(uno|dos|tres|cuatro|cinco|seis|siete|ocho|nueve|diez|once|doce|trece|catorce|quince|dieciséis|diecisiete|dieciocho|diecinueve|veinte|veintiuno|veintidós|veintitrés|veinticuatro|veinticinco|veintiséis|veintisiete|veintiocho|veintinueve|treinta)\.\s+', r'\1, ', processed_text)
-    # También reemplazar números en dígitos seguidos de punto
-    processed_text = re.sub(r'\b(\d{1,2})\.\s+', r'\1, ', processed_text)
-    processed_text = re.sub(r'\s+', ' ', processed_text).strip() # Normalize whitespace
+    for pattern, replacement in LINE_BREAK_FIXUPS:
+        processed_text = pattern.sub(replacement, processed_text)
+    processed_text = WHITESPACE_RE.sub(' ', processed_text).strip() # Normalize whitespace
     return processed_text
 
+# Abreviaciones comunes en múltiples idiomas (expandida para evitar cortes)
+SENTENCE_ABBREVIATIONS = {
+    'es': ('Sr', 'Sra', 'Srta', 'Dr', 'Dra', 'Prof', 'Profa', 'Lic', 'Licda', 'Ing', 'Inga', 'Arq', 'Arqa', 'Mtro', 'Mtra', 'etc', 'vs', 'p.ej', 'i.e', 'cf', 'vol', 'cap', 'art', 'núm', 'pág', 'ed', 'op.cit'),
+    'en': ('Mr', 'Mrs', 'Ms', 'Miss', 'Dr', 'Prof', 'Inc', 'Ltd', 'Corp', 'Co', 'vs', 'e.g', 'i.e', 'cf', 'vol', 'ch', 'art', 'no', 'pg', 'ed', 'op.cit'),
+    'fr': ('M', 'Mme', 'Mlle', 'Dr', 'Prof', 'etc', 'vs', 'p.ex', 'c.à.d', 'cf', 'vol', 'ch', 'art', 'n°', 'p', 'éd'),
+    'de': ('Hr', 'Fr', 'Frl', 'Dr', 'Prof', 'etc', 'vs', 'z.B', 'd.h', 'vgl', 'Bd', 'Kap', 'Art', 'Nr', 'S', 'Hrsg'),
+    'it': ('Sig', 'Sig.ra', 'Sig.na', 'Dr', 'Prof', 'ecc', 'vs', 'ad.es', 'cioè', 'cfr', 'vol', 'cap', 'art', 'n', 'p', 'ed'),
+    'pt': ('Sr', 'Sra', 'Srta', 'Dr', 'Dra', 'Prof', 'Profa', 'etc', 'vs', 'p.ex', 'ou.seja', 'cf', 'vol', 'cap', 'art', 'n', 'p', 'ed'),
+}
+ABBREVIATIONS = frozenset(abbrev for abbrevs in SENTENCE_ABBREVIATIONS.values() for abbrev in abbrevs)
+MAX_ABBREVIATION_LENGTH = max(len(abbrev) for abbrev in ABBREVIATIONS)
+SENTENCE_TERMINATOR_RUN_RE = re.compile(r'([.!?¡¿…]+)\s*')
+LAST_WHITESPACE_RE = re.compile(r'\s(?=\S*\Z)')
+FIRST_NON_WHITESPACE_RE = re.compile(r'\S')
+CONTROL_WHITESPACE_RE = re.compile(r'[\r\n\t]+')
+SPEAKABLE_CHAR_RE = re.compile(r'[a-zA-ZáéíóúñüÁÉÍÓÚÑÜ0-9]')
+WORD_RE = re.compile(r'\b\w+\b')
+FALLBACK_SPLIT_RE = re.compile(r'[.!?]+\s+')
+MIN_SENTENCE_WORDS = 3
+LONG_SENTENCE_CHARS = 500
+COMMA_CHUNK_CHARS = 200
+
+def starts_with_abbreviation(word):
+    """True when word begins with a known abbreviation followed by a period ("Sr.", "p.ej.", "Dr.García")."""
+    dot = word.find('.', 1)
+    while dot != -1 and dot <= MAX_ABBREVIATION_LENGTH:
+        if word[:dot] in ABBREVIATIONS:
+            return True
+        dot = word.find('.', dot + 1)
+    return False
+
+def _sentence_boundaries(text):
+    """
+    Yield raw sentences in one left-to-right pass over the terminator runs.
+
+    A run of [.!?¡¿…] (plus trailing whitespace) ends the sentence unless the
+    sentence's last word, when it is not also its first, starts with an
+    abbreviation. The word boundaries are tracked as the scan advances, so no
+    piece of the text is split or re-scanned more than once.
+    """
+    sentence_start = 0
+    first_word_start = None  # First non-whitespace character of the current sentence
+    word_start = 0  # Start of the word the scan is currently in
+    position = 0
+    for match in SENTENCE_TERMINATOR_RUN_RE.finditer(text):
+        run_start, run_end, end = match.start(), match.end(1), match.end()
+        if run_start > position:
+            space = LAST_WHITESPACE_RE.search(text, position, run_start)
+            if space:
+                word_start = space.end()
+        if first_word_start is None:
+            first = FIRST_NON_WHITESPACE_RE.search(text, sentence_start, run_end)
+            first_word_start = first.start()
+        if first_word_start < word_start:
+            last_word = text[word_start:run_end]
+        else:
+            last_word = ""  # A single-word sentence never counts as an abbreviation
+        position = end
+        if end > run_end:
+            word_start = end
+        if not starts_with_abbreviation(last_word):
+            yield text[sentence_start:end].strip()
+            sentence_start = end
+            first_word_start = None
+    if text[sentence_start:].strip():
+        yield text[sentence_start:].strip()
+
+def _merge_short_sentences(sentences):
+    """Append sentences under three words to the previous one; fragments are joined once at the end."""
+    merged = []
+    for sentence in sentences:
+        if len(sentence) > 2 and len(WORD_RE.findall(sentence)) >= MIN_SENTENCE_WORDS:
+            merged.append([sentence])
+        elif merged:
+            merged[-1].append(sentence)
+        elif len(sentence.strip()) > 2:
+            merged.append([sentence])
+    return merged
+
+def _split_long_sentence(sentence):
+    """Break a sentence over 500 characters into comma-joined chunks of up to ~200 characters."""
+    chunks = []
+    chunk = []
+    chunk_length = 0
+    for part in sentence.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if chunk and chunk_length + 2 + len(part) > COMMA_CHUNK_CHARS:
+            chunks.append(', '.join(chunk))
+            chunk = [part]
+            chunk_length = len(part)
+        else:
+            chunk_length += len(part) + (2 if chunk else 0)
+            chunk.append(part)
+    if chunk:
+        chunks.append(', '.join(chunk))
+    return chunks
+
 def split_sentences(text):
     """
     Divide texto en oraciones de manera inteligente para síntesis de voz.
@@ -439,111 +1365,32 @@ def split_sentences(text):
     if not text or not text.strip():
         return []
     
-    # Abreviaciones comunes en múltiples idiomas (expandida para evitar cortes)
-    abbreviations = {
-        'es': r'(?:Sr|Sra|Srta|Dr|Dra|Prof|Profa|Lic|Licda|Ing|Inga|Arq|Arqa|Mtro|Mtra|etc|vs|p\.ej|i\.e|cf|vol|cap|art|núm|pág|ed|op\.cit)',
-        'en': r'(?:Mr|Mrs|Ms|Miss|Dr|Prof|Inc|Ltd|Corp|Co|vs|e\.g|i\.e|cf|vol|ch|art|no|pg|ed|op\.cit)',
-        'fr': r'(?:M|Mme|Mlle|Dr|Prof|etc|vs|p\.ex|c\.à\.d|cf|vol|ch|art|n°|p|éd)',
-        'de': r'(?:Hr|Fr|Frl|Dr|Prof|etc|vs|z\.B|d\.h|vgl|Bd|Kap|Art|Nr|S|Hrsg)',
-        'it': r'(?:Sig|Sig\.ra|Sig\.na|Dr|Prof|ecc|vs|ad\.es|cioè|cfr|vol|cap|art|n|p|ed)',
-        'pt': r'(?:Sr|Sra|Srta|Dr|Dra|Prof|Profa|etc|vs|p\.ex|ou\.seja|cf|vol|cap|art|n|p|ed)'
-    }
-    
-    # Combinar todas las abreviaciones
-    all_abbrevs = '|'.join(abbreviations.values())
-    
-    # Usar método simple más confiable para evitar errores de regex
-    # Dividir por puntuación seguida de espacio y mayúscula, pero proteger abreviaciones
-    sentences = []
-    current_sentence = ""
-    
-    # Dividir por oraciones pero verificar abreviaciones
-    parts = re.split(r'([.!?¡¿…]+\s*)', text)
-    
-    for i, part in enumerate(parts):
-        current_sentence += part
-        
-        # Si termina en puntuación
-        if re.match(r'[.!?¡¿…]+\s*$', part):
-            # Verificar si la oración anterior termina en abreviación
-            words = current_sentence.strip().split()
-            if words:
-                last_word = words[-1] if len(words) > 1 else ""
-                # Si no termina en abreviación conocida, es fin de oración
-                is_abbreviation = False
-                for abbrev_pattern in abbreviations.values():
-                    if re.match(rf'({abbrev_pattern})\.', last_word):
-                        is_abbreviation = True
-                        break
-                
-                if not is_abbreviation:
-                    sentences.append(current_sentence.strip())
-                    current_sentence = ""
-    
-    # Agregar cualquier texto restante
-    if current_sentence.strip():
-        sentences.append(current_sentence.strip())
-    
     # Limpiar y filtrar oraciones
-    cleaned_sentences = []
-    for sentence in sentences:
+    cleaned = []  # Each entry is a list of fragments joined with spaces at the end
+    for sentence in _sentence_boundaries(text):
         # Limpiar espacios y caracteres de control
-        clean_sentence = re.sub(r'[\r\n\t]+', ' ', sentence).strip()
+        clean_sentence = CONTROL_WHITESPACE_RE.sub(' ', sentence).strip()
         
         # Filtrar oraciones muy cortas o que solo contienen puntuación
-        if len(clean_sentence) > 2 and re.search(r'[a-zA-ZáéíóúñüÁÉÍÓÚÑÜ0-9]', clean_sentence):
-            # Si la oración es muy larga (más de 500 caracteres), dividirla por comas
-            if len(clean_sentence) > 500:
-                # Dividir por comas y procesar cada parte
-                comma_parts = [part.strip() for part in clean_sentence.split(',') if part.strip()]
-                current_chunk = ""
-                
-                for part in comma_parts:
-                    # Si agregar esta parte haría que el chunk sea muy largo, guardar el chunk actual
-                    if len(current_chunk + ', ' + part) > 200 and current_chunk:
-                        cleaned_sentences.append(current_chunk.strip())
-                        current_chunk = part
-                    else:
-                        if current_chunk:
-                            current_chunk += ', ' + part
-                        else:
-                            current_chunk = part
-                
-                # Agregar el último chunk si no está vacío
-                if current_chunk.strip():
-                    cleaned_sentences.append(current_chunk.strip())
-            else:
-                # Verificar que tenga al menos 3 palabras para dividir el texto (reducido de 7)
-                word_count = len(re.findall(r'\b\w+\b', clean_sentence))
-                if word_count >= 3:
-                    cleaned_sentences.append(clean_sentence)
-                else:
-                    # Si tiene menos de 3 palabras, combinarla con la anterior si existe
-                    if cleaned_sentences:
-                        cleaned_sentences[-1] += ' ' + clean_sentence
-                    else:
-                        # Si es la primera, mantenerla si tiene contenido válido
-                        if len(clean_sentence.strip()) > 2:
-                            cleaned_sentences.append(clean_sentence)
-        
+        if len(clean_sentence) <= 2 or not SPEAKABLE_CHAR_RE.search(clean_sentence):
+            continue
+        if len(clean_sentence) > LONG_SENTENCE_CHARS:
+            # Si la oración es muy larga, dividirla por comas
+            cleaned.extend([chunk] for chunk in _split_long_sentence(clean_sentence))
+        elif len(WORD_RE.findall(clean_sentence)) >= MIN_SENTENCE_WORDS:
+            cleaned.append([clean_sentence])
+        elif cleaned:
+            # Si tiene menos de 3 palabras, combinarla con la anterior
+            cleaned[-1].append(clean_sentence)
+        else:
+            cleaned.append([clean_sentence])
+    
     # Si no se pudo dividir correctamente, usar método de respaldo
-    if not cleaned_sentences and text.strip():
-        # Método de respaldo más simple
-        fallback_sentences = re.split(r'[.!?]+\s+', text.strip())
-        temp_sentences = [s.strip() for s in fallback_sentences if s.strip()]
-        
-        # Combinar oraciones muy cortas en el método de respaldo
-        cleaned_sentences = []
-        for sentence in temp_sentences:
-            if len(sentence) > 2 and len(re.findall(r'\b\w+\b', sentence)) >= 3:
-                cleaned_sentences.append(sentence)
-            elif cleaned_sentences:
-                # Combinar con la anterior si tiene menos de 3 palabras
-                cleaned_sentences[-1] += ' ' + sentence
-            else:
-                # Si es la primera y es corta, mantenerla si tiene contenido válido
-                if len(sentence.strip()) > 2:
-                    cleaned_sentences.append(sentence)
+    if not cleaned:
+        fallback_sentences = [sentence.strip() for sentence in FALLBACK_SPLIT_RE.split(text.strip()) if sentence.strip()]
+        cleaned = _merge_short_sentences(fallback_sentences)
+    
+    cleaned_sentences = [' '.join(fragments) for fragments in cleaned]
     
     # Log the divided text with <> separators
     if cleaned_sentences:
@@ -552,70 +1399,159 @@ def split_sentences(text):
     
     return cleaned_sentences
 
-def filter_text_segment(text_segment, model_replacements):
+# Target length of each synthesis job in characters (0 disables packing)
+SENTENCE_PACK_TARGET_CHARS = int(os.environ.get('SENTENCE_PACK_TARGET_CHARS', 200))
+CLAUSE_BREAK_RE = re.compile(r'(?<=[,;:])\s+')
+
+def _pack_adjacent(units, target_chars):
+    """Greedily join consecutive units with a space while the result stays within target_chars."""
+    packed = []
+    packed_length = 0
+    for unit in units:
+        if packed and packed_length + 1 + len(unit) <= target_chars:
+            packed[-1].append(unit)
+            packed_length += 1 + len(unit)
+        else:
+            packed.append([unit])
+            packed_length = len(unit)
+    return [' '.join(parts) for parts in packed]
+
+def pack_sentences(sentences, target_chars=None):
     """
-    Process text segment with comprehensive filtering and replacement logic.
-    
-    Args:
-        text_segment (str): Raw text to process
-        model_replacements (list): Model-specific replacements
-    
-    Returns:
-        str: Processed text ready for TTS
+    Even out synthesis job sizes around target_chars.
+
+    Sentences longer than 1.5x the target are split at clause punctuation
+    (, ; :) and short neighbours are joined, so one long sentence no longer
+    sets the latency of the whole request while many tiny ones don't each pay
+    a synthesis call. Text is only ever cut after punctuation, and the output
+    keeps the original order.
     """
-    logging.debug(f"[FILTER] Processing segment: '{text_segment[:100]}{'...' if len(text_segment) > 100 else ''}'")
-    
-    # Step 1: Remove code blocks
-    text = filter_code_blocks(text_segment)
-    logging.debug(f"[FILTER] After code block removal: '{text[:100]}{'...' if len(text) > 100 else ''}'")
-    
-    # Step 2: Process line breaks
-    text = process_line_breaks(text)
-    logging.debug(f"[FILTER] After line break processing: '{text[:100]}{'...' if len(text) > 100 else ''}'")
-    
-    # Step 3: Apply replacements - prioritize model-specific over global
-    if model_replacements:
-        logging.debug(f"[FILTER] Using {len(model_replacements)} model-specific replacements (ignoring global)")
-        text = multiple_replace(text, model_replacements)
-    elif global_replacements:
-        logging.debug(f"[FILTER] No model replacements found, using {len(global_replacements)} global replacements")
-        text = multiple_replace(text, global_replacements)
-    else:
-        logging.debug(f"[FILTER] No replacements available (no model or global replacements)")
-    
-    # Step 5: Final cleanup
-    text = re.sub(r'\s+', ' ', text).strip() # Normalize whitespace
-    
-    # Removed the "punto y seguido" replacement that was causing issues
-    # Keep periods as they are - only use commas for line breaks, not for existing periods
-    
-    # Removed character limit to allow full text processing
-    
-    logging.debug(f"[FILTER] Final processed text: '{text[:100]}{'...' if len(text) > 100 else ''}'")
-    return text
+    if target_chars is None:
+        target_chars = SENTENCE_PACK_TARGET_CHARS
+    if target_chars <= 0 or not sentences:
+        return sentences
+    units = []
+    for sentence in sentences:
+        if len(sentence) > target_chars * 1.5:
+            units.extend(_pack_adjacent(CLAUSE_BREAK_RE.split(sentence), target_chars))
+        else:
+            units.append(sentence)
+    return _pack_adjacent(units, target_chars)
 
-def generate_silence(seconds, temp_dir):
-    if seconds <= 0:
-        return None
-    output_file = os.path.join(temp_dir, f"silence_{random_string(4)}_{seconds}s.wav")
-    try:
-        subprocess.run(
-            [
-                ffmpeg_path, '-loglevel', 'error', '-f', 'lavfi',
-                '-i', 'anullsrc=r=22050:cl=mono', '-t', str(seconds),
-                '-ar', '22050', '-ac', '1', '-f', 'wav', '-y', output_file
-            ],
-            check=True, capture_output=True, text=True
-        )
-        if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-            logging.debug(f"Generated silence file: {output_file}")
-            return output_file
+# Normalization result cache (entries; 0 disables)
+NORMALIZATION_CACHE_SIZE = int(os.environ.get('NORMALIZATION_CACHE_SIZE', 2048))
+
+class TextNormalizationPipeline:
+    """
+    The text path from raw segment to sentence list as named stages:
+    code_blocks -> line_breaks -> replacements -> whitespace -> split.
+
+    Every stage uses patterns compiled at import. Results are kept in an LRU
+    keyed by (text hash, replacement set id), and the time spent in each stage
+    is recorded in the metrics registry as normalize.<stage>_seconds.
+    """
+
+    def __init__(self, cache_size):
+        self.cache_size = cache_size
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.stages = [
+            ('code_blocks', lambda text, engine: filter_code_blocks(text)),
+            ('line_breaks', lambda text, engine: process_line_breaks(text)),
+            ('replacements', lambda text, engine: engine.apply(text) if engine else text),
+            ('whitespace', lambda text, engine: WHITESPACE_RE.sub(' ', text).strip()),
+        ]
+
+    @staticmethod
+    def replacement_engine(model_replacements):
+        # Model-specific replacements take priority over the global list
+        replacements = model_replacements or global_replacements
+        return get_replacement_engine(replacements) if replacements else None
+
+    def run(self, text, engine):
+        """Run all stages uncached; return (filtered_text, sentences, [(stage, seconds), ...])."""
+        timings = []
+        for name, stage in self.stages:
+            started = time.perf_counter()
+            text = stage(text, engine)
+            timings.append((name, time.perf_counter() - started))
+        started = time.perf_counter()
+        sentences = split_sentences(text) if text.strip() else []
+        timings.append(('split', time.perf_counter() - started))
+        return text, sentences, timings
+
+    def process(self, text, model_replacements):
+        """Return (filtered_text, sentences) for a raw segment, served from the cache when possible."""
+        engine = self.replacement_engine(model_replacements)
+        key = (hashlib.sha1(text.encode('utf-8')).hexdigest(), engine.set_id if engine else 0)
+        if self.cache_size:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None:
+                    self._cache.move_to_end(key)
+            if cached is not None:
+                metrics.increment('normalize.cache_hits')
+                return cached[0], list(cached[1])
+            metrics.increment('normalize.cache_misses')
+        if preprocess_pool is not None and len(text) >= PREPROCESS_MIN_CHARS:
+            filtered, sentences, timings = preprocess_pool.normalize(text, engine, model_replacements or global_replacements)
         else:
-             logging.error(f"Silence file {output_file} was not created or is empty.")
-             return None
-    except Exception as e:
-        logging.error(f"Error generating silence: {e}")
-        return None
+            filtered, sentences, timings = self.run(text, engine)
+        for name, seconds in timings:
+            metrics.observe(f'normalize.{name}_seconds', seconds)
+        if self.cache_size:
+            with self._lock:
+                self._cache[key] = (filtered, tuple(sentences))
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return filtered, sentences
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+text_pipeline = TextNormalizationPipeline(NORMALIZATION_CACHE_SIZE)
+
+def piper_command(model_path, settings, output_file):
+    """Command line for a one-shot piper process writing one WAV file."""
+    return [
+        piper_binary_path, '-m', model_path, '-f', output_file,
+        '--speaker', str(settings.get('speaker', 0)),
+        '--noise-scale', str(settings.get('noise_scale', 0.667)),
+        '--length-scale', str(settings.get('length_scale', 1.0)),
+        '--noise-w', str(settings.get('noise_w', 0.8)),
+    ]
+
+def run_piper_once(text_part, model_path, settings, output_file, timeout=60):
+    """Run a one-shot piper process for a single sentence. Returns (returncode, stderr)."""
+    command = piper_command(model_path, settings, output_file)
+    logging.debug(f"[PIPER] Command: {' '.join(command)}")
+    process = subprocess.Popen(
+        command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE, text=True, encoding='utf-8',
+    )
+    try:
+        # Send text_part as stdin to piper
+        with cancellable_process(process):
+            _, stderr = process.communicate(input=text_part + '\n', timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise
+    return process.returncode, stderr
+
+def run_piper_pooled(text_part, model_path, settings, output_file, timeout=60):
+    """Synthesize a sentence on a pooled piper worker. Returns (returncode, stderr)."""
+    worker = piper_pool.acquire(model_path, settings)
+    healthy = False
+    try:
+        with cancellable_process(worker.process):
+            worker.synthesize(text_part, output_file, settings.get('speaker', 0), timeout=timeout)
+        healthy = True
+        return 0, worker.stderr_tail()
+    finally:
+        # A worker that crashed or timed out is killed and replaced on the next acquire
+        piper_pool.release(worker, healthy)
 
 def generate_audio_for_sentence(text_part, model_path, settings, temp_dir, retry_attempts=3):
     if not text_part.strip():
@@ -634,31 +1570,20 @@ def generate_audio_for_sentence(text_part, model_path, settings, temp_dir, retry
     base_output_name = f"audio_{random_string(8)}"
     output_file = os.path.join(temp_dir, f"{base_output_name}.wav")
     
-    command = [
-        piper_binary_path, '-m', model_path, '-f', output_file,
-        '--speaker', str(settings.get('speaker', 0)),
-        '--noise-scale', str(settings.get('noise_scale', 0.667)),
-        '--length-scale', str(settings.get('length_scale', 1.0)),
-        '--noise-w', str(settings.get('noise_w', 0.8)),
-    ]
-    
-    # Add '--json-input' if your Piper version supports it for more robust input handling
-    # command.append('--json-input') 
-    
     for attempt in range(retry_attempts):
+        if job_cancelled():
+            logging.debug(f"[PIPER] Request cancelled, not synthesizing: '{text_part[:50]}...'")
+            return None
         try:
             logging.debug(f"[PIPER] Attempt {attempt+1}/{retry_attempts} to generate audio for: '{text_part[:50]}...'")
-            logging.debug(f"[PIPER] Command: {' '.join(command)}")
             logging.debug(f"[PIPER] Input text (final): '{text_part}'")
             
-            process = subprocess.Popen(
-                command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE, text=True, encoding='utf-8',
-            )
-            # Send text_part as stdin to piper
-            stdout, stderr = process.communicate(input=text_part + '\n', timeout=60) # Reduced timeout for individual sentences
+            if piper_pool is not None:
+                returncode, stderr = run_piper_pooled(text_part, model_path, settings, output_file)
+            else:
+                returncode, stderr = run_piper_once(text_part, model_path, settings, output_file)
             
-            if process.returncode == 0:
+            if returncode == 0:
                 if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
                     logging.debug(f"[PIPER] Successfully generated audio file: {output_file} ({os.path.getsize(output_file)} bytes)")
                     return output_file
@@ -666,69 +1591,1365 @@ def generate_audio_for_sentence(text_part, model_path, settings, temp_dir, retry
                     logging.warning(f"[PIPER] Process succeeded but file is missing/empty: {output_file}. Stderr: {stderr}")
                     if os.path.exists(output_file): os.remove(output_file) # Clean up empty file
             else:
-                logging.error(f"[PIPER] Process failed with return code {process.returncode} for text: '{text_part}'. Stderr: {stderr}")
+                logging.error(f"[PIPER] Process failed with return code {returncode} for text: '{text_part}'. Stderr: {stderr}")
                 if os.path.exists(output_file): os.remove(output_file) # Clean up failed file
         except subprocess.TimeoutExpired:
-            process.kill()
             logging.warning(f"Piper process timed out on attempt {attempt+1} for text: '{text_part[:50]}...'")
             if os.path.exists(output_file): os.remove(output_file) # Clean up timed out file
         except Exception as e:
             logging.error(f"Error during audio generation attempt {attempt+1} for text: '{text_part[:50]}...': {e}")
             if os.path.exists(output_file): os.remove(output_file) # Clean up on general error
         
-        if attempt < retry_attempts - 1:
+        if attempt < retry_attempts - 1 and not job_cancelled():
             time.sleep(0.5 * (attempt + 1)) # Exponential back-off for retries
             
     logging.error(f"Failed to generate audio for text after {retry_attempts} attempts: '{text_part[:50]}...'")
     return None
 
-def concatenate_audio_files(audio_files, output_file, temp_dir):
-    if not audio_files:
-        logging.warning("No audio files provided for concatenation.")
+# In-process ONNX synthesis engine
+PHONEME_PAD = '_'
+PHONEME_BOS = '^'
+PHONEME_EOS = '$'
+
+# Configs of models being warmed up by the model watcher, not yet in model_configs
+staged_model_configs = {}
+
+def get_model_config_by_path(model_path):
+    model_config = staged_model_configs.get(model_path)
+    if model_config is not None:
+        return model_config
+    for model_config in model_configs.values():
+        if model_config["model_path_onnx"] == model_path:
+            return model_config
+    return None
+
+_mmap_model_lock = threading.Lock()
+
+def mmap_model_path(model_path):
+    """
+    A copy of model_path with its weights in an external data file, made once per file version.
+
+    onnxruntime memory-maps external data and, with prepacking disabled, runs
+    straight from the mapped pages, so every process using the model shares one
+    copy of its weights through the page cache instead of holding its own.
+    """
+    stat = os.stat(model_path)
+    base = os.path.basename(model_path)[:-len('.onnx')]
+    version = f"{base}-{stat.st_mtime_ns}-{stat.st_size}"
+    target = os.path.join(ONNX_MMAP_DIR, f"{version}.onnx")
+    with _mmap_model_lock:
+        if os.path.exists(target):
+            return target
+        os.makedirs(ONNX_MMAP_DIR, exist_ok=True)
+        # Per-process names: the graph is renamed into place and a data file is never rewritten
+        unique = f"{version}.{os.getpid()}"
+        temp_path = os.path.join(ONNX_MMAP_DIR, f"{unique}.onnx.tmp")
+        model = onnx.load(model_path)
+        expose_frame_lengths(model)
+        onnx.save_model(model, temp_path, save_as_external_data=True,
+                        all_tensors_to_one_file=True, location=f"{unique}.data", size_threshold=1024)
+        os.replace(temp_path, target)
+        # Copies of older versions; unlinking is safe even while another process has them mapped
+        old_version = re.compile(re.escape(base) + r'-\d+-\d+\..+')
+        for filename in os.listdir(ONNX_MMAP_DIR):
+            if old_version.fullmatch(filename) and not filename.startswith(f"{version}."):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(ONNX_MMAP_DIR, filename))
+        logging.info(f"[ONNX] Wrote memory-mappable copy of {os.path.basename(model_path)}")
+        return target
+
+def expose_frame_lengths(model):
+    """
+    Add the per-item frame counts computed inside a piper (VITS) graph as a second output.
+
+    VITS rounds the predicted phoneme durations up (Ceil) and sums them into
+    the number of audio frames of each item; padded phonemes get a duration
+    of zero. Returns the name of that output, or None when the graph has no
+    such Ceil -> ReduceSum pair.
+    """
+    ceil_outputs = {node.output[0] for node in model.graph.node if node.op_type == 'Ceil'}
+    for node in model.graph.node:
+        if node.op_type == 'ReduceSum' and node.input and node.input[0] in ceil_outputs:
+            name = node.output[0]
+            if name not in {output.name for output in model.graph.output}:
+                model.graph.output.append(onnx.helper.make_tensor_value_info(name, onnx.TensorProto.FLOAT, None))
+            return name
+    return None
+
+class OnnxVoice:
+    """
+    A piper voice loaded once into an onnxruntime InferenceSession.
+
+    Batched inference needs each item's real output length to cut off the
+    audio decoded from padding; it is read from the graph's frame counts (see
+    expose_frame_lengths), which needs the optional onnx package. Without
+    them, batches are run one item at a time.
+    """
+
+    def __init__(self, model_path, model_config):
+        self.model_path = model_path
+        self.config = model_config["synthesis_config"]
+        self.sample_rate = model_config.get("sample_rate", 22050)
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = ONNX_INTRA_OP_THREADS
+        session_options.inter_op_num_threads = 1
+        session_path = model_path
+        if ONNX_MMAP_WEIGHTS and onnx is not None:
+            try:
+                session_path = mmap_model_path(model_path)
+                # Prepacking would copy the weights into private buffers again
+                session_options.add_session_config_entry('session.disable_prepacking', '1')
+            except Exception as e:
+                logging.warning(f"[ONNX] Could not memory-map {os.path.basename(model_path)}, loading it normally: {e}")
+        session_model = session_path
+        if session_path == model_path and onnx is not None:
+            try:
+                model = onnx.load(model_path)
+                if expose_frame_lengths(model):
+                    session_model = model.SerializeToString()
+            except Exception as e:
+                logging.warning(f"[ONNX] Could not read frame lengths from {os.path.basename(model_path)}: {e}")
+        self.session = onnxruntime.InferenceSession(
+            session_model, sess_options=session_options, providers=['CPUExecutionProvider']
+        )
+        outputs = self.session.get_outputs()
+        self.frame_lengths_output = outputs[1].name if len(outputs) > 1 else None
+
+    def phonemize(self, text):
+        if self.config["phoneme_type"] == 'text':
+            return piper_phonemize.phonemize_codepoints(text)
+        return piper_phonemize.phonemize_espeak(text, self.config["espeak_voice"])
+
+    def phonemes_to_ids(self, phonemes):
+        id_map = self.config["phoneme_id_map"]
+        ids = list(id_map[PHONEME_BOS])
+        for phoneme in phonemes:
+            if phoneme not in id_map:
+                continue
+            ids.extend(id_map[phoneme])
+            ids.extend(id_map[PHONEME_PAD])
+        ids.extend(id_map[PHONEME_EOS])
+        return ids
+
+    def synthesize_ids(self, phoneme_ids, settings):
+        return self.synthesize_ids_batch([phoneme_ids], settings)[0]
+
+    @property
+    def batchable(self):
+        return self.frame_lengths_output is not None
+
+    def synthesize_ids_batch(self, batch_ids, settings):
+        """Run one padded inference call for several phoneme id sequences."""
+        if len(batch_ids) > 1 and not self.batchable:
+            return [self.synthesize_ids(ids, settings) for ids in batch_ids]
+        pad_id = self.config["phoneme_id_map"][PHONEME_PAD][0]
+        lengths = [len(ids) for ids in batch_ids]
+        max_length = max(lengths)
+        padded = np.full((len(batch_ids), max_length), pad_id, dtype=np.int64)
+        for row, ids in enumerate(batch_ids):
+            padded[row, :len(ids)] = ids
+        inputs = {
+            'input': padded,
+            'input_lengths': np.array(lengths, dtype=np.int64),
+            'scales': np.array([
+                settings.get('noise_scale', 0.667),
+                settings.get('length_scale', 1.0),
+                settings.get('noise_w', 0.8),
+            ], dtype=np.float32),
+        }
+        if self.config["num_speakers"] > 1:
+            inputs['sid'] = np.full(len(batch_ids), settings.get('speaker', 0), dtype=np.int64)
+        outputs = self.session.run(None, inputs)
+        audio = outputs[0].reshape(len(batch_ids), -1)  # (batch, 1, samples)
+        if len(batch_ids) == 1:
+            return [audio_float_to_int16(audio[0])]
+        # Output is padded to the longest item: keep each item's own frames, at the
+        # samples per frame (hop size) of this run
+        if outputs[1].size != len(batch_ids):
+            logging.warning(f"[ONNX] {os.path.basename(self.model_path)} has no per-item frame counts; not batching it")
+            self.frame_lengths_output = None
+            return [self.synthesize_ids(ids, settings) for ids in batch_ids]
+        frames = np.maximum(outputs[1].reshape(len(batch_ids)), 1)
+        samples_per_frame = audio.shape[1] / float(frames.max())
+        return [audio_float_to_int16(audio[row, :int(round(frames[row] * samples_per_frame))])
+                for row in range(len(batch_ids))]
+
+    def synthesize(self, text, settings):
+        """Return int16 mono PCM for text as a NumPy array."""
+        chunks = [
+            self.synthesize_ids(self.phonemes_to_ids(phonemes), settings)
+            for phonemes in self.phonemize(text) if phonemes
+        ]
+        if not chunks:
+            return np.zeros(0, dtype=np.int16)
+        return np.concatenate(chunks)
+
+def plan_phoneme_batches(lengths):
+    """
+    Group item indices into batches by phoneme-length bucket.
+
+    Items are sorted by length and only batched with items of the same bucket, so
+    padding stays small; the batch size of each bucket is ONNX_BATCH_MAX_TOKENS
+    divided by the bucket's upper bound, capped at ONNX_BATCH_MAX_SIZE.
+    """
+    batches = []
+    current, current_bucket = [], None
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        bucket = next((upper for upper in ONNX_BATCH_BUCKETS if lengths[index] <= upper), None)
+        bucket_size = max(1, min(ONNX_BATCH_MAX_SIZE, ONNX_BATCH_MAX_TOKENS // bucket)) if bucket else 1
+        if current and (bucket != current_bucket or len(current) >= bucket_size):
+            batches.append(current)
+            current = []
+        current.append(index)
+        current_bucket = bucket
+    if current:
+        batches.append(current)
+    return batches
+
+def audio_float_to_int16(audio, max_wav_value=32767.0):
+    peak = float(np.max(np.abs(audio))) if audio.size else 0.0
+    audio = audio * (max_wav_value / max(0.01, peak))
+    return np.clip(audio, -max_wav_value, max_wav_value).astype(np.int16)
+
+class OnnxSynthesisEngine:
+    """Loads each model once and keeps its InferenceSession for the life of the process."""
+
+    def __init__(self):
+        self._voices = {}
+        self._lock = threading.Lock()
+
+    def get_voice(self, model_path):
+        voice = self._voices.get(model_path)
+        if voice is not None:
+            return voice
+        with self._lock:
+            voice = self._voices.get(model_path)
+            if voice is None:
+                model_config = get_model_config_by_path(model_path)
+                if model_config is None:
+                    raise ValueError(f"No model config loaded for {model_path}")
+                start = time.monotonic()
+                voice = OnnxVoice(model_path, model_config)
+                logging.info(f"[ONNX] Loaded {os.path.basename(model_path)} in {time.monotonic() - start:.2f}s")
+                self._voices[model_path] = voice
+        return voice
+
+    def unload(self, model_path=None):
+        with self._lock:
+            if model_path is None:
+                self._voices.clear()
+            else:
+                self._voices.pop(model_path, None)
+
+def generate_pcm_for_sentence(text_part, model_path, settings, temp_dir, retry_attempts=3):
+    """Same contract as generate_audio_for_sentence but returns int16 PCM instead of a WAV path."""
+    if not text_part.strip():
         return None
-    list_file = os.path.join(temp_dir, f'concat_list_{random_string(4)}.txt')
+    for attempt in range(retry_attempts):
+        try:
+            voice = onnx_engine.get_voice(model_path)
+            pcm = voice.synthesize(text_part, settings)
+            if pcm.size > 0:
+                logging.debug(f"[ONNX] Generated {pcm.size} samples for: '{text_part[:50]}...'")
+                return pcm
+            logging.warning(f"[ONNX] Empty audio for text: '{text_part[:50]}...'")
+            return None
+        except Exception as e:
+            logging.error(f"[ONNX] Error during audio generation attempt {attempt+1} for text: '{text_part[:50]}...': {e}")
+        if attempt < retry_attempts - 1:
+            time.sleep(0.5 * (attempt + 1))
+    logging.error(f"Failed to generate audio for text after {retry_attempts} attempts: '{text_part[:50]}...'")
+    return None
+
+def submit_sentence_batches(sentences, model_path, settings, temp_dir, submit):
+    """
+    Submit a group of sentences that share model and settings as padded batches.
+
+    Each sentence is phonemized here, the phoneme sequences are bucketed by length
+    with plan_phoneme_batches and every batch becomes a single job, queued with
+    submit(cost, fn, *args). Returns one future per sentence, resolved with its
+    int16 PCM (or None), in input order.
+    """
+    sentence_futures = [concurrent.futures.Future() for _ in sentences]
     try:
-        with open(list_file, 'w', encoding='utf-8') as f:
-            for file_item in audio_files:
-                # Ensure path is correctly formatted for ffmpeg, especially on Windows
-                abs_file_path = os.path.abspath(file_item).replace('\\', '/')
-                f.write(f"file '{abs_file_path}'\n")
-        
-        logging.debug(f"Concatenating {len(audio_files)} files to {output_file}")
-        subprocess.run(
-            [
-                ffmpeg_path, '-loglevel', 'error', '-f', 'concat',
-                '-safe', '0', '-i', list_file, '-c', 'copy', '-y', output_file
-            ],
-            check=True, capture_output=True, text=True
-        )
-        if os.path.exists(output_file) and os.path.getsize(output_file) > 0:
-            logging.debug(f"Concatenated audio files successfully to {output_file}")
-            return True
+        voice = onnx_engine.get_voice(model_path)
+        items = []  # (sentence index, phoneme ids)
+        for index, sentence in enumerate(sentences):
+            for phonemes in voice.phonemize(sentence):
+                if phonemes:
+                    items.append((index, voice.phonemes_to_ids(phonemes)))
+    except Exception as e:
+        logging.error(f"[ONNX] Batch preparation failed, synthesizing sentences one by one: {e}")
+        return [submit(len(sentence), generate_pcm_for_sentence, sentence, model_path, settings, temp_dir) for sentence in sentences]
+
+    sentence_items = collections.defaultdict(list)
+    for item_index, (sentence_index, _) in enumerate(items):
+        sentence_items[sentence_index].append(item_index)
+    pending_parts = {index: len(item_indices) for index, item_indices in sentence_items.items()}
+    parts = {}
+    lock = threading.Lock()
+
+    def finish_items(item_indices, results):
+        with lock:
+            for item_index, pcm in zip(item_indices, results):
+                sentence_index = items[item_index][0]
+                parts[item_index] = pcm
+                pending_parts[sentence_index] -= 1
+                if pending_parts[sentence_index] > 0:
+                    continue
+                chunks = [parts[i] for i in sentence_items[sentence_index]]
+                if any(chunk is None for chunk in chunks):
+                    sentence_futures[sentence_index].set_result(None)
+                else:
+                    sentence_futures[sentence_index].set_result(np.concatenate(chunks))
+
+    def run_batch(item_indices):
+        try:
+            results = voice.synthesize_ids_batch([items[i][1] for i in item_indices], settings)
+        except Exception as e:
+            logging.error(f"[ONNX] Batched inference of {len(item_indices)} items failed: {e}")
+            results = [None] * len(item_indices)
+        finish_items(item_indices, results)
+
+    if voice.batchable:
+        batches = plan_phoneme_batches([len(ids) for _, ids in items])
+    else:
+        batches = [[index] for index in range(len(items))]
+    logging.debug(f"[ONNX] {len(sentences)} sentences -> {len(items)} phoneme sequences in {len(batches)} batches")
+    # Largest batches first so the request's tail isn't a big batch started last
+    for batch in sorted(batches, key=lambda batch: sum(len(items[i][1]) for i in batch), reverse=True):
+        submit(sum(len(items[i][1]) for i in batch), run_batch, batch)
+    for index, future in enumerate(sentence_futures):
+        if index not in pending_parts:
+            future.set_result(None)  # Nothing to pronounce
+    return sentence_futures
+
+onnx_engine = None
+synthesize_sentence = generate_audio_for_sentence
+if TTS_ENGINE == 'onnx':
+    if onnxruntime is None or piper_phonemize is None:
+        logging.warning("TTS_ENGINE=onnx requires numpy, onnxruntime and piper-phonemize. Falling back to the piper binary.")
+    else:
+        logging.info(f"Using in-process ONNX Runtime synthesis engine ({ONNX_INTRA_OP_THREADS} threads per session).")
+        onnx_engine = OnnxSynthesisEngine()
+        synthesize_sentence = generate_pcm_for_sentence
+        if ONNX_MMAP_WEIGHTS and onnx is None:
+            logging.warning("ONNX_MMAP_WEIGHTS=1 requires the onnx package (pip install onnx); weights are loaded per process.")
+
+# In-memory PCM assembly (mono, 16-bit)
+DEFAULT_SAMPLE_RATE = 22050
+
+def read_wav_pcm(wav_source):
+    """Return (pcm_bytes, sample_rate) from WAV bytes or a WAV file path."""
+    source = io.BytesIO(wav_source) if isinstance(wav_source, (bytes, bytearray)) else wav_source
+    with wave.open(source, 'rb') as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise ValueError(f"Unsupported WAV sample width: {wav_file.getsampwidth() * 8} bits")
+        pcm = wav_file.readframes(wav_file.getnframes())
+        if wav_file.getnchannels() == 2:
+            pcm = downmix_stereo_pcm16(pcm)
+        elif wav_file.getnchannels() != 1:
+            raise ValueError(f"Unsupported WAV channel count: {wav_file.getnchannels()}")
+        return pcm, wav_file.getframerate()
+
+def downmix_stereo_pcm16(pcm):
+    if np is not None:
+        frames = np.frombuffer(pcm, dtype='<i2').reshape(-1, 2).astype(np.int32)
+        return (frames.sum(axis=1) // 2).astype('<i2').tobytes()
+    samples = array.array('h', pcm)
+    return array.array('h', ((samples[i] + samples[i + 1]) // 2 for i in range(0, len(samples) - 1, 2))).tobytes()
+
+def resample_pcm16(pcm, from_rate, to_rate):
+    """Linear-interpolation resampling, used when models with different sample rates are mixed."""
+    if from_rate == to_rate or not pcm:
+        return pcm
+    if np is not None:
+        samples = np.frombuffer(pcm, dtype='<i2').astype(np.float32)
+        output_length = int(round(len(samples) * to_rate / from_rate))
+        positions = np.arange(output_length) * (from_rate / to_rate)
+        return np.interp(positions, np.arange(len(samples)), samples).astype('<i2').tobytes()
+    samples = array.array('h', pcm)
+    output_length = int(round(len(samples) * to_rate / from_rate))
+    step = from_rate / to_rate
+    last = len(samples) - 1
+    resampled = array.array('h', bytes(output_length * 2))
+    for i in range(output_length):
+        position = i * step
+        left = min(int(position), last)
+        right = min(left + 1, last)
+        fraction = position - left
+        resampled[i] = int(samples[left] + (samples[right] - samples[left]) * fraction)
+    return resampled.tobytes()
+
+class PcmAssembler:
+    """
+    Joins sentence audio and silences into one PCM buffer without ffmpeg or temp files.
+
+    Chunks are kept as references until assemble() (or drain(), for incremental
+    consumers), which preallocates the output (silence is just the zero-filled gap)
+    and copies each chunk in through a memoryview. The output rate is the first
+    audio chunk's rate unless given; chunks at other rates are resampled.
+    """
+
+    def __init__(self, sample_rate=None):
+        self.sample_rate = sample_rate
+        self._parts = []  # (pcm_bytes, sample_rate) or (None, seconds of silence)
+        self._has_audio = False
+
+    def add_wav(self, wav_source):
+        pcm, sample_rate = read_wav_pcm(wav_source)
+        self.add_pcm(pcm, sample_rate)
+
+    def add_pcm(self, pcm, sample_rate):
+        if not pcm:
+            return
+        if self.sample_rate is None:
+            self.sample_rate = sample_rate
+        self._parts.append((pcm, sample_rate))
+        self._has_audio = True
+
+    def add_silence(self, seconds):
+        if seconds > 0:
+            self._parts.append((None, seconds))
+
+    def has_audio(self):
+        return self._has_audio
+
+    def drain(self):
+        """Return the PCM added since the last drain, once the output rate is known."""
+        if self.sample_rate is None:
+            return bytearray()  # Only leading silence so far
+        parts, self._parts = self._parts, []
+        return self._render(parts, self.sample_rate)
+
+    def assemble(self):
+        """Return (bytearray of int16 little-endian PCM, sample_rate)."""
+        sample_rate = self.sample_rate or DEFAULT_SAMPLE_RATE
+        parts, self._parts = self._parts, []
+        return self._render(parts, sample_rate), sample_rate
+
+    @staticmethod
+    def _render(parts, sample_rate):
+        rendered = []
+        total_bytes = 0
+        for pcm, value in parts:
+            if pcm is None:
+                size = int(round(value * sample_rate)) * 2
+            else:
+                if value != sample_rate:
+                    logging.debug(f"Resampling chunk from {value} Hz to {sample_rate} Hz")
+                    pcm = resample_pcm16(pcm, value, sample_rate)
+                size = len(pcm)
+            rendered.append((pcm, size))
+            total_bytes += size
+        output = bytearray(total_bytes)
+        view = memoryview(output)
+        offset = 0
+        for pcm, size in rendered:
+            if pcm is not None:
+                view[offset:offset + size] = pcm
+            offset += size
+        return output
+
+def write_wav(target, pcm, sample_rate):
+    """Write mono 16-bit PCM as WAV to a path or file object."""
+    with wave.open(target, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm)
+    return target
+
+def pcm_to_wav_bytes(pcm, sample_rate):
+    buffer = io.BytesIO()
+    write_wav(buffer, pcm, sample_rate)
+    return buffer.getvalue()
+
+# Preprocessing mode: 'thread' runs normalization and WAV decoding on the request thread,
+# 'process' hands them to a pool of forked worker processes so they do not hold the GIL
+PREPROCESS_MODE = os.environ.get('PREPROCESS_MODE', 'thread').lower()
+PREPROCESS_WORKERS = int(os.environ.get('PREPROCESS_WORKERS', min(4, os.cpu_count() or 1)))
+PREPROCESS_MIN_CHARS = int(os.environ.get('PREPROCESS_MIN_CHARS', 1000))  # Shorter segments stay in-thread
+
+_worker_engines = {}  # Replacement engines preloaded in each preprocessing worker, by parent set_id
+
+def _preprocess_worker_init(replacement_sets):
+    for set_id, replacements in replacement_sets.items():
+        _worker_engines[set_id] = get_replacement_engine(replacements)
+
+def _preprocess_worker_normalize(text, set_id, replacements):
+    engine = None
+    if set_id:
+        engine = _worker_engines.get(set_id)
+        if engine is None:
+            engine = _worker_engines[set_id] = get_replacement_engine(replacements)
+    return text_pipeline.run(text, engine)
+
+def _preprocess_worker_decode(wav_path, target_rate):
+    """Decode (and resample) a WAV file into a new shared memory block; return (name, size, rate)."""
+    pcm, sample_rate = read_wav_pcm(wav_path)
+    if target_rate and target_rate != sample_rate:
+        pcm, sample_rate = resample_pcm16(pcm, sample_rate, target_rate), target_rate
+    block = shared_memory.SharedMemory(create=True, size=max(1, len(pcm)))
+    block.buf[:len(pcm)] = pcm
+    block.close()  # The parent unlinks it after copying
+    return block.name, len(pcm), sample_rate
+
+class PreprocessPool:
+    """
+    Persistent worker processes for the CPU-bound parts of a conversion.
+
+    Workers are forked once, compile every known replacement set in their
+    initializer and then receive only a set id with each text. Decoded PCM
+    comes back through a shared memory block instead of being pickled
+    through the result pipe.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._preloaded = set()
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def known_replacement_sets():
+        sets = {}
+        for replacements in [global_replacements] + [config.get('replacements') for config in model_configs.values()]:
+            if replacements:
+                sets[get_replacement_engine(replacements).set_id] = replacements
+        return sets
+
+    def start(self):
+        replacement_sets = self.known_replacement_sets()
+        # Shared memory blocks are registered with the resource tracker; start it before
+        # forking so workers and the parent share one tracker
+        resource_tracker.ensure_running()
+        self._executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context('fork'),
+            initializer=_preprocess_worker_init, initargs=(replacement_sets,))
+        self._preloaded = set(replacement_sets)
+        # With fork every worker is started on the first submit
+        self._executor.submit(len, '').result()
+        logging.info(f"Preprocessing pool started: {self.workers} processes, {len(replacement_sets)} replacement sets preloaded")
+
+    def _restart(self, broken):
+        """Replace a broken executor, unless another thread already did."""
+        with self._lock:
+            if self._executor is not broken:
+                return
+            broken.shutdown(wait=False, cancel_futures=True)
+            metrics.increment('preprocess.pool_restarts')
+            logging.warning("[PREPROCESS] A worker process died; restarting the preprocessing pool")
+            self.start()
+
+    def _run(self, fallback, fn, *args):
+        """
+        fn(*args) in a worker process. A broken pool is recreated and the call
+        retried once; if that fails too, fallback() runs on the calling thread.
+        """
+        for attempt in range(2):
+            executor = self._executor
+            try:
+                return executor.submit(fn, *args).result()
+            except BrokenProcessPool:
+                try:
+                    self._restart(executor)
+                except Exception as e:
+                    logging.error(f"[PREPROCESS] Could not restart the preprocessing pool: {e}")
+                    break
+        metrics.increment('preprocess.fallbacks')
+        return fallback()
+
+    def normalize(self, text, engine, replacements):
+        set_id = engine.set_id if engine else 0
+        started = time.perf_counter()
+        result = self._run(lambda: text_pipeline.run(text, engine), _preprocess_worker_normalize, text, set_id,
+                           None if set_id in self._preloaded or not set_id else replacements)
+        metrics.observe('preprocess.normalize_round_trip_seconds', time.perf_counter() - started)
+        return result
+
+    def decode_wav(self, wav_path, target_rate=None):
+        """Return (pcm_bytes, sample_rate) for a WAV file, resampled to target_rate when given."""
+        started = time.perf_counter()
+        name, size, sample_rate = self._run(lambda: _preprocess_worker_decode(wav_path, target_rate),
+                                            _preprocess_worker_decode, wav_path, target_rate)
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            pcm = bytes(block.buf[:size])
+        finally:
+            block.close()
+            block.unlink()
+        metrics.observe('preprocess.decode_round_trip_seconds', time.perf_counter() - started)
+        return pcm, sample_rate
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+preprocess_pool = None
+
+def start_preprocess_pool():
+    """(Re)create the preprocessing pool when PREPROCESS_MODE=process; safe to call after a fork."""
+    global preprocess_pool
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown()
+        preprocess_pool = None
+    if PREPROCESS_MODE != 'process':
+        return None
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        logging.warning("PREPROCESS_MODE=process needs fork(); preprocessing stays in-thread")
+        return None
+    pool = PreprocessPool(max(1, PREPROCESS_WORKERS))
+    pool.start()
+    preprocess_pool = pool
+    return pool
+
+atexit.register(lambda: preprocess_pool and preprocess_pool.shutdown())
+
+# Output encoding: 'auto' uses lameenc for MP3 when installed, 'ffmpeg' always pipes through ffmpeg
+AUDIO_ENCODER = os.environ.get('AUDIO_ENCODER', 'auto').lower()
+OPUS_BITRATE = os.environ.get('OPUS_BITRATE', '48k')
+AUDIO_MIMETYPES = {'mp3': 'audio/mpeg', 'ogg': 'audio/ogg'}
+
+class StreamingAudioEncoder:
+    """
+    Incremental PCM -> MP3 or Opus/OGG encoder.
+
+    MP3 is encoded in-process with lameenc when available. Otherwise, and always
+    for Opus, one ffmpeg process per request reads s16le PCM from stdin and its
+    encoded output is drained by a reader thread, so write() returns as soon as
+    the chunk is handed over and encoding overlaps with synthesis of the next
+    sentences.
+    """
+
+    def __init__(self, sample_rate, audio_format='mp3', on_output=None):
+        if audio_format not in AUDIO_MIMETYPES:
+            raise ValueError(f"Unsupported audio format: {audio_format}")
+        self.sample_rate = sample_rate
+        self.audio_format = audio_format
+        self._output = queue.Queue()
+        # When set, encoded bytes are handed to on_output as soon as they exist instead of being queued
+        self._emit = on_output or self._output.put
+        self._lame = None
+        self._process = None
+        self._reader = None
+        if self.uses_lameenc(audio_format):
+            self._lame = self.new_lame_encoder(sample_rate)
+        else:
+            self._start_ffmpeg()
+
+    @staticmethod
+    def uses_lameenc(audio_format):
+        return audio_format == 'mp3' and lameenc is not None and AUDIO_ENCODER != 'ffmpeg'
+
+    @staticmethod
+    def new_lame_encoder(sample_rate):
+        encoder = lameenc.Encoder()
+        encoder.set_in_sample_rate(sample_rate)
+        encoder.set_channels(1)
+        encoder.set_quality(2)
+        encoder.set_vbr(4)  # vbr_default, the mode behind ffmpeg's -qscale:a
+        encoder.set_vbr_quality(2)
+        return encoder
+
+    @staticmethod
+    def ffmpeg_command(sample_rate, audio_format):
+        """ffmpeg reading s16le mono PCM on stdin and writing the encoded stream to stdout."""
+        if audio_format == 'mp3':
+            # -qscale:a 2 is a good balance for MP3 quality
+            codec_args = ['-codec:a', 'libmp3lame', '-qscale:a', '2', '-f', 'mp3']
         else:
-            logging.error(f"Concatenated output file {output_file} is missing or empty after FFmpeg. Stderr: {subprocess.run([ffmpeg_path, '-f', 'concat', '-safe', '0', '-i', list_file, '-c', 'copy', '-y', output_file], capture_output=True, text=True).stderr}")
+            codec_args = ['-codec:a', 'libopus', '-b:a', OPUS_BITRATE, '-f', 'ogg']
+        return [
+            ffmpeg_path, '-loglevel', 'error', '-f', 's16le', '-ar', str(sample_rate),
+            '-ac', '1', '-i', 'pipe:0',
+        ] + codec_args + ['-flush_packets', '1', 'pipe:1']
+
+    def _start_ffmpeg(self):
+        command = self.ffmpeg_command(self.sample_rate, self.audio_format)
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read_output, daemon=True)
+        self._reader.start()
+
+    def _read_output(self):
+        for chunk in iter(lambda: self._process.stdout.read1(65536), b''):
+            self._emit(chunk)
+
+    def write(self, pcm):
+        if not pcm:
+            return
+        if self._lame is not None:
+            encoded = self._lame.encode(bytes(pcm))
+            if encoded:
+                self._emit(bytes(encoded))
+            return
+        try:
+            self._process.stdin.write(pcm)
+            self._process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise RuntimeError(f"FFmpeg encoder stopped accepting audio: {e}. Stderr: {self._process.stderr.read().decode('utf-8', 'replace')}")
+
+    def read_available(self):
+        """Return the encoded bytes produced so far without blocking."""
+        chunks = []
+        while True:
+            try:
+                chunks.append(self._output.get_nowait())
+            except queue.Empty:
+                return b''.join(chunks)
+
+    def close(self):
+        """Flush the encoder and return the remaining encoded bytes."""
+        if self._lame is not None:
+            self._emit(bytes(self._lame.flush()))
+            self._lame = None
+            return self.read_available()
+        if self._process is None:
+            return b''
+        self._process.stdin.close()
+        self._reader.join()
+        stderr = self._process.stderr.read().decode('utf-8', 'replace')
+        returncode = self._process.wait()
+        self._process = None
+        if returncode != 0:
+            raise RuntimeError(f"FFmpeg encoding failed with code {returncode}: {stderr}")
+        return self.read_available()
+
+    def abort(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+        self._lame = None
+
+# Synthesized audio cache settings (0 MB disables a tier)
+SENTENCE_CACHE_MEMORY_MB = int(os.environ.get('SENTENCE_CACHE_MEMORY_MB', 64))
+SENTENCE_CACHE_DISK_MB = int(os.environ.get('SENTENCE_CACHE_DISK_MB', 512))
+SENTENCE_CACHE_TTL_SECONDS = int(os.environ.get('SENTENCE_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+# How often each process re-reads a disk tier that other worker processes also write to
+CACHE_DISK_RESCAN_SECONDS = float(os.environ.get('CACHE_DISK_RESCAN_SECONDS', 30))
+
+class SharedMarker:
+    """
+    A file that processes sharing a folder (the gunicorn workers) replace to
+    signal each other. bump() replaces it; changed() returns True once per
+    process after another process has bumped it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._seen = self._state()
+
+    def _state(self):
+        try:
+            stat = os.stat(self.path)
+            return stat.st_ino, stat.st_mtime_ns, stat.st_size
+        except OSError:
+            return None
+
+    def bump(self):
+        temp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(f"{os.getpid()} {time.time_ns()}")
+        os.replace(temp_path, self.path)
+        self._seen = self._state()
+
+    def changed(self):
+        state = self._state()
+        if state == self._seen:
             return False
-    except subprocess.CalledProcessError as e:
-        logging.error(f"FFmpeg concatenation failed with error: {e.stderr}")
+        self._seen = state
+        return True
+
+class TieredAudioCache:
+    """
+    Content-addressed byte cache with an in-memory LRU tier and an optional disk tier.
+
+    Both tiers are bounded in bytes and evict least-recently-used entries first;
+    entries older than ttl_seconds are treated as misses and removed on access.
+    Keys are hex digests, so they double as file names in the disk tier.
+
+    The disk tier is shared by every worker process: a key missing from this
+    process' index is looked up in the folder, the index is rebuilt from the
+    folder every CACHE_DISK_RESCAN_SECONDS (so max_disk_bytes bounds the
+    folder, not each worker's share), and clear() bumps a marker file that
+    makes every process drop its memory tier on its next access.
+    """
+
+    def __init__(self, name, max_memory_bytes, disk_dir=None, max_disk_bytes=0, ttl_seconds=0, file_suffix='.bin'):
+        self.name = name
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes if disk_dir else 0
+        self.disk_dir = disk_dir
+        self.ttl_seconds = ttl_seconds
+        self.file_suffix = file_suffix
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # key -> (data, stored_at)
+        self._memory_bytes = 0
+        self._disk = collections.OrderedDict()    # key -> (size, stored_at)
+        self._disk_bytes = 0
+        self._next_rescan = time.monotonic() + CACHE_DISK_RESCAN_SECONDS
+        self.counters = collections.Counter()
+        self._flush_marker = None
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._flush_marker = SharedMarker(os.path.join(disk_dir, '.flushed'))
+        if self.max_disk_bytes > 0:
+            self._load_disk_index()
+
+    @property
+    def enabled(self):
+        return self.max_memory_bytes > 0 or self.max_disk_bytes > 0
+
+    def _load_disk_index(self):
+        entries = []
+        for filename in os.listdir(self.disk_dir):
+            if filename.endswith(self.file_suffix):
+                try:
+                    stat = os.stat(os.path.join(self.disk_dir, filename))
+                except OSError:
+                    continue  # Removed by another process meanwhile
+                entries.append((stat.st_mtime, filename[:-len(self.file_suffix)], stat.st_size))
+        self._disk.clear()
+        self._disk_bytes = 0
+        for stored_at, key, size in sorted(entries):
+            self._disk[key] = (size, stored_at)
+            self._disk_bytes += size
+        self._evict_disk_locked()
+
+    def _sync_locked(self):
+        """Catch up with what other processes did to the shared disk tier."""
+        if self._flush_marker is not None and self._flush_marker.changed():
+            self._memory.clear()
+            self._memory_bytes = 0
+            self.counters['remote_flushes'] += 1
+            if self.max_disk_bytes > 0:
+                self._load_disk_index()
+                self._next_rescan = time.monotonic() + CACHE_DISK_RESCAN_SECONDS
+        elif self.max_disk_bytes > 0 and time.monotonic() >= self._next_rescan:
+            # Rebuilt in file age order, so LRU order between processes is approximate
+            self._load_disk_index()
+            self._next_rescan = time.monotonic() + CACHE_DISK_RESCAN_SECONDS
+
+    def _adopt_disk_locked(self, key):
+        """Index an entry another process wrote to the disk tier; returns its index entry or None."""
+        if self.max_disk_bytes <= 0:
+            return None
+        try:
+            stat = os.stat(self._disk_path(key))
+        except OSError:
+            return None
+        self._disk[key] = (stat.st_size, stat.st_mtime)
+        self._disk_bytes += stat.st_size
+        return self._disk[key]
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + self.file_suffix)
+
+    def _expired(self, stored_at):
+        return self.ttl_seconds > 0 and time.time() - stored_at > self.ttl_seconds
+
+    def get(self, key):
+        with self._lock:
+            self._sync_locked()
+            entry = self._memory.get(key)
+            if entry is not None:
+                if not self._expired(entry[1]):
+                    self._memory.move_to_end(key)
+                    self.counters['memory_hits'] += 1
+                    return entry[0]
+                self._drop_memory_locked(key)
+                self.counters['expired'] += 1
+            disk_entry = self._disk.get(key) or self._adopt_disk_locked(key)
+            if disk_entry is not None and self._expired(disk_entry[1]):
+                self._drop_disk_locked(key)
+                self.counters['expired'] += 1
+                disk_entry = None
+            if disk_entry is None:
+                self.counters['misses'] += 1
+                return None
+            self._disk.move_to_end(key)
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                data = f.read()
+        except OSError:
+            with self._lock:
+                self._drop_disk_locked(key)
+                self.counters['misses'] += 1
+            return None
+        with self._lock:
+            self.counters['disk_hits'] += 1
+            self._put_memory_locked(key, data, disk_entry[1])
+        return data
+
+    def put(self, key, data):
+        if not data:
+            return
+        stored_at = time.time()
+        with self._lock:
+            self._sync_locked()
+            self.counters['stores'] += 1
+            self._put_memory_locked(key, data, stored_at)
+            write_disk = 0 < len(data) <= self.max_disk_bytes and key not in self._disk
+        if write_disk:
+            path = self._disk_path(key)
+            tmp_path = f"{path}.{random_string(6)}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.error(f"[CACHE:{self.name}] Error writing {path}: {e}")
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                return
+            with self._lock:
+                if key not in self._disk:
+                    self._disk[key] = (len(data), stored_at)
+                    self._disk_bytes += len(data)
+                    self._evict_disk_locked()
+
+    def path_for(self, key):
+        """Return the disk path of a fresh entry, or None if it only lives in memory."""
+        with self._lock:
+            self._sync_locked()
+            entry = self._disk.get(key) or self._adopt_disk_locked(key)
+            if entry is None or self._expired(entry[1]):
+                return None
+            return self._disk_path(key)
+
+    def _put_memory_locked(self, key, data, stored_at):
+        if len(data) > self.max_memory_bytes:
+            return
+        if key in self._memory:
+            self._drop_memory_locked(key)
+        self._memory[key] = (data, stored_at)
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            oldest_key = next(iter(self._memory))
+            self._drop_memory_locked(oldest_key)
+            self.counters['memory_evictions'] += 1
+
+    def _drop_memory_locked(self, key):
+        data, _ = self._memory.pop(key)
+        self._memory_bytes -= len(data)
+
+    def _evict_disk_locked(self):
+        while self._disk_bytes > self.max_disk_bytes and self._disk:
+            oldest_key = next(iter(self._disk))
+            self._drop_disk_locked(oldest_key)
+            self.counters['disk_evictions'] += 1
+
+    def _drop_disk_locked(self, key):
+        size, _ = self._disk.pop(key)
+        self._disk_bytes -= size
+        try:
+            os.remove(self._disk_path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        """Empty both tiers in every worker process."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._disk.clear()
+            self._disk_bytes = 0
+            if self.disk_dir and os.path.isdir(self.disk_dir):
+                # Every file in the folder, including those other processes wrote
+                for filename in os.listdir(self.disk_dir):
+                    if filename.endswith(self.file_suffix):
+                        try:
+                            os.remove(os.path.join(self.disk_dir, filename))
+                        except OSError:
+                            pass
+            if self._flush_marker is not None:
+                try:
+                    self._flush_marker.bump()
+                except OSError as e:
+                    logging.error(f"[CACHE:{self.name}] Could not signal the flush to other workers: {e}")
+
+    def stats(self):
+        with self._lock:
+            self._sync_locked()
+            lookups = self.counters['memory_hits'] + self.counters['disk_hits'] + self.counters['misses']
+            return dict(self.counters,
+                        memory_entries=len(self._memory), memory_bytes=self._memory_bytes,
+                        disk_entries=len(self._disk), disk_bytes=self._disk_bytes,
+                        hit_ratio=round((lookups - self.counters['misses']) / lookups, 3) if lookups else 0.0)
+
+sentence_cache = TieredAudioCache(
+    'sentences',
+    SENTENCE_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_dir=os.path.join(temp_audio_folder, 'sentence_cache'),
+    max_disk_bytes=SENTENCE_CACHE_DISK_MB * 1024 * 1024,
+    ttl_seconds=SENTENCE_CACHE_TTL_SECONDS,
+    file_suffix='.wav',
+)
+
+# Whole-response cache: final MP3 of /convert keyed by (text, model, settings)
+RESPONSE_CACHE_MEMORY_MB = int(os.environ.get('RESPONSE_CACHE_MEMORY_MB', 64))
+RESPONSE_CACHE_DISK_MB = int(os.environ.get('RESPONSE_CACHE_DISK_MB', 1024))
+RESPONSE_CACHE_TTL_SECONDS = int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', 24 * 3600))
+
+response_cache = TieredAudioCache(
+    'responses',
+    RESPONSE_CACHE_MEMORY_MB * 1024 * 1024,
+    disk_dir=os.path.join(temp_audio_folder, 'response_cache'),
+    max_disk_bytes=RESPONSE_CACHE_DISK_MB * 1024 * 1024,
+    ttl_seconds=RESPONSE_CACHE_TTL_SECONDS,
+    file_suffix='.audio',
+)
+
+_model_sha256_cache = {}
+
+def get_model_sha256(model_config):
+    """sha256 from the modelcard, or of the .onnx file itself (computed once per file version)."""
+    if model_config.get("sha256"):
+        return model_config["sha256"].upper()
+    model_path = model_config["model_path_onnx"]
+    stat = os.stat(model_path)
+    cache_key = (model_path, stat.st_mtime, stat.st_size)
+    digest = _model_sha256_cache.get(cache_key)
+    if digest is None:
+        sha256_hash = hashlib.sha256()
+        with open(model_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256_hash.update(chunk)
+        digest = _model_sha256_cache[cache_key] = sha256_hash.hexdigest().upper()
+    return digest
+
+def sentence_cache_key(model_config, settings, sentence):
+    normalized_sentence = ' '.join(sentence.split())
+    key_parts = [
+        model_config["filename_key"],
+        get_model_sha256(model_config),
+        str(int(settings.get('speaker', 0))),
+        repr(float(settings.get('noise_scale', 0.667))),
+        repr(float(settings.get('length_scale', 1.0))),
+        repr(float(settings.get('noise_w', 0.8))),
+        normalized_sentence,
+    ]
+    return hashlib.sha256('\x1f'.join(key_parts).encode('utf-8')).hexdigest()
+
+def response_cache_key(text, model_name, settings, audio_format='mp3'):
+    """
+    Hash of the raw request text, the settings, the output format and every
+    model the text is spoken with: the requested one and those switched to
+    with <#model#> tags, each with its sha256.
+    """
+    resolved_model_name = model_id_to_filename_map.get(model_name, model_name)
+    used_models = {resolved_model_name: model_configs[resolved_model_name]}
+    for item in iter_conversion_segments(text, resolved_model_name):
+        if item[0] == 'text':
+            used_models.setdefault(item[1], item[2])
+    key_parts = []
+    for model_config in used_models.values():
+        key_parts += [model_config["filename_key"], get_model_sha256(model_config)]
+    key_parts += [
+        json.dumps(settings, sort_keys=True),
+        audio_format,
+        text,
+    ]
+    return hashlib.sha256('\x1f'.join(key_parts).encode('utf-8')).hexdigest()
+
+def flush_audio_caches(include_sentences=False):
+    response_cache.clear()
+    if include_sentences:
+        sentence_cache.clear()
+    logging.info(f"Flushed response cache{' and sentence cache' if include_sentences else ''}")
+
+def retire_model_path(model_path):
+    """Drop what this process has loaded from a model file: its piper workers and ONNX session."""
+    model_manager.discard(model_path)
+    if piper_pool is not None:
+        piper_pool.retire(model_path)
+    if onnx_engine is not None:
+        onnx_engine.unload(model_path)
+
+def reload_models():
+    """Rescan the models folder now in every worker and apply every change (see ModelWatcher)."""
+    return model_watcher.request_reload()
+
+def completed_future(result):
+    future = concurrent.futures.Future()
+    future.set_result(result)
+    return future
+
+# How often a waiting conversion checks whether it should be cancelled
+CANCEL_POLL_SECONDS = 0.5
+
+class ConversionCancelled(Exception):
+    pass
+
+def client_disconnected(environ):
+    """
+    Probe the client socket of a WSGI request without consuming data.
+
+    Werkzeug and gunicorn expose the connection as werkzeug.socket / gunicorn.socket;
+    a non-blocking MSG_PEEK read that returns b'' means the peer closed it.
+    """
+    sock = environ.get('werkzeug.socket') or environ.get('gunicorn.socket')
+    if sock is None:
         return False
-    except Exception as e:
-        logging.error(f"Error concatenating audios: {e}")
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+    except (BlockingIOError, InterruptedError, ValueError):
+        return False  # No data waiting (or a TLS socket that can't be peeked)
+    except OSError:
+        return True
+
+CONVERSION_TAG_RE = re.compile(r'(<#.*?#>)')
+SILENCE_TAG_RE = re.compile(r'<#(\d+\.?\d*)#>')
+MODEL_TAG_RE = re.compile(r'<#([\w-]+)#>')
+
+def iter_conversion_segments(text, model_name):
+    """
+    Walk a text with <#seconds#> silence and <#model#> voice-switch tags.
+
+    Yields ('silence', seconds) and ('text', model_name, model_config, segment)
+    in text order, starting with model_name (a loaded model key). Tags that
+    cannot be applied are logged and spoken as regular text.
+    """
+    default_model_name = model_name
+    for segment in CONVERSION_TAG_RE.split(text):
+        if not segment.strip():
+            continue
+        if segment.startswith('<#') and segment.endswith('#>'):
+            silence_match = SILENCE_TAG_RE.match(segment)
+            if silence_match:
+                try:
+                    seconds = float(silence_match.group(1))
+                    if seconds > 0:
+                        yield ('silence', seconds)
+                    continue
+                except ValueError:
+                    logging.warning(f"Invalid silence duration in tag: {segment}. Ignoring tag.")
+                    # Treat as regular text if tag is malformed
+            else:
+                model_match = MODEL_TAG_RE.match(segment)
+                if model_match:
+                    requested_model_key = model_match.group(1)
+                    if requested_model_key == 'default':
+                        model_name = default_model_name
+                        logging.debug(f"Switched to default model: {model_name}")
+                        continue
+                    # Try to resolve model key
+                    resolved_requested_key = model_id_to_filename_map.get(requested_model_key, requested_model_key)
+                    if resolved_requested_key in model_configs:
+                        potential_model_path = model_configs[resolved_requested_key].get("model_path_onnx")
+                        if potential_model_path and os.path.exists(potential_model_path):
+                            model_name = resolved_requested_key
+                            logging.debug(f"Switched model to: {model_name} (requested: {requested_model_key})")
+                            continue
+                        logging.warning(f"Requested model '{requested_model_key}' not found or ONNX file missing. Continuing with current model.")
+                    else:
+                        logging.warning(f"Requested model '{requested_model_key}' not found. Continuing with current model.")
+                else:
+                    logging.warning(f"Unrecognized custom tag: {segment}. Ignoring tag.")
+        yield ('text', model_name, model_configs[model_name], segment)
+
+def add_sentence_audio(assembler, sentence_audio, sample_rate, cache_key=None):
+    """
+    Append one synthesis result to a PcmAssembler and store it in the sentence cache.
+
+    Engines return a WAV path (piper), int16 PCM (onnx) or WAV bytes (cache hit).
+    Returns False when there was no audio.
+    """
+    if np is not None and isinstance(sentence_audio, np.ndarray):
+        pcm = sentence_audio.astype('<i2', copy=False).tobytes()
+        assembler.add_pcm(pcm, sample_rate)
+        if cache_key and pcm:
+            sentence_cache.put(cache_key, pcm_to_wav_bytes(pcm, sample_rate))
+        return bool(pcm)
+    if isinstance(sentence_audio, (bytes, bytearray)):
+        assembler.add_wav(sentence_audio)
+        return True
+    if not sentence_audio or not os.path.exists(sentence_audio) or os.path.getsize(sentence_audio) == 0:
         return False
-    finally:
-        if os.path.exists(list_file):
-            try: os.remove(list_file)
-            except Exception as e: logging.error(f"Error removing list file {list_file}: {e}")
+    if preprocess_pool is not None:
+        pcm, decoded_rate = preprocess_pool.decode_wav(sentence_audio, assembler.sample_rate)
+        assembler.add_pcm(pcm, decoded_rate)
+        if cache_key and pcm:
+            sentence_cache.put(cache_key, pcm_to_wav_bytes(pcm, decoded_rate))
+        return True
+    with open(sentence_audio, 'rb') as f:
+        wav_bytes = f.read()
+    assembler.add_wav(wav_bytes)
+    if cache_key:
+        sentence_cache.put(cache_key, wav_bytes)
+    return True
+
+# Sentence cache keys seen recently; a sentence seen again is synthesized on its own so it gets cached
+SENTENCE_SIGHTINGS_MAX = 10000
+_sentence_sightings = collections.OrderedDict()
+_sentence_sightings_lock = threading.Lock()
+
+def sentence_seen_before(cache_key):
+    """Record a sighting of an uncached sentence; True if it was already seen recently."""
+    with _sentence_sightings_lock:
+        if cache_key in _sentence_sightings:
+            _sentence_sightings.move_to_end(cache_key)
+            return True
+        _sentence_sightings[cache_key] = True
+        if len(_sentence_sightings) > SENTENCE_SIGHTINGS_MAX:
+            _sentence_sightings.popitem(last=False)
+        return False
+
+def plan_synthesis_units(sentences, model_config, settings):
+    """
+    Turn sentences into synthesis units; returns (units, cache_keys, cached_audio).
+
+    Every sentence is looked up in the sentence cache first and only runs of
+    uncached sentences are packed (see pack_sentences), so packing never hides
+    a cached sentence. A repeated sentence that is not cached yet (e.g. it was
+    packed with its neighbours last time) becomes a unit of its own, so it is
+    cached from now on. Packed units are looked up as well; cached_audio holds
+    the cached WAV of a unit or None.
+    """
+    if not sentence_cache.enabled:
+        units = pack_sentences(sentences)
+        return units, [None] * len(units), [None] * len(units)
+    units, cache_keys, cached_audio = [], [], []
+    run = []  # Consecutive uncached sentences
+
+    def pack_run():
+        for unit in pack_sentences(run):
+            cache_key = sentence_cache_key(model_config, settings, unit)
+            units.append(unit)
+            cache_keys.append(cache_key)
+            # A unit that is one of the run's sentences has just missed
+            cached_audio.append(None if unit in run else sentence_cache.get(cache_key))
+        run.clear()
+
+    for sentence in sentences:
+        cache_key = sentence_cache_key(model_config, settings, sentence)
+        cached_wav = sentence_cache.get(cache_key)
+        if cached_wav or sentence_seen_before(cache_key):
+            pack_run()
+            units.append(sentence)
+            cache_keys.append(cache_key)
+            cached_audio.append(cached_wav)
+        else:
+            run.append(sentence)
+    pack_run()
+    return units, cache_keys, cached_audio
+
+def plan_conversion(text, resolved_model_name, settings, temp_dir, submit, acquired_models):
+    """
+    Normalize text, serve cached sentences and submit the rest for synthesis.
+
+    Returns (ordered_tasks, synthesis_started): ordered_tasks lists, in text
+    order, {'type': 'silence', 'duration': ...} gaps and {'type': 'audio',
+    'future': ...} sentences. Jobs are queued with submit(cost, fn, *args);
+    models used are acquired through model_manager and recorded in
+    acquired_models (model_path -> config), which the caller releases.
+    """
+    ordered_tasks = [] # Store futures and paths in order of processing
+    synthesis_started = None
+
+    for item in iter_conversion_segments(text, resolved_model_name):
+        if item[0] == 'silence':
+            # Silence is a zero-filled gap added at assembly time
+            ordered_tasks.append({'type': 'silence', 'duration': item[1]})
+            continue
+        _, current_model_name, current_model_config, segment = item
+        current_model_path = current_model_config["model_path_onnx"]
+        current_replacements = current_model_config.get("replacements", [])
+
+        # Process segment as regular text
+        logging.debug(f"[TTS] Processing text segment with model '{current_model_name}': '{segment[:100]}{'...' if len(segment) > 100 else ''}'")
+        
+        filtered_segment, sentences = text_pipeline.process(segment, current_replacements)
+        if not filtered_segment.strip():
+            logging.debug(f"[TTS] Segment became empty after filtering, skipping")
+            continue
+        
+        logging.info(f"[TTS] Text ready for synthesis: '{filtered_segment}'")
+        
+        # Serve repeated sentences from the audio cache before submitting anything
+        sentences, cache_keys, cached_audio = plan_synthesis_units(
+            [sentence.strip() for sentence in sentences if sentence.strip()], current_model_config, settings)
+        logging.debug(f"[TTS] Split into {len(sentences)} synthesis jobs")
+        futures = [completed_future(cached_wav) if cached_wav else None for cached_wav in cached_audio]
+        pending = [j for j, future in enumerate(futures) if future is None]
+        if len(pending) < len(sentences):
+            logging.debug(f"[CACHE] {len(sentences) - len(pending)}/{len(sentences)} sentences served from cache")
+        
+        pending_sentences = [sentences[j] for j in pending]
+        if pending_sentences and current_model_path not in acquired_models:
+            # Loads the model on first use (or after eviction) and keeps it resident for this conversion
+            acquired_models[current_model_path] = current_model_config
+            model_manager.acquire(current_model_config)
+        if synthesis_started is None and pending_sentences:
+            synthesis_started = time.monotonic()
+        if onnx_engine is not None and ONNX_BATCH_MAX_SIZE > 1 and len(pending_sentences) > 1:
+            submitted = submit_sentence_batches(pending_sentences, current_model_path, settings, temp_dir, submit)
+            for j, future in zip(pending, submitted):
+                futures[j] = future
+        else:
+            # Longest first, so the biggest job never starts last and sets the request's latency
+            for j in sorted(pending, key=lambda j: len(sentences[j]), reverse=True):
+                futures[j] = submit(len(sentences[j]), synthesize_sentence, sentences[j], current_model_path, settings, temp_dir)
+        
+        for j, (sentence, future) in enumerate(zip(sentences, futures)):
+            logging.debug(f"[TTS] Sentence {j+1}/{len(sentences)}: '{sentence[:100]}{'...' if len(sentence) > 100 else ''}'")
+            ordered_tasks.append({'type': 'audio', 'future': future, 'sentence': sentence,
+                                  'sample_rate': current_model_config.get('sample_rate', 22050),
+                                  'cache_key': cache_keys[j] if j in pending else None})
+    return ordered_tasks, synthesis_started
+
+def convert_text_to_speech_concurrent(text, default_model_name, settings, audio_format='mp3', on_audio_chunk=None, on_progress=None, client_class='anonymous', should_cancel=None):
+    """
+    Synthesize text and return (encoded_audio_bytes, error_message).
+
+    Sentence audio is encoded in order as soon as each sentence is ready; when
+    on_audio_chunk is given it receives every encoded chunk as it is produced.
+    on_progress is called with (sentences_done, sentences_total). Synthesis jobs
+    are queued on the fair scheduler under client_class. should_cancel is polled
+    while waiting; once it returns True queued jobs are dropped, running piper
+    and ffmpeg processes are killed and temporary files removed.
+    """
+    scheduled = scheduler.open_request(client_class)
+    submit = lambda cost, fn, *args: scheduler.submit(scheduled, cost, fn, *args)
+
+    def wait_result(future):
+        if should_cancel is None:
+            return future.result()
+        while True:
+            if should_cancel():
+                raise ConversionCancelled()
+            try:
+                return future.result(timeout=CANCEL_POLL_SECONDS)
+            except concurrent.futures.TimeoutError:
+                continue
 
-def convert_text_to_speech_concurrent(text, default_model_name, settings):
     temp_dir = None
     all_temp_files = [] # Keep track of all generated temp files for cleanup
-    final_output_mp3 = None
+    final_audio = None
     error_message = None
+    encoder = None
+    encoded_chunks = []
+    acquired_models = {}  # model_path -> config held through model_manager until the end
+
+    def encode_pcm(pcm):
+        nonlocal encoder
+        if not pcm:
+            return
+        if encoder is None:
+            encoder = StreamingAudioEncoder(assembler.sample_rate, audio_format, on_output=emit_encoded)
+        encoder.write(pcm)
+
+    def emit_encoded(data):
+        # Called from the encoder (or its ffmpeg reader thread) in output order
+        if data:
+            encoded_chunks.append(data)
+            if on_audio_chunk is not None:
+                on_audio_chunk(data)
 
     try:
         temp_dir = tempfile.mkdtemp(dir=temp_audio_folder)
         logging.info(f"Created temporary directory: {temp_dir}")
-        audio_segments_to_concat = []
 
         # Resolve model name to actual key if needed
         resolved_model_name = model_id_to_filename_map.get(default_model_name, default_model_name)
@@ -738,148 +2959,68 @@ def convert_text_to_speech_concurrent(text, default_model_name, settings):
              logging.error(error_message)
              return None, error_message
 
-        current_model_name = resolved_model_name
-        current_model_config = model_configs[current_model_name]
-        current_model_path = current_model_config["model_path_onnx"]
-        current_replacements = current_model_config.get("replacements", [])
-        
-        # Split text by custom tags for model switching or silence
-        segments = re.split(r'(<#.*?#>)', text)
-        ordered_tasks = [] # Store futures and paths in order of processing
-
-        for i, segment in enumerate(segments):
-            if not segment.strip():
-                continue
-            
-            processed_as_tag = False
-            if segment.startswith('<#') and segment.endswith('#>'):
-                silence_match = re.match(r'<#(\d+\.?\d*)#>', segment)
-                if silence_match:
-                    try:
-                        seconds = float(silence_match.group(1))
-                        # Generate silence directly, not via executor
-                        silence_file = generate_silence(seconds, temp_dir)
-                        if silence_file:
-                            ordered_tasks.append({'type': 'silence', 'file': silence_file, 'duration': seconds})
-                            all_temp_files.append(silence_file)
-                        processed_as_tag = True
-                    except ValueError:
-                        logging.warning(f"Invalid silence duration in tag: {segment}. Ignoring tag.")
-                        # Treat as regular text if tag is malformed
-                else:
-                    model_match = re.match(r'<#([\w-]+)#>', segment)
-                    if model_match:
-                        requested_model_key = model_match.group(1)
-                        if requested_model_key == 'default':
-                            current_model_name = default_model_name
-                            current_model_config = model_configs[current_model_name]
-                            current_model_path = current_model_config["model_path_onnx"]
-                            current_replacements = current_model_config.get("replacements", [])
-                            logging.debug(f"Switched to default model: {current_model_name}")
-                            processed_as_tag = True
-                        else:
-                            # Try to resolve model key
-                            resolved_requested_key = model_id_to_filename_map.get(requested_model_key, requested_model_key)
-                            if resolved_requested_key in model_configs:
-                                potential_model_config = model_configs[resolved_requested_key]
-                                potential_model_path = potential_model_config.get("model_path_onnx")
-                                if potential_model_path and os.path.exists(potential_model_path):
-                                    current_model_name = resolved_requested_key
-                                    current_model_config = potential_model_config
-                                    current_model_path = potential_model_path
-                                    current_replacements = current_model_config.get("replacements", [])
-                                    logging.debug(f"Switched model to: {current_model_name} (requested: {requested_model_key})")
-                                    processed_as_tag = True
-                                else:
-                                    logging.warning(f"Requested model '{requested_model_key}' not found or ONNX file missing. Continuing with current model.")
-                            else:
-                                logging.warning(f"Requested model '{requested_model_key}' not found. Continuing with current model.")
-                    else:
-                        logging.warning(f"Unrecognized custom tag: {segment}. Ignoring tag.")
-            
-            if processed_as_tag:
-                continue
-
-            # Process segment as regular text
-            logging.debug(f"[TTS] Processing text segment with model '{current_model_name}': '{segment[:100]}{'...' if len(segment) > 100 else ''}'")
-            
-            filtered_segment = filter_text_segment(segment, current_replacements)
-            if not filtered_segment.strip():
-                logging.debug(f"[TTS] Segment became empty after filtering, skipping")
-                continue
-            
-            logging.info(f"[TTS] Text ready for synthesis: '{filtered_segment}'")
-            
-            sentences = split_sentences(filtered_segment)
-            logging.debug(f"[TTS] Split into {len(sentences)} sentences")
-            
-            for j, sentence in enumerate(sentences):
-                 if sentence.strip():
-                    logging.debug(f"[TTS] Sentence {j+1}/{len(sentences)}: '{sentence[:100]}{'...' if len(sentence) > 100 else ''}'")
-                    future = executor.submit(generate_audio_for_sentence, sentence.strip(), current_model_path, settings, temp_dir)
-                    ordered_tasks.append({'type': 'audio', 'future': future, 'sentence': sentence.strip()})
+        ordered_tasks, synthesis_started = plan_conversion(
+            text, resolved_model_name, settings, temp_dir, submit, acquired_models)
 
-        # Collect results in order
+        # Collect results in order and feed them to the encoder as they complete
+        assembler = PcmAssembler()
+        sentences_total = sum(1 for task in ordered_tasks if task['type'] == 'audio')
+        sentences_done = 0
+        if on_progress is not None:
+            on_progress(sentences_done, sentences_total)
         for task in ordered_tasks:
             if task['type'] == 'silence':
-                if task['file'] and os.path.exists(task['file']) and os.path.getsize(task['file']) > 0:
-                    audio_segments_to_concat.append(task['file'])
-                else:
-                    logging.warning(f"Skipping empty or missing silence file: {task['file']}")
+                assembler.add_silence(task['duration'])
+                continue
             elif task['type'] == 'audio':
                 try:
-                    sentence_audio_file = task['future'].result()
-                    if sentence_audio_file and os.path.exists(sentence_audio_file) and os.path.getsize(sentence_audio_file) > 0:
-                        audio_segments_to_concat.append(sentence_audio_file)
-                        all_temp_files.append(sentence_audio_file)
-                    else:
+                    sentence_audio = wait_result(task['future'])
+                    if isinstance(sentence_audio, str):
+                        all_temp_files.append(sentence_audio)
+                    if not add_sentence_audio(assembler, sentence_audio, task['sample_rate'], task['cache_key']):
                         logging.warning(f"Skipping empty or missing audio file for sentence: '{task['sentence'][:50]}...'")
+                except ConversionCancelled:
+                    raise
                 except Exception as exc:
                     logging.error(f"Exception retrieving audio generation result for sentence '{task['sentence'][:50]}...': {exc}")
+                sentences_done += 1
+                if on_progress is not None:
+                    on_progress(sentences_done, sentences_total)
+            encode_pcm(assembler.drain())
+        if synthesis_started is not None:
+            # Tail latency of the request: first submission until its last sentence is in
+            metrics.observe('convert.synthesis_seconds', time.monotonic() - synthesis_started)
 
-        if not audio_segments_to_concat:
+        if not assembler.has_audio():
              error_message = "No audio segments were successfully generated or collected for concatenation."
              logging.warning(error_message)
              return None, error_message
 
-        final_output_wav = os.path.join(temp_dir, f"final_output_{random_string(8)}.wav")
-        if not concatenate_audio_files(audio_segments_to_concat, final_output_wav, temp_dir):
-            error_message = "Failed to concatenate audio files into a final WAV."
-            return None, error_message
-        
-        all_temp_files.append(final_output_wav) # Add the concatenated WAV for cleanup later
-
-        compressed_output_mp3 = os.path.join(temp_audio_folder, f"converted_{random_string(8)}.mp3")
         try:
-            # -qscale:a 2 is a good balance for MP3 quality
-            subprocess.run(
-                [
-                    ffmpeg_path, '-loglevel', 'error', '-i', final_output_wav,
-                    '-codec:a', 'libmp3lame', '-qscale:a', '2', '-y', compressed_output_mp3
-                ],
-                check=True, capture_output=True, text=True
-            )
-            if os.path.exists(compressed_output_mp3) and os.path.getsize(compressed_output_mp3) > 0:
-                logging.info(f"Compressed final audio to: {compressed_output_mp3}")
-                final_output_mp3 = compressed_output_mp3
-            else:
-                error_message = f"Final MP3 is missing or empty after compression. Stderr: {subprocess.run([ffmpeg_path, '-i', final_output_wav, '-codec:a', 'libmp3lame', '-qscale:a', '2', '-y', compressed_output_mp3], capture_output=True, text=True).stderr}"
-                logging.error(error_message)
-                final_output_mp3 = None
-        except subprocess.CalledProcessError as e:
-            error_message = f"FFmpeg compression failed with error: {e.stderr}"
-            logging.error(error_message)
-            final_output_mp3 = None
+            encode_pcm(assembler.drain())  # Trailing silence
+            encoder.close()
+            final_audio = b''.join(encoded_chunks)
+            logging.info(f"Encoded final audio: {len(final_audio)} bytes of {audio_format}")
         except Exception as e:
             error_message = f"Error compressing audio: {e}"
             logging.error(error_message)
-            final_output_mp3 = None
+            final_audio = None
 
+    except ConversionCancelled:
+        error_message = "Conversión cancelada"
+        logging.info("[TTS] Conversion cancelled by the client")
+        scheduler.cancel_request(scheduled)
+        final_audio = None
     except Exception as e:
         error_message = f"Unexpected error in conversion process: {e}"
         logging.error(error_message, exc_info=True)
-        final_output_mp3 = None
+        final_audio = None
     finally:
+        scheduler.close_request(scheduled)
+        if encoder is not None:
+            encoder.abort()
+        for model_config in acquired_models.values():
+            model_manager.release(model_config)
         # Clean up all temporary files generated during this conversion
         for file_path in all_temp_files:
             if os.path.exists(file_path):
@@ -896,7 +3037,650 @@ def convert_text_to_speech_concurrent(text, default_model_name, settings):
             except Exception as e: 
                 logging.error(f"Error removing temporary directory {temp_dir}: {e}")
 
-    return final_output_mp3, error_message
+    return final_audio, error_message
+
+# Background jobs for long texts
+ASYNC_TEXT_THRESHOLD = int(os.environ.get('ASYNC_TEXT_THRESHOLD', 1500))  # Characters; 0 disables background jobs
+TASK_MAX_CONCURRENT = int(os.environ.get('TASK_MAX_CONCURRENT', 2))
+TASK_MAX_QUEUED = int(os.environ.get('TASK_MAX_QUEUED', 20))
+TASK_RESULT_TTL_SECONDS = int(os.environ.get('TASK_RESULT_TTL_SECONDS', 600))
+TASK_MAX_STORED = int(os.environ.get('TASK_MAX_STORED', 100))
+# Task state (SQLite) and finished audio, shared by every worker process on the host
+TASK_STORE_DIR = os.environ.get('TASK_STORE_DIR', os.path.join(temp_audio_folder, 'tasks'))
+TASK_CLAIM_POLL_SECONDS = 0.5
+TASK_PURGE_INTERVAL_SECONDS = 5
+
+class TaskQueueFull(Exception):
+    pass
+
+def process_owner(pid=None):
+    """'pid:start time' of a process; the start time tells a reused pid apart (Linux only)."""
+    pid = os.getpid() if pid is None else pid
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            return f"{pid}:{f.read().rsplit(')', 1)[1].split()[19]}"
+    except (OSError, IndexError):
+        return f"{pid}:"
+
+def process_owner_alive(owner):
+    pid, _, started = owner.partition(':')
+    if started:
+        return process_owner(int(pid)) == owner
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class TaskManager:
+    """
+    Runs conversions in the background and keeps their results for polling.
+
+    Task state lives in a SQLite file and finished audio in files next to it,
+    under store_dir, so any worker process can report on, serve or cancel a
+    task that another one runs; the worker running it polls for the cancel.
+    The limits are shared the same way: at most max_concurrent tasks
+    synthesize at once across all workers and at most max_queued wait behind
+    them; submit() raises TaskQueueFull beyond that, so a burst of long texts
+    cannot fan out into an unbounded number of piper processes. Finished
+    tasks are kept for ttl_seconds, and only the newest max_stored are
+    retained. Unfinished tasks of a worker process that died are failed.
+    """
+
+    def __init__(self, store_dir, max_concurrent, max_queued, ttl_seconds, max_stored):
+        self.store_dir = store_dir
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.ttl_seconds = ttl_seconds
+        self.max_stored = max_stored
+        self._local = threading.local()
+        self._next_purge = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent, thread_name_prefix='tts-task')
+        os.makedirs(store_dir, exist_ok=True)
+        self._connect().execute(
+            'CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, status TEXT, sentences_done INTEGER, '
+            'sentences_total INTEGER, audio_format TEXT, cache_key TEXT, error TEXT, created REAL, finished REAL, '
+            'cancel_requested INTEGER DEFAULT 0, owner TEXT)')
+
+    def _connect(self):
+        # sqlite3 connections must stay on the thread (and process) that opened them
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(os.path.join(self.store_dir, 'tasks.sqlite3'), timeout=5, isolation_level=None)
+            connection.row_factory = sqlite3.Row
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _owner(self):
+        if getattr(self._local, 'owner_pid', None) != os.getpid():
+            self._local.owner, self._local.owner_pid = process_owner(), os.getpid()
+        return self._local.owner
+
+    def _audio_path(self, task_id, audio_format):
+        return os.path.join(self.store_dir, f'{task_id}.{audio_format}')
+
+    def submit(self, params):
+        self._purge(force=True)
+        task_id = secrets.token_urlsafe(16)
+        with self._transaction() as connection:
+            (waiting,) = connection.execute("SELECT COUNT(*) FROM tasks WHERE status = 'queued'").fetchone()
+            if waiting >= self.max_queued:
+                raise TaskQueueFull()
+            connection.execute(
+                "INSERT INTO tasks (id, status, sentences_done, sentences_total, audio_format, cache_key, created, owner) "
+                "VALUES (?, 'queued', 0, 0, ?, ?, ?, ?)",
+                (task_id, params['audio_format'], params['cache_key'], time.time(), self._owner()))
+        self._executor.submit(self._run, task_id, params)
+        metrics.increment('tasks.submitted')
+        return task_id
+
+    def _claim(self, task_id):
+        """Wait for a free slot and mark the task processing; False if it was cancelled first."""
+        while True:
+            with self._transaction() as connection:
+                row = connection.execute('SELECT status, created FROM tasks WHERE id = ?', (task_id,)).fetchone()
+                if row is None or row['status'] != 'queued':
+                    return False
+                (running,) = connection.execute("SELECT COUNT(*) FROM tasks WHERE status = 'processing'").fetchone()
+                if running < self.max_concurrent:
+                    connection.execute("UPDATE tasks SET status = 'processing' WHERE id = ?", (task_id,))
+                    metrics.observe('tasks.queue_wait_seconds', time.time() - row['created'])
+                    return True
+            time.sleep(TASK_CLAIM_POLL_SECONDS)
+            self._purge()
+
+    def _cancel_requested(self, task_id):
+        row = self._connect().execute('SELECT cancel_requested FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        return row is None or bool(row['cancel_requested'])
+
+    def _run(self, task_id, params):
+        if not self._claim(task_id):
+            return
+
+        def update_progress(done, total):
+            self._connect().execute('UPDATE tasks SET sentences_done = ?, sentences_total = ? WHERE id = ?',
+                                    (done, total, task_id))
+
+        try:
+            audio_data, error_message = convert_text_to_speech_concurrent(
+                params['text'], params['model_name'], params['settings'], params['audio_format'],
+                on_progress=update_progress, client_class=params['client_class'],
+                should_cancel=lambda: self._cancel_requested(task_id))
+        except Exception as e:
+            logging.error(f"Background task {task_id} failed: {e}", exc_info=True)
+            audio_data, error_message = None, str(e)
+        if audio_data and response_cache.enabled:
+            response_cache.put(params['cache_key'], audio_data)
+        if audio_data and not self._cancel_requested(task_id):
+            audio_path = self._audio_path(task_id, params['audio_format'])
+            temp_path = f'{audio_path}.{os.getpid()}.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(audio_data)
+            os.replace(temp_path, audio_path)
+        with self._transaction() as connection:
+            row = connection.execute('SELECT cancel_requested FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            if row is None:
+                return  # Purged while running
+            if row['cancel_requested']:
+                status, error = 'cancelled', None
+            elif audio_data:
+                status, error = 'completed', None
+            else:
+                status, error = 'error', error_message or 'Error al convertir texto a voz'
+            connection.execute('UPDATE tasks SET status = ?, error = ?, finished = ? WHERE id = ?',
+                               (status, error, time.time(), task_id))
+        metrics.increment(f"tasks.{status}")
+
+    def get(self, task_id):
+        """Return the task as a dict, or None when it is unknown or expired."""
+        self._purge()
+        row = self._connect().execute('SELECT * FROM tasks WHERE id = ?', (task_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def audio(self, task):
+        """The audio of a completed task, or None once it is gone."""
+        try:
+            with open(self._audio_path(task['id'], task['audio_format']), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def cancel(self, task_id):
+        """Cancel a queued or running task. Returns False if it is unknown or already finished."""
+        with self._transaction() as connection:
+            row = connection.execute('SELECT status, finished FROM tasks WHERE id = ?', (task_id,)).fetchone()
+            if row is None or row['finished'] is not None:
+                return False
+            if row['status'] == 'queued':
+                # Never started: finish it now, _claim will skip it
+                connection.execute("UPDATE tasks SET status = 'cancelled', cancel_requested = 1, finished = ? WHERE id = ?",
+                                   (time.time(), task_id))
+            else:
+                connection.execute('UPDATE tasks SET cancel_requested = 1 WHERE id = ?', (task_id,))
+        metrics.increment('tasks.cancelled_by_client')
+        return True
+
+    def _purge(self, force=False):
+        now = time.time()
+        if not force and now < self._next_purge:
+            return
+        self._next_purge = now + TASK_PURGE_INTERVAL_SECONDS
+        with self._transaction() as connection:
+            owners = [row['owner'] for row in connection.execute('SELECT DISTINCT owner FROM tasks WHERE finished IS NULL')]
+            for owner in owners:
+                if not process_owner_alive(owner):
+                    connection.execute("UPDATE tasks SET status = 'error', error = 'Tarea interrumpida', finished = ? "
+                                       "WHERE owner = ? AND finished IS NULL", (now, owner))
+            expired = connection.execute('SELECT id, audio_format FROM tasks WHERE finished < ?',
+                                         (now - self.ttl_seconds,)).fetchall()
+            # Oldest finished results go first when the store is full
+            (stored,) = connection.execute('SELECT COUNT(*) FROM tasks').fetchone()
+            overflow = max(0, stored - len(expired) - self.max_stored)
+            expired += connection.execute('SELECT id, audio_format FROM tasks WHERE finished >= ? ORDER BY finished LIMIT ?',
+                                          (now - self.ttl_seconds, overflow)).fetchall()
+            connection.executemany('DELETE FROM tasks WHERE id = ?', [(row['id'],) for row in expired])
+        for row in expired:
+            with contextlib.suppress(OSError):
+                os.remove(self._audio_path(row['id'], row['audio_format']))
+
+    def stats(self):
+        rows = self._connect().execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        statuses = {status: count for status, count in rows}
+        return {'stored': sum(statuses.values()), 'waiting': statuses.get('queued', 0), 'by_status': statuses}
+
+    def shutdown(self):
+        """Finish the running and queued jobs of this process."""
+        self._executor.shutdown(wait=True)
+
+task_manager = TaskManager(TASK_STORE_DIR, TASK_MAX_CONCURRENT, TASK_MAX_QUEUED, TASK_RESULT_TTL_SECONDS, TASK_MAX_STORED)
+
+# Model warmup: /health answers 503 until every model has synthesized once in this process
+MODEL_WARMUP = os.environ.get('MODEL_WARMUP', '1') == '1'
+WARMUP_TEXT = os.environ.get('WARMUP_TEXT', 'Hola.')
+DEFAULT_SYNTHESIS_SETTINGS = {'speaker': 0, 'noise_scale': 0.667, 'length_scale': 1.0, 'noise_w': 0.8}
+
+# Resident models (pooled piper processes or ONNX sessions) per serving process
+MODEL_MEMORY_BUDGET_MB = int(os.environ.get('MODEL_MEMORY_BUDGET_MB', 0))  # 0 keeps every model resident
+MODEL_MEMORY_FACTOR = float(os.environ.get('MODEL_MEMORY_FACTOR', 1.5))  # Resident bytes per byte of .onnx file
+MODEL_PINNED = [name.strip() for name in os.environ.get('MODEL_PINNED', '').split(',') if name.strip()]
+
+class ModelManager:
+    """
+    Keeps the models resident in this process within a memory budget.
+
+    A model is loaded on first use by synthesizing WARMUP_TEXT with it, which
+    starts its pooled piper process or ONNX session. Each resident model is
+    estimated at its .onnx size times MODEL_MEMORY_FACTOR, per piper process
+    when the piper pool is used. Once the estimate exceeds budget_bytes the
+    least recently used models that are neither pinned nor in use by a
+    conversion are unloaded with retire_model_path; the next request loads
+    them again. Without a pool or ONNX engine nothing stays resident and only
+    hits and misses are counted.
+    """
+
+    def __init__(self, budget_bytes, pinned):
+        self.budget_bytes = budget_bytes
+        self.pinned = set(pinned)
+        self._lock = threading.Lock()
+        self._resident = collections.OrderedDict()  # model_path -> model_config, least recently used first
+        self._loading = {}  # model_path -> threading.Event set when the load finishes
+        self._in_use = collections.Counter()
+        self.evictions = 0
+
+    def is_pinned(self, model_config):
+        return model_config["filename_key"] in self.pinned or model_config["id"] in self.pinned
+
+    def load(self, model_config):
+        """Make a model resident (or mark it recently used); raises if loading fails."""
+        model_path = model_config["model_path_onnx"]
+        name = model_config["filename_key"]
+        while True:
+            with self._lock:
+                if model_path in self._resident:
+                    self._resident.move_to_end(model_path)
+                    metrics.increment(f'models.hits.{name}')
+                    return
+                loading = self._loading.get(model_path)
+                if loading is None:
+                    loading = self._loading[model_path] = threading.Event()
+                    break
+            # Another request is loading it; use its result
+            loading.wait()
+
+        metrics.increment(f'models.misses.{name}')
+        started = time.monotonic()
+        loaded = False
+        try:
+            self._load(model_path)
+            loaded = True
+            metrics.observe(f'models.load_seconds.{name}', time.monotonic() - started)
+            logging.info(f"[MODELS] Loaded {name} in {time.monotonic() - started:.2f}s")
+        finally:
+            with self._lock:
+                if loaded:
+                    self._resident[model_path] = model_config
+                del self._loading[model_path]
+                to_evict = self._select_evictions_locked()
+            loading.set()
+            self._evict(to_evict)
+
+    @staticmethod
+    def _load(model_path):
+        if onnx_engine is None and piper_pool is None:
+            return
+        temp_dir = tempfile.mkdtemp(dir=temp_audio_folder)
+        try:
+            # A WAV path (piper) or a PCM array (onnx); None when nothing was generated
+            if synthesize_sentence(WARMUP_TEXT, model_path, dict(DEFAULT_SYNTHESIS_SETTINGS), temp_dir) is None:
+                raise RuntimeError("no audio generated")
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def hold(self, model_config):
+        """Keep a model from being evicted until release(); does not load it."""
+        with self._lock:
+            self._in_use[model_config["model_path_onnx"]] += 1
+
+    def ensure_loaded(self, model_config):
+        """load() for a conversion: failures are logged and left to per-sentence synthesis."""
+        try:
+            self.load(model_config)
+        except Exception as e:
+            logging.error(f"[MODELS] Loading {model_config['filename_key']} failed: {e}")
+
+    def acquire(self, model_config):
+        """Hold a model for a conversion and load it if it is not resident."""
+        self.hold(model_config)
+        self.ensure_loaded(model_config)
+
+    def release(self, model_config):
+        model_path = model_config["model_path_onnx"]
+        with self._lock:
+            self._in_use[model_path] -= 1
+            if self._in_use[model_path] <= 0:
+                del self._in_use[model_path]
+            to_evict = self._select_evictions_locked()
+        self._evict(to_evict)
+
+    def discard(self, model_path):
+        """Forget a model whose file was replaced or removed (it is unloaded by the caller)."""
+        with self._lock:
+            self._resident.pop(model_path, None)
+
+    def _footprint(self, model_path):
+        if onnx_engine is None and piper_pool is None:
+            return 0
+        try:
+            size = os.path.getsize(model_path)
+        except OSError:
+            return 0
+        copies = piper_pool.model_processes(model_path) if onnx_engine is None and piper_pool is not None else 1
+        return int(size * MODEL_MEMORY_FACTOR) * max(1, copies)
+
+    def _select_evictions_locked(self):
+        if self.budget_bytes <= 0:
+            return []
+        footprints = {model_path: self._footprint(model_path) for model_path in self._resident}
+        total = sum(footprints.values())
+        victims = []
+        for model_path, model_config in self._resident.items():
+            if total <= self.budget_bytes:
+                break
+            if self._in_use[model_path] or self.is_pinned(model_config):
+                continue
+            total -= footprints[model_path]
+            victims.append(model_path)
+        for model_path in victims:
+            del self._resident[model_path]
+        self.evictions += len(victims)
+        return victims
+
+    @staticmethod
+    def _evict(model_paths):
+        for model_path in model_paths:
+            logging.info(f"[MODELS] Evicting {os.path.basename(model_path)} (memory budget)")
+            metrics.increment('models.evictions')
+            retire_model_path(model_path)
+
+    def warmup_candidates(self, configs):
+        """Models to load at startup: all of them without a budget, else only the pinned ones."""
+        if self.budget_bytes <= 0:
+            return configs
+        return {name: config for name, config in configs.items() if self.is_pinned(config)}
+
+    def stats(self):
+        with self._lock:
+            resident = list(self._resident.values())
+            return {
+                'resident': [config["filename_key"] for config in resident],
+                'estimated_bytes': sum(self._footprint(config["model_path_onnx"]) for config in resident),
+                'budget_bytes': self.budget_bytes,
+                'pinned': sorted(self.pinned),
+                'in_use': len(self._in_use),
+                'evictions': self.evictions,
+            }
+
+model_manager = ModelManager(MODEL_MEMORY_BUDGET_MB * 1024 * 1024, MODEL_PINNED)
+
+def probe_model(model_config):
+    """
+    Synthesize WARMUP_TEXT with a model file outside the piper pool and ONNX
+    engine; raises if no audio comes out.
+
+    A replaced file keeps its path, so this checks the new version while the
+    workers and session of the previous one are still serving it.
+    """
+    model_path = model_config["model_path_onnx"]
+    settings = dict(DEFAULT_SYNTHESIS_SETTINGS)
+    if onnx_engine is not None:
+        if OnnxVoice(model_path, model_config).synthesize(WARMUP_TEXT, settings).size == 0:
+            raise RuntimeError("no audio generated")
+        return
+    temp_dir = tempfile.mkdtemp(dir=temp_audio_folder)
+    try:
+        output_file = os.path.join(temp_dir, 'probe.wav')
+        returncode, stderr = run_piper_once(WARMUP_TEXT, model_path, settings, output_file)
+        if returncode != 0 or not os.path.exists(output_file) or os.path.getsize(output_file) <= 44:
+            raise RuntimeError(f"piper exited with {returncode}: {stderr.strip()[-200:]}")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+class ModelWarmup:
+    """
+    Synthesizes a short text with every model once, in the background.
+
+    This spawns the pooled piper processes (or loads the ONNX sessions) and
+    pulls the model files into the page cache before the process is reported
+    ready, so the first real request per model does not pay for it. With a
+    model memory budget only the pinned models are warmed up; the rest are
+    loaded by model_manager on first use. A model whose warmup fails is
+    hidden from the catalog, as on a reload (see ModelWatcher).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started = False
+        self._pending = set()
+        self._failed = []
+        self._ready = not MODEL_WARMUP
+
+    def start(self):
+        with self._lock:
+            if self._started or not MODEL_WARMUP:
+                return
+            self._started = True
+            configs = model_manager.warmup_candidates(model_configs)
+            self._pending = set(configs)
+        threading.Thread(target=self._run, args=(configs,), daemon=True, name='model-warmup').start()
+
+    def _run(self, configs):
+        started = time.monotonic()
+        failed_keys = set()
+        try:
+            futures = {
+                executor.submit(self._warm_model, name, config): name
+                for name, config in configs.items()
+            }
+            for future in concurrent.futures.as_completed(futures):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f"[WARMUP] Model {name} failed, not exposing it: {e}")
+                    failed_keys.add(configs[name]["filename_key"])
+                    with self._lock:
+                        self._failed.append(name)
+                with self._lock:
+                    self._pending.discard(name)
+            if failed_keys:
+                model_watcher.hide(failed_keys)
+        finally:
+            with self._lock:
+                self._ready = True
+            logging.info(f"[WARMUP] {len(configs)} models warmed up in {time.monotonic() - started:.1f}s")
+
+    @staticmethod
+    def _warm_model(name, model_config):
+        started = time.monotonic()
+        model_manager.load(model_config)
+        metrics.observe('warmup.model_seconds', time.monotonic() - started)
+
+    def status(self):
+        with self._lock:
+            return {
+                'ready': self._ready,
+                'pending': sorted(self._pending),
+                'failed': list(self._failed),
+            }
+
+model_warmup = ModelWarmup()
+
+# Seconds between scans of the models folder; 0 disables polling (reload requests still apply)
+MODEL_WATCH_INTERVAL = float(os.environ.get('MODEL_WATCH_INTERVAL', 10))
+
+class ModelWatcher:
+    """
+    Polls the models folder and applies added, changed and removed models
+    without a restart.
+
+    Models are compared by the mtime and size of their .onnx.json and .onnx
+    files, and a change is applied once two consecutive polls agree, so files
+    still being copied are left alone. Only changed models are parsed and
+    their new version is checked with probe_model first; only then are the
+    previous piper workers and ONNX session dropped, the new version warmed
+    up and the catalog swapped in with publish_models. When the check fails,
+    an updated model keeps serving its previous version and a new one is not
+    exposed, until its files change again.
+
+    request_reload() asks every worker process to rescan at once; the thread
+    checks for that request every second, even when polling is disabled.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._seen = {}  # filename key -> file state on the previous poll
+        self._rejected = {}  # filename key -> file state whose new version failed its check
+        self._thread = None
+        self._reload_marker = SharedMarker(os.path.join(temp_audio_folder, '.models_reload'))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._seen = {key: state for key, (state, _) in model_entries.items()}
+        self._thread = threading.Thread(target=self._loop, daemon=True, name='model-watcher')
+        self._thread.start()
+
+    def _loop(self):
+        next_poll = time.monotonic() + self.interval
+        while True:
+            time.sleep(1)
+            try:
+                if self._reload_marker.changed():
+                    self.refresh(settle=False)
+                elif self.interval > 0 and time.monotonic() >= next_poll:
+                    next_poll = time.monotonic() + self.interval
+                    self.refresh()
+            except Exception as e:
+                logging.error(f"[MODELS] Watch error: {e}")
+
+    def request_reload(self):
+        """Rescan now in this process and signal the other worker processes to do the same."""
+        changes = self.refresh(settle=False)
+        try:
+            self._reload_marker.bump()
+        except OSError as e:
+            logging.error(f"[MODELS] Could not signal the reload to other workers: {e}")
+        return changes
+
+    def refresh(self, settle=True):
+        """Apply pending model changes; settle=False skips the two-poll wait."""
+        with self._lock:
+            current = scan_model_files()
+            seen, self._seen = self._seen, current
+            entries = model_entries
+            self._rejected = {key: state for key, state in self._rejected.items() if current.get(key) == state}
+            changed = [
+                key for key, state in current.items()
+                if (key not in entries or entries[key][0] != state) and self._rejected.get(key) != state
+                and (not settle or seen.get(key) == state)
+            ]
+            removed = [key for key in entries if key not in current and (not settle or key not in seen)]
+            if not changed and not removed:
+                return {'added': [], 'updated': [], 'removed': [], 'failed': []}
+
+            started = time.monotonic()
+            staged = {key: parse_model_entry(key, current[key]) for key in changed}
+            failed = self._run_all(probe_model, staged)
+            for key in failed:
+                if key in entries and entries[key][1] is not None:
+                    # Keep serving the previous version; its workers and session are still loaded
+                    logging.error(f"[MODELS] Keeping the previous version of {key}")
+                    self._rejected[key] = current[key]
+                    del staged[key]
+                else:
+                    staged[key] = (staged[key][0], None)
+            for key in list(staged) + removed:
+                previous = entries.get(key, (None, None))[1]
+                if previous is not None:
+                    retire_model_path(previous["model_path_onnx"])
+            for key in self._warm_up(staged):
+                retire_model_path(staged[key][1]["model_path_onnx"])
+                staged[key] = (staged[key][0], None)
+                failed.append(key)
+            changes = {
+                'added': [key for key in staged if key not in entries and key not in failed],
+                'updated': [key for key in staged if key in entries and key not in failed],
+                'removed': removed,
+                'failed': failed,
+            }
+            if not staged and not removed:
+                return changes
+
+            new_entries = {key: entry for key, entry in entries.items() if key not in removed}
+            new_entries.update(staged)
+            publish_models(new_entries)
+            save_model_manifest(new_entries)
+            flush_audio_caches()
+            metrics.increment('models.reloads')
+            metrics.observe('models.reload_seconds', time.monotonic() - started)
+            logging.info(f"[MODELS] Reloaded in {time.monotonic() - started:.1f}s: "
+                         f"added {changes['added']}, updated {changes['updated']}, removed {changes['removed']}")
+            return changes
+
+    def hide(self, keys):
+        """Take models out of the catalog until their files change (startup warmup failures)."""
+        with self._lock:
+            entries = dict(model_entries)
+            for key in keys:
+                if entries.get(key, (None, None))[1] is not None:
+                    retire_model_path(entries[key][1]["model_path_onnx"])
+                    entries[key] = (entries[key][0], None)
+            publish_models(entries)
+
+    @staticmethod
+    def _run_all(check, staged):
+        """Run check(model_config) for every staged model on the executor; returns the keys that failed."""
+        configs = {key: model_config for key, (_, model_config) in staged.items() if model_config is not None}
+        if not MODEL_WARMUP or not configs:
+            return []
+        failed = []
+        futures = {executor.submit(check, config): key for key, config in configs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"[MODELS] Warmup of {futures[future]} failed: {e}")
+                failed.append(futures[future])
+        return failed
+
+    @classmethod
+    def _warm_up(cls, staged):
+        """Load every staged model into the pool or engine; returns the keys that failed."""
+        configs = [model_config for _, model_config in staged.values() if model_config is not None]
+        staged_model_configs.update({config["model_path_onnx"]: config for config in configs})
+        try:
+            return cls._run_all(model_manager.load, staged)
+        finally:
+            for config in configs:
+                staged_model_configs.pop(config["model_path_onnx"], None)
+
+model_watcher = ModelWatcher(MODEL_WATCH_INTERVAL)
 
 def get_client_ip():
     """Get the real client IP address, considering proxy headers"""
@@ -933,67 +3717,227 @@ def is_private_ip(ip):
     except:
         return False
 
+class RingCounter:
+    """
+    Sliding-window counter over a ring of fixed-width time slots.
+
+    Slots that fall out of the window are cleared lazily, when the counter is
+    next touched, and a running total is kept, so add() and count() are O(1)
+    amortized no matter how many requests the window holds.
+    """
+
+    __slots__ = ('slot_seconds', 'counts', 'last_slot', 'total')
+
+    def __init__(self, slots, slot_seconds):
+        self.slot_seconds = slot_seconds
+        self.counts = [0] * slots
+        self.last_slot = None
+        self.total = 0
+
+    def _advance(self, now):
+        slot = int(now // self.slot_seconds)
+        if self.last_slot is not None and slot > self.last_slot:
+            if slot - self.last_slot >= len(self.counts):
+                self.counts = [0] * len(self.counts)
+                self.total = 0
+            else:
+                for expired in range(self.last_slot + 1, slot + 1):
+                    index = expired % len(self.counts)
+                    self.total -= self.counts[index]
+                    self.counts[index] = 0
+        if self.last_slot is None or slot > self.last_slot:
+            self.last_slot = slot
+        return slot
+
+    def count(self, now):
+        self._advance(now)
+        return self.total
+
+    def add(self, now):
+        slot = self._advance(now)
+        self.counts[slot % len(self.counts)] += 1
+        self.total += 1
+
+class MemoryRateLimiter:
+    """
+    Per-IP minute and hour windows kept in this process.
+
+    Tracked IPs live in an LRU bounded by max_tracked; blocked IPs in a second
+    LRU of the same size. All updates happen under one lock.
+    """
+
+    def __init__(self, per_minute, per_hour, block_seconds, max_tracked):
+        self.per_minute = per_minute
+        self.per_hour = per_hour
+        self.block_seconds = block_seconds
+        self.max_tracked = max_tracked
+        self._clients = collections.OrderedDict()  # ip -> (minute RingCounter, hour RingCounter)
+        self._blocked = collections.OrderedDict()  # ip -> blocked until (epoch seconds)
+        self._lock = threading.Lock()
+
+    def check(self, client_ip, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            blocked_until = self._blocked.get(client_ip)
+            if blocked_until is not None:
+                if now < blocked_until:
+                    return False, "IP temporarily blocked due to suspicious activity"
+                del self._blocked[client_ip]
+            windows = self._clients.get(client_ip)
+            if windows is None:
+                windows = self._clients[client_ip] = (RingCounter(60, 1), RingCounter(60, 60))
+                while len(self._clients) > self.max_tracked:
+                    self._clients.popitem(last=False)
+            else:
+                self._clients.move_to_end(client_ip)
+            minute, hour = windows
+            if minute.count(now) >= self.per_minute:
+                self._block(client_ip, now)
+                return False, "Rate limit exceeded: too many requests per minute"
+            if hour.count(now) >= self.per_hour:
+                self._block(client_ip, now)
+                return False, "Rate limit exceeded: too many requests per hour"
+            minute.add(now)
+            hour.add(now)
+            return True, None
+
+    def _block(self, client_ip, now):
+        self._blocked[client_ip] = now + self.block_seconds
+        self._blocked.move_to_end(client_ip)
+        while len(self._blocked) > self.max_tracked:
+            self._blocked.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'backend': 'memory', 'tracked_ips': len(self._clients), 'blocked_ips': len(self._blocked)}
+
+class SqliteRateLimiter:
+    """
+    The same windows in a SQLite file, so every worker process on the host
+    enforces one shared limit (a local stand-in for Redis).
+
+    Hits are stored per (ip, window, slot); each check is one short write
+    transaction over indexed rows, and expired rows are purged periodically.
+    """
+
+    WINDOWS = (('minute', 1, 60), ('hour', 60, 60))  # name, slot seconds, slots
+    PURGE_EVERY = 1000
+
+    def __init__(self, path, per_minute, per_hour, block_seconds):
+        self.path = path
+        self.limits = {'minute': per_minute, 'hour': per_hour}
+        self.block_seconds = block_seconds
+        self._local = threading.local()
+        self._checks = itertools.count()
+        with self._connect() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS hits (ip TEXT, window TEXT, slot INTEGER, count INTEGER, '
+                               'PRIMARY KEY (ip, window, slot)) WITHOUT ROWID')
+            connection.execute('CREATE TABLE IF NOT EXISTS blocked (ip TEXT PRIMARY KEY, until REAL)')
+
+    def _connect(self):
+        # sqlite3 connections must stay on the thread that opened them
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return connection
+
+    def check(self, client_ip, now=None):
+        now = time.time() if now is None else now
+        connection = self._connect()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = self._check(connection, client_ip, now)
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    def _check(self, connection, client_ip, now):
+        row = connection.execute('SELECT until FROM blocked WHERE ip = ?', (client_ip,)).fetchone()
+        if row is not None:
+            if now < row[0]:
+                return False, "IP temporarily blocked due to suspicious activity"
+            connection.execute('DELETE FROM blocked WHERE ip = ?', (client_ip,))
+        for window, slot_seconds, slots in self.WINDOWS:
+            slot = int(now // slot_seconds)
+            (total,) = connection.execute(
+                'SELECT COALESCE(SUM(count), 0) FROM hits WHERE ip = ? AND window = ? AND slot > ?',
+                (client_ip, window, slot - slots)).fetchone()
+            if total >= self.limits[window]:
+                connection.execute('INSERT OR REPLACE INTO blocked (ip, until) VALUES (?, ?)',
+                                   (client_ip, now + self.block_seconds))
+                return False, f"Rate limit exceeded: too many requests per {window}"
+        for window, slot_seconds, _ in self.WINDOWS:
+            connection.execute('INSERT INTO hits (ip, window, slot, count) VALUES (?, ?, ?, 1) '
+                               'ON CONFLICT (ip, window, slot) DO UPDATE SET count = count + 1',
+                               (client_ip, window, int(now // slot_seconds)))
+        if next(self._checks) % self.PURGE_EVERY == 0:
+            self._purge(connection, now)
+        return True, None
+
+    def _purge(self, connection, now):
+        for window, slot_seconds, slots in self.WINDOWS:
+            connection.execute('DELETE FROM hits WHERE window = ? AND slot <= ?',
+                               (window, int(now // slot_seconds) - slots))
+        connection.execute('DELETE FROM blocked WHERE until <= ?', (now,))
+
+    def stats(self):
+        connection = self._connect()
+        (tracked,) = connection.execute('SELECT COUNT(DISTINCT ip) FROM hits').fetchone()
+        (blocked,) = connection.execute('SELECT COUNT(*) FROM blocked WHERE until > ?', (time.time(),)).fetchone()
+        return {'backend': 'sqlite', 'tracked_ips': tracked, 'blocked_ips': blocked}
+
+if RATE_LIMIT_BACKEND == 'sqlite':
+    rate_limiter = SqliteRateLimiter(RATE_LIMIT_SQLITE_PATH, MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_HOUR,
+                                     BLOCK_DURATION_MINUTES * 60)
+else:
+    rate_limiter = MemoryRateLimiter(MAX_REQUESTS_PER_MINUTE, MAX_REQUESTS_PER_HOUR,
+                                     BLOCK_DURATION_MINUTES * 60, RATE_LIMIT_MAX_TRACKED_IPS)
+
 def check_rate_limit(client_ip):
     """Check if client has exceeded rate limits"""
-    now = datetime.now()
-    
-    # Clean old entries
-    for ip in list(request_counts.keys()):
-        request_counts[ip] = [(timestamp, count) for timestamp, count in request_counts[ip] 
-                             if now - timestamp < timedelta(hours=1)]
-        if not request_counts[ip]:
-            del request_counts[ip]
-    
-    # Check if IP is blocked
-    if client_ip in blocked_ips:
-        if now - blocked_ips[client_ip] < timedelta(minutes=BLOCK_DURATION_MINUTES):
-            return False, "IP temporarily blocked due to suspicious activity"
-        else:
-            del blocked_ips[client_ip]
-    
-    # Initialize or get current counts
-    if client_ip not in request_counts:
-        request_counts[client_ip] = []
-    
-    # Count requests in last minute and hour
-    minute_ago = now - timedelta(minutes=1)
-    hour_ago = now - timedelta(hours=1)
-    
-    requests_last_minute = sum(1 for timestamp, _ in request_counts[client_ip] if timestamp > minute_ago)
-    requests_last_hour = sum(1 for timestamp, _ in request_counts[client_ip] if timestamp > hour_ago)
-    
-    # Check limits
-    if requests_last_minute >= MAX_REQUESTS_PER_MINUTE:
-        blocked_ips[client_ip] = now
-        return False, "Rate limit exceeded: too many requests per minute"
-    
-    if requests_last_hour >= MAX_REQUESTS_PER_HOUR:
-        blocked_ips[client_ip] = now
-        return False, "Rate limit exceeded: too many requests per hour"
-    
-    # Add current request
-    request_counts[client_ip].append((now, 1))
-    return True, None
+    try:
+        return rate_limiter.check(client_ip)
+    except sqlite3.Error as e:
+        # A busy or broken shared store must not take the service down
+        logging.error(f"Rate limiter backend error, allowing request from {client_ip}: {e}")
+        return True, None
+
+# Each pattern list compiled into one alternation, searched in the lowercased string
+SUSPICIOUS_USER_AGENT_RE = re.compile('|'.join(map(re.escape, SUSPICIOUS_USER_AGENTS)))
+VALID_USER_AGENT_RE = re.compile('|'.join(map(re.escape, VALID_USER_AGENTS)))
+USER_AGENT_CACHE_SIZE = int(os.environ.get('USER_AGENT_CACHE_SIZE', 4096))
+USER_AGENT_CACHE_MAX_LENGTH = 512  # Longer strings are checked but not cached
+
+def _user_agent_verdict(user_agent):
+    """Return (allowed, message_or_None, looks_like_browser) for a non-empty User-Agent."""
+    user_agent_lower = user_agent.lower()
+    if SUSPICIOUS_USER_AGENT_RE.search(user_agent_lower):
+        # Report the first listed pattern, as the per-pattern loop did
+        suspicious = next(pattern for pattern in SUSPICIOUS_USER_AGENTS if pattern in user_agent_lower)
+        return False, f"Suspicious User-Agent detected: {suspicious}", False
+    return True, None, VALID_USER_AGENT_RE.search(user_agent_lower) is not None
+
+_cached_user_agent_verdict = lru_cache(maxsize=USER_AGENT_CACHE_SIZE)(_user_agent_verdict)
 
 def validate_user_agent(user_agent):
     """Validate user agent to prevent automated requests"""
     if not user_agent:
         return False, "Missing User-Agent header"
     
-    user_agent_lower = user_agent.lower()
-    
-    # Check if user agent is in blocked list
-    if user_agent_lower in blocked_user_agents:
-        return False, "Blocked User-Agent"
-    
-    # Check for suspicious patterns
-    for suspicious in SUSPICIOUS_USER_AGENTS:
-        if suspicious in user_agent_lower:
-            blocked_user_agents.add(user_agent_lower)
-            return False, f"Suspicious User-Agent detected: {suspicious}"
+    # Verdicts are cached per User-Agent string; browsers send the same few over and over
+    if len(user_agent) <= USER_AGENT_CACHE_MAX_LENGTH:
+        allowed, message, is_valid = _cached_user_agent_verdict(user_agent)
+    else:
+        allowed, message, is_valid = _user_agent_verdict(user_agent)
+    if not allowed:
+        return False, message
     
     # Check if user agent matches valid patterns (more lenient for legitimate browsers)
-    is_valid = any(valid in user_agent_lower for valid in VALID_USER_AGENTS)
     if not is_valid:
         # Log suspicious user agent but don't block immediately
         logging.warning(f"Potentially suspicious User-Agent: {user_agent}")
@@ -1001,16 +3945,17 @@ def validate_user_agent(user_agent):
     
     return True, None
 
+# Only obviously malicious automation headers are rejected
+MALICIOUS_HEADERS = ('x-automation', 'x-test', 'x-bot', 'selenium-remote-control', 'webdriver')
+PROXY_INDICATOR_HEADERS = ('CF-Ray', 'CF-Connecting-IP', 'X-Forwarded-For', 'X-Real-IP', 'X-Forwarded-Proto')
+CONVERT_CONTENT_TYPES = ('application/x-www-form-urlencoded', 'multipart/form-data', 'application/json')
+SUSPICIOUS_CONTENT_PATTERNS = ('<script', '<?php', '<%', 'javascript:', 'data:', 'vbscript:')
+SUSPICIOUS_CONTENT_RE = re.compile('|'.join(map(re.escape, SUSPICIOUS_CONTENT_PATTERNS)))
+
 def validate_request_headers():
     """Validate request headers for security - proxy-friendly version"""
-    # Only check for obviously malicious automation headers
     # Allow proxy headers that are common with Cloudflare, nginx, etc.
-    malicious_headers = [
-        'x-automation', 'x-test', 'x-bot',
-        'selenium-remote-control', 'webdriver'
-    ]
-    
-    for header in malicious_headers:
+    for header in MALICIOUS_HEADERS:
         if request.headers.get(header):
             return False, f"Suspicious header detected: {header}"
     
@@ -1022,27 +3967,29 @@ def validate_request_headers():
         # Proxies sometimes strip or modify headers
         if not content_type:
             # Check if this looks like a proxy request
-            proxy_indicators = [
-                'CF-Ray', 'CF-Connecting-IP', 'X-Forwarded-For', 
-                'X-Real-IP', 'X-Forwarded-Proto'
-            ]
-            has_proxy_headers = any(request.headers.get(header) for header in proxy_indicators)
+            has_proxy_headers = any(request.headers.get(header) for header in PROXY_INDICATOR_HEADERS)
             
             if not has_proxy_headers:
                 return False, "Missing Content-Type header"
         
         # For /convert endpoint, be more flexible with Content-Type
         if request.endpoint == 'convert' and content_type:
-            valid_types = [
-                'application/x-www-form-urlencoded',
-                'multipart/form-data',
-                'application/json'  # Allow JSON for API usage through proxies
-            ]
-            if not any(valid_type in content_type for valid_type in valid_types):
+            # JSON is allowed for API usage through proxies
+            if not any(valid_type in content_type for valid_type in CONVERT_CONTENT_TYPES):
                 return False, "Invalid Content-Type for web interface"
     
     return True, None
 
+def request_data():
+    """
+    The POST body as a mapping (JSON object or form), parsed once per request
+    and shared by security_check and the route through flask.g.
+    """
+    if 'request_data' not in g:
+        data = request.get_json(silent=True) if request.is_json else request.form
+        g.request_data = data if isinstance(data, collections.abc.Mapping) else {}
+    return g.request_data
+
 def security_check(f):
     """Comprehensive security decorator"""
     @wraps(f)
@@ -1072,27 +4019,38 @@ def security_check(f):
         
         # Additional validation for text input
         if request.method == 'POST':
-            if request.is_json:
-                data = request.get_json()
-                text = data.get('text', '') if data else ''
-            else:
-                text = request.form.get('text', '')
+            text = request_data().get('text', '')
+            if not isinstance(text, str):
+                text = ''
             
             if text and len(text) > MAX_TEXT_LENGTH:
                 logging.warning(f"Text too long from IP {client_ip}: {len(text)} characters")
                 return jsonify({'error': f'Text too long. Maximum {MAX_TEXT_LENGTH} characters allowed.'}), 400
             
             # Check for potential injection attempts
-            suspicious_patterns = ['<script', '<?php', '<%', 'javascript:', 'data:', 'vbscript:']
-            text_lower = text.lower() if text else ''
-            for pattern in suspicious_patterns:
-                if pattern in text_lower:
-                    logging.warning(f"Suspicious content detected from IP {client_ip}: {pattern}")
-                    return jsonify({'error': 'Invalid content detected.'}), 400
+            text_lower = text.lower()
+            if SUSPICIOUS_CONTENT_RE.search(text_lower):
+                pattern = next(pattern for pattern in SUSPICIOUS_CONTENT_PATTERNS if pattern in text_lower)
+                logging.warning(f"Suspicious content detected from IP {client_ip}: {pattern}")
+                return jsonify({'error': 'Invalid content detected.'}), 400
         
         return f(*args, **kwargs)
     return decorated_function
 
+def admin_required(f):
+    """Allow logged-in users or requests carrying PIPER_API_TOKEN as a Bearer token."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get('username'):
+            return f(*args, **kwargs)
+        api_token = os.environ.get('PIPER_API_TOKEN')
+        auth_header = request.headers.get('Authorization', '')
+        if api_token and auth_header.startswith('Bearer ') and secrets.compare_digest(auth_header[7:], api_token):
+            return f(*args, **kwargs)
+        logging.warning(f"Unauthorized admin request from IP {get_client_ip()} to {request.path}")
+        return jsonify({'error': 'No autorizado'}), 401
+    return decorated_function
+
 # Función para convertir imagen a base64
 def image_to_base64(image_path):
     try:
@@ -1121,77 +4079,130 @@ def cleanup_file_delayed(filepath, delay=1.0):
     cleanup_thread = threading.Thread(target=delayed_cleanup, daemon=True)
     cleanup_thread.start()
 
-# Función para enviar archivo como stream en memoria
-def send_file_as_stream(filepath, mimetype='audio/mpeg', filename=None):
-    """Envía un archivo como stream y permite eliminarlo inmediatamente"""
-    try:
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
-        
-        # Eliminar el archivo inmediatamente después de leerlo
+def wants_base64_json():
+    """Base64-in-JSON responses are opt-in: response=json in the request or an Accept header preferring JSON."""
+    if request.values.get('response') == 'json':
+        return True
+    return request.accept_mimetypes.best_match(['audio/*', 'application/json']) == 'application/json'
+
+def send_audio_response(audio_data, audio_format, cache_key):
+    """
+    Return encoded audio as a binary response with ETag and Range support.
+
+    When the response cache holds the audio on disk the file is served with
+    send_file, which lets the WSGI server use sendfile instead of copying it
+    through Python.
+    """
+    mimetype = AUDIO_MIMETYPES[audio_format]
+    download_name = f'audio_{cache_key[:12]}.{audio_format}'
+    cache_path = response_cache.path_for(cache_key) if response_cache.enabled else None
+    if cache_path:
         try:
-            os.remove(filepath)
-            logging.debug(f"Final MP3 deleted immediately after reading: {filepath}")
-        except Exception as e:
-            logging.error(f"Error deleting final MP3 immediately {filepath}: {e}")
-        
-        # Crear un stream en memoria
-        file_stream = io.BytesIO(file_data)
-        
-        # Usar Response para enviar el stream
-        if not filename:
-            filename = f'audio_{random_string(8)}.mp3'
-            
-        return Response(
-            file_stream.getvalue(),
-            mimetype=mimetype,
-            headers={
-                'Content-Disposition': f'attachment; filename="{filename}"',
-                'Content-Length': str(len(file_data))
-            }
-        )
-    except Exception as e:
-        logging.error(f"Error sending file as stream: {e}")
-        return None
+            return send_file(cache_path, mimetype=mimetype, download_name=download_name,
+                             conditional=True, etag=cache_key, max_age=0)
+        except FileNotFoundError:
+            pass  # Evicted between lookup and open, fall back to the bytes in hand
+    if audio_data is None:
+        audio_data = response_cache.get(cache_key)
+    if audio_data is None:
+        response = jsonify({'error': 'Audio no disponible'})
+        response.status_code = 404
+        return response
+    response = Response(audio_data, mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'inline; filename="{download_name}"'
+    response.set_etag(cache_key)
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(audio_data))
 
-@app.route('/convert', methods=['POST'])
-@security_check
-def convert():
-    """Convertir texto a voz para la interfaz web del playground"""
-    data = request.form
+def parse_convert_request():
+    """Validate the /convert form or JSON body. Returns (params, None) or (None, error_response)."""
+    data = request_data()
     text = data.get('text')
     model_name = data.get('model')
     
-    if not text or not text.strip():
-        return jsonify({'error': 'El texto no puede estar vacío'}), 400
+    if not isinstance(text, str) or not text.strip():
+        return None, (jsonify({'error': 'El texto no puede estar vacío'}), 400)
     if not model_name:
-        return jsonify({'error': 'Se requiere un nombre de modelo'}), 400
+        return None, (jsonify({'error': 'Se requiere un nombre de modelo'}), 400)
     
     # Resolve model name to actual key if needed
     resolved_model_name = model_id_to_filename_map.get(model_name, model_name)
     if resolved_model_name not in existing_models:
-        return jsonify({'error': f'Modelo "{model_name}" no encontrado'}), 404
+        return None, (jsonify({'error': f'Modelo "{model_name}" no encontrado'}), 404)
     
-    settings = {
-        'speaker': int(data.get('speaker', 0)),
-        'noise_scale': float(data.get('noise_scale', 0.667)),
-        'length_scale': float(data.get('length_scale', 1.0)),
-        'noise_w': float(data.get('noise_w', 0.8)),
-    }
+    try:
+        settings = {
+            'speaker': int(data.get('speaker', DEFAULT_SYNTHESIS_SETTINGS['speaker'])),
+            'noise_scale': float(data.get('noise_scale', DEFAULT_SYNTHESIS_SETTINGS['noise_scale'])),
+            'length_scale': float(data.get('length_scale', DEFAULT_SYNTHESIS_SETTINGS['length_scale'])),
+            'noise_w': float(data.get('noise_w', DEFAULT_SYNTHESIS_SETTINGS['noise_w'])),
+        }
+    except (TypeError, ValueError):
+        return None, (jsonify({'error': 'Los parámetros de síntesis deben ser numéricos'}), 400)
+    
+    audio_format = data.get('format', 'mp3')
+    if audio_format not in AUDIO_MIMETYPES:
+        return None, (jsonify({'error': f'Formato de audio "{audio_format}" no soportado'}), 400)
+    
+    return {
+        'text': text,
+        'model_name': model_name,
+        'settings': settings,
+        'audio_format': audio_format,
+        'client_class': 'user' if session.get('username') else 'anonymous',
+        'cache_key': response_cache_key(text, model_name, settings, audio_format),
+    }, None
+
+@app.route('/convert', methods=['POST'])
+@security_check
+def convert():
+    """Convertir texto a voz para la interfaz web del playground"""
+    params, error_response = parse_convert_request()
+    if error_response:
+        return error_response
+    early_response = convert_preflight(params)
+    if early_response is not None:
+        return early_response
     
-    output_file_mp3, error_message = convert_text_to_speech_concurrent(text, model_name, settings)
+    started = time.monotonic()
+    environ = request.environ
+    audio_data, error_message = convert_text_to_speech_concurrent(
+        params['text'], params['model_name'], params['settings'], params['audio_format'],
+        client_class=params['client_class'], should_cancel=lambda: client_disconnected(environ))
+    metrics.observe('convert.total_seconds', time.monotonic() - started)
+    return convert_result_response(params, audio_data, error_message)
+
+def convert_preflight(params):
+    """Answer a /convert request from the caches or the task queue; None means synthesize it now."""
+    cache_key = params['cache_key']
+    # Identical requests are answered from the response cache without splitting, synthesis or encoding
+    if request.if_none_match.contains(cache_key):
+        return Response(status=304, headers={'ETag': f'"{cache_key}"'})
+    if response_cache.enabled:
+        # A disk hit is sent straight from the file; only memory-only entries are loaded here
+        cache_path = response_cache.path_for(cache_key)
+        cached_audio = None if cache_path else response_cache.get(cache_key)
+        if cache_path or cached_audio:
+            logging.info(f"[CACHE] Serving cached response {cache_key[:12]}")
+            return format_audio_response(cached_audio, params['audio_format'], cache_key)
     
-    if output_file_mp3:
-        # Read the MP3 file and encode it as base64 for direct embedding in HTML
+    # Long texts run as background jobs polled through /task/<task_id>
+    if ASYNC_TEXT_THRESHOLD and len(params['text']) > ASYNC_TEXT_THRESHOLD:
         try:
-            with open(output_file_mp3, "rb") as audio_file:
-                audio_base64 = base64.b64encode(audio_file.read()).decode('utf-8')
-            
-            # Clean up the temporary file
-            os.remove(output_file_mp3)
-            
-            # Return the base64 encoded audio data
-            return jsonify({'audio_base64': audio_base64})
+            task_id = task_manager.submit(params)
+        except TaskQueueFull:
+            logging.warning(f"Task queue full, rejecting long text from IP {get_client_ip()}")
+            return jsonify({'error': 'El servidor está ocupado. Por favor, intenta de nuevo en unos minutos.'}), 503
+        return jsonify({'task_id': task_id}), 202
+    return None
+
+def convert_result_response(params, audio_data, error_message):
+    """Cache and format the result of a /convert synthesis."""
+    if audio_data:
+        cache_key = params['cache_key']
+        if response_cache.enabled:
+            response_cache.put(cache_key, audio_data)
+        try:
+            return format_audio_response(audio_data, params['audio_format'], cache_key)
         except Exception as e:
             logging.error(f"Error encoding audio file: {e}")
             return jsonify({'error': 'Error procesando archivo de audio'}), 500
@@ -1199,6 +4210,256 @@ def convert():
         logging.error(f"Audio conversion failed. Error: {error_message}")
         return jsonify({'error': error_message or 'Error al convertir texto a voz'}), 500
 
+def format_audio_response(audio_data, audio_format, cache_key):
+    """Binary audio by default; base64 JSON for clients that opt in."""
+    if not wants_base64_json():
+        response = send_audio_response(audio_data, audio_format, cache_key)
+        if response_cache.enabled:
+            response.headers['Content-Location'] = url_for('cached_audio_file', cache_key=cache_key, audio_format=audio_format)
+        return response
+    if audio_data is None:
+        audio_data = response_cache.get(cache_key)
+    # Encode the audio as base64 for direct embedding in HTML
+    response = jsonify({
+        'audio_base64': base64.b64encode(audio_data).decode('utf-8'),
+        'mimetype': AUDIO_MIMETYPES[audio_format],
+    })
+    response.set_etag(cache_key)
+    return response
+
+@app.route('/task/<task_id>', methods=['GET'])
+def task_status(task_id):
+    """Progress of a background conversion; completed tasks include the audio."""
+    task = task_manager.get(task_id)
+    if task is None:
+        return jsonify({'error': 'Tarea no encontrada o expirada'}), 404
+    total = task['sentences_total']
+    result = {
+        'status': task['status'],
+        'progress': round(100.0 * task['sentences_done'] / total, 1) if total else 0.0,
+        'sentences_done': task['sentences_done'],
+        'sentences_total': total,
+    }
+    if task['status'] == 'completed':
+        result['audio_url'] = url_for('task_audio', task_id=task_id)
+        result['mimetype'] = AUDIO_MIMETYPES[task['audio_format']]
+        if wants_base64_json():
+            audio_data = task_manager.audio(task)
+            if audio_data is None:
+                return jsonify({'error': 'Tarea no encontrada o expirada'}), 404
+            result['audio_base64'] = base64.b64encode(audio_data).decode('utf-8')
+    elif task['status'] == 'error':
+        result['error'] = task['error']
+    return jsonify(result)
+
+@app.route('/task/<task_id>', methods=['DELETE'])
+@app.route('/task/<task_id>/cancel', methods=['POST'])
+def cancel_task(task_id):
+    """Stop a background conversion the client no longer wants (sent when the page is closed)."""
+    if not task_manager.cancel(task_id):
+        return jsonify({'error': 'Tarea no encontrada o ya terminada'}), 404
+    return jsonify({'status': 'cancelled'})
+
+@app.route('/task/<task_id>/audio', methods=['GET'])
+def task_audio(task_id):
+    task = task_manager.get(task_id)
+    audio_data = task_manager.audio(task) if task is not None and task['status'] == 'completed' else None
+    if audio_data is None:
+        return jsonify({'error': 'Audio no disponible'}), 404
+    return send_audio_response(audio_data, task['audio_format'], task['cache_key'])
+
+@app.route('/audio/<cache_key>.<audio_format>', methods=['GET'])
+def cached_audio_file(cache_key, audio_format):
+    """
+    Serve a cached /convert result by its ETag. Range requests (used by <audio>
+    to seek) are only honoured on GET, so this is the URL players should use.
+
+    Not rate limited: a player sends a request for every seek, and the key is
+    a 64-hex digest that only a /convert call can produce.
+    """
+    if audio_format not in AUDIO_MIMETYPES or not re.fullmatch(r'[0-9a-f]{64}', cache_key):
+        return jsonify({'error': 'Audio no encontrado'}), 404
+    return send_audio_response(None, audio_format, cache_key)
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
+
+@app.route('/convert/stream', methods=['POST'])
+@security_check
+def convert_stream():
+    """
+    Stream encoded audio while later sentences are still being synthesized.
+
+    The body is sent with chunked transfer encoding as the encoder produces it;
+    with Accept: text/event-stream each chunk is instead an ordered SSE event
+    carrying base64 audio, followed by a final 'done' event.
+    """
+    params, error_response = parse_convert_request()
+    if error_response:
+        return error_response
+    cache_key = params['cache_key']
+    mimetype = AUDIO_MIMETYPES[params['audio_format']]
+    use_sse = request.accept_mimetypes.best == 'text/event-stream'
+    started = time.monotonic()
+    
+    chunks = queue.Queue()
+    cancel_event = threading.Event()
+    cached_audio = response_cache.get(cache_key) if response_cache.enabled else None
+    if cached_audio:
+        chunks.put(cached_audio)
+        chunks.put(None)
+    else:
+        def run_conversion():
+            try:
+                audio_data, error_message = convert_text_to_speech_concurrent(
+                    params['text'], params['model_name'], params['settings'], params['audio_format'],
+                    on_audio_chunk=chunks.put, client_class=params['client_class'],
+                    should_cancel=cancel_event.is_set)
+                metrics.observe('convert.total_seconds', time.monotonic() - started)
+                if audio_data and response_cache.enabled:
+                    response_cache.put(cache_key, audio_data)
+                if error_message:
+                    if not cancel_event.is_set():
+                        logging.error(f"Streaming conversion failed. Error: {error_message}")
+                    chunks.put(RuntimeError(error_message))
+            finally:
+                chunks.put(None)
+        threading.Thread(target=run_conversion, daemon=True).start()
+    
+    # Wait for the first chunk so errors before any audio still get a proper status code
+    environ = request.environ
+    while True:
+        try:
+            first_chunk = chunks.get(timeout=CANCEL_POLL_SECONDS)
+            break
+        except queue.Empty:
+            if client_disconnected(environ):
+                # Gone before any audio: stop synthesizing for nobody
+                cancel_event.set()
+                return jsonify({'error': 'Conversión cancelada'}), 500
+    if first_chunk is None or isinstance(first_chunk, Exception):
+        return jsonify({'error': str(first_chunk) if first_chunk else 'Error al convertir texto a voz'}), 500
+    metrics.observe('stream.time_to_first_byte_seconds', time.monotonic() - started)
+    
+    def generate():
+        chunk = first_chunk
+        index = 0
+        finished = False
+        try:
+            while chunk is not None:
+                if isinstance(chunk, Exception):
+                    if use_sse:
+                        yield sse_event('error', {'error': str(chunk)})
+                elif use_sse:
+                    yield sse_event('audio', {'index': index, 'audio_base64': base64.b64encode(chunk).decode('utf-8')})
+                    index += 1
+                else:
+                    yield chunk
+                chunk = chunks.get()
+            finished = True
+            if use_sse:
+                yield sse_event('done', {'chunks': index, 'mimetype': mimetype})
+        finally:
+            # The server closes the generator early when the client goes away
+            if not finished:
+                cancel_event.set()
+    
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # Keep nginx from buffering the stream
+    return Response(generate(), mimetype='text/event-stream' if use_sse else mimetype, headers=headers)
+
+@app.route('/health')
+def health():
+    """Readiness probe: 503 until this process has warmed up its models."""
+    status = model_warmup.status()
+    status.update({'status': 'ok' if status['ready'] else 'warming_up', 'models': len(existing_models), 'pid': os.getpid()})
+    return jsonify(status), 200 if status['ready'] else 503
+
+@app.route('/admin/metrics', methods=['GET'])
+@admin_required
+def admin_metrics():
+    snapshot = metrics.snapshot()
+    snapshot['tasks'] = task_manager.stats()
+    snapshot['scheduler'] = scheduler.stats()
+    snapshot['rate_limit'] = rate_limiter.stats()
+    snapshot['models'] = model_manager.stats()
+    return jsonify(snapshot)
+
+@app.route('/admin/cache/stats', methods=['GET'])
+@admin_required
+def admin_cache_stats():
+    return jsonify({'responses': response_cache.stats(), 'sentences': sentence_cache.stats()})
+
+@app.route('/admin/cache/flush', methods=['POST'])
+@admin_required
+def admin_cache_flush():
+    include_sentences = request.args.get('scope') == 'all'
+    flush_audio_caches(include_sentences=include_sentences)
+    return jsonify({'flushed': ['responses', 'sentences'] if include_sentences else ['responses']})
+
+@app.route('/admin/models/reload', methods=['POST'])
+@admin_required
+def admin_models_reload():
+    changes = reload_models()
+    return jsonify({'models': existing_models, **changes})
+
+# Set by gunicorn.conf.py: the app is imported once in the master and then forked, so
+# processes and threads are started per worker from its post_fork hook instead of here
+SERVER_PREFORK = os.environ.get('SERVER_PREFORK') == '1'
+
+def start_worker_services():
+    """Start the pools, background threads and model warmup owned by one serving process."""
+    start_piper_pool()
+    start_preprocess_pool()
+    model_warmup.start()
+    model_watcher.start()
+
+def stop_worker_services():
+    """
+    Finish background conversions, then stop this process's synthesis threads
+    and its piper and preprocessing workers (gunicorn worker_exit).
+
+    Does everything the atexit handlers and interpreter shutdown would, so
+    the caller may exit without them.
+    """
+    global piper_pool, preprocess_pool
+    task_manager.shutdown()
+    scheduler.shutdown()
+    executor.shutdown(wait=True)
+    if piper_pool is not None:
+        piper_pool.shutdown()
+        piper_pool = None
+    if preprocess_pool is not None:
+        preprocess_pool.shutdown()
+        preprocess_pool = None
+
+def preload_shared_models():
+    """
+    Build the ONNX sessions in the gunicorn master, before the workers fork.
+
+    Forked workers then share the loaded (and prepacked) weights copy-on-write
+    instead of each loading its own copy, and find the models already resident
+    when they warm up. Only done with single-threaded sessions, since
+    onnxruntime's thread pools do not survive fork().
+    """
+    if onnx_engine is None or not ONNX_PREFORK_SESSIONS:
+        return
+    if ONNX_INTRA_OP_THREADS != 1:
+        logging.warning("ONNX_PREFORK_SESSIONS needs ONNX_INTRA_OP_THREADS=1; each worker loads its own sessions.")
+        return
+    started = time.monotonic()
+    configs = model_manager.warmup_candidates(model_configs)
+    for name, config in configs.items():
+        try:
+            model_manager.load(config)
+        except Exception as e:
+            logging.error(f"[ONNX] Preloading {name} before fork failed: {e}")
+    logging.info(f"[ONNX] {len(configs)} models loaded before fork in {time.monotonic() - started:.1f}s")
+
+if SERVER_PREFORK:
+    preload_shared_models()
+else:
+    start_worker_services()
+
 if __name__ == '__main__':
     logging.info("Iniciando la API de texto a voz...")
     
@@ -1226,4 +4487,5 @@ if __name__ == '__main__':
     
     logging.info(f"Token de API interno configurado. Modelos disponibles: {existing_models}")
     
-    app.run(host='0.0.0.0', port=7860, debug=False)
\ No newline at end of file
+    # Development server; production runs gunicorn -c gunicorn.conf.py app:app (see entrypoint.sh)
+    app.run(host=os.environ.get('PIPER_HOST', '0.0.0.0'), port=int(os.environ.get('PIPER_PORT', 7860)), debug=False, threaded=True)
\ No newline at end of file
@@ -0,0 +1,434 @@
+"""
+ASGI entry point: the conversion endpoints on asyncio, everything else on the Flask app.
+
+    pip install uvicorn
+    uvicorn asgi:app --host 0.0.0.0 --port 7860
+
+POST /convert and POST /convert/stream run here without holding a thread per
+request: sentences are queued on the same fair scheduler, piper pool and
+encoders as under gunicorn, and the request only awaits their futures, so
+one process can keep hundreds of slow clients connected. Security checks, form parsing, caches and
+response formatting are the Flask ones, run inside app.request_context on a
+WSGI environ built from the ASGI scope. Long texts still become background
+tasks, exactly as under gunicorn. Any other path is handed to the Flask app
+in a worker thread.
+"""
+import asyncio
+import base64
+import contextlib
+import io
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import app as tts
+
+flask_app = tts.app
+
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 1024 * 1024))
+# Conversions allowed to queue work on the scheduler at once, per model and in total; the rest wait without a thread
+ASYNC_CONVERSIONS_PER_MODEL = int(os.environ.get('ASYNC_CONVERSIONS_PER_MODEL', tts.MAX_WORKERS))
+ASYNC_MAX_CONVERSIONS = int(os.environ.get('ASYNC_MAX_CONVERSIONS', 2 * tts.MAX_WORKERS))
+
+_model_semaphores = {}
+_conversion_semaphore = None
+
+
+@contextlib.asynccontextmanager
+async def conversion_slot(model_path):
+    """Hold one of the model's conversion slots and one of the global ones."""
+    global _conversion_semaphore
+    if _conversion_semaphore is None:
+        _conversion_semaphore = asyncio.Semaphore(ASYNC_MAX_CONVERSIONS)
+    semaphore = _model_semaphores.get(model_path)
+    if semaphore is None:
+        semaphore = _model_semaphores[model_path] = asyncio.Semaphore(ASYNC_CONVERSIONS_PER_MODEL)
+    started = time.monotonic()
+    async with semaphore, _conversion_semaphore:
+        tts.metrics.observe('asgi.slot_wait_seconds', time.monotonic() - started)
+        yield
+
+
+async def convert_text_to_speech_async(text, default_model_name, settings, audio_format='mp3', on_audio_chunk=None,
+                                       client_class='anonymous'):
+    """
+    Async counterpart of app.convert_text_to_speech_concurrent.
+
+    Sentences are planned and queued on the fair scheduler by
+    app.plan_conversion, so they run in the same piper pool or ONNX engine
+    and under the same per-request limits as under gunicorn; this coroutine
+    only awaits their futures and feeds the encoder in order. The scheduler
+    bounds the jobs running at once; conversion_slot bounds how many
+    conversions may queue jobs, so a burst of clients waits on a semaphore
+    instead of growing the scheduler queue. Returns
+    (encoded_audio_bytes, error_message). Cancelling the calling task drops
+    the queued jobs, kills running piper and ffmpeg processes and removes
+    temp files.
+    """
+    resolved_model_name = tts.model_id_to_filename_map.get(default_model_name, default_model_name)
+    model_config = tts.model_configs.get(resolved_model_name)
+    if model_config is None or not os.path.exists(model_config["model_path_onnx"]):
+        error_message = f"Model '{default_model_name}' not found or its ONNX file is missing."
+        logging.error(error_message)
+        return None, error_message
+
+    async with conversion_slot(model_config["model_path_onnx"]):
+        return await _convert_on_scheduler(text, resolved_model_name, settings, audio_format,
+                                           on_audio_chunk, client_class)
+
+
+async def _convert_on_scheduler(text, resolved_model_name, settings, audio_format, on_audio_chunk, client_class):
+    loop = asyncio.get_running_loop()
+    scheduled = tts.scheduler.open_request(client_class)
+    submit = lambda cost, fn, *args: tts.scheduler.submit(scheduled, cost, fn, *args)
+    temp_dir = tempfile.mkdtemp(dir=tts.temp_audio_folder)
+    encoder = None
+    encoded_chunks = []
+    acquired_models = {}  # model_path -> config held through model_manager until the end
+    planning = None
+
+    def emit_encoded(data):
+        # Called by the encoder from worker threads, in output order
+        if data:
+            encoded_chunks.append(data)
+            if on_audio_chunk is not None:
+                loop.call_soon_threadsafe(on_audio_chunk, data)
+
+    try:
+        # Shielded: the planning thread cannot be interrupted, so cancellation waits for it below
+        planning = asyncio.ensure_future(asyncio.to_thread(
+            tts.plan_conversion, text, resolved_model_name, settings, temp_dir, submit, acquired_models))
+        ordered_tasks, synthesis_started = await asyncio.shield(planning)
+
+        assembler = tts.PcmAssembler()
+        for task in ordered_tasks:
+            if task['type'] == 'silence':
+                assembler.add_silence(task['duration'])
+            else:
+                try:
+                    sentence_audio = await asyncio.wrap_future(task['future'])
+                    added = await asyncio.to_thread(tts.add_sentence_audio, assembler, sentence_audio,
+                                                    task['sample_rate'], task['cache_key'])
+                    if not added:
+                        logging.warning(f"Skipping empty or missing audio file for sentence: '{task['sentence'][:50]}...'")
+                except asyncio.CancelledError:
+                    raise
+                except Exception as exc:
+                    logging.error(f"Exception retrieving audio generation result for sentence '{task['sentence'][:50]}...': {exc}")
+            pcm = assembler.drain()
+            if pcm:
+                if encoder is None:
+                    encoder = tts.StreamingAudioEncoder(assembler.sample_rate, audio_format, on_output=emit_encoded)
+                await asyncio.to_thread(encoder.write, pcm)
+        if synthesis_started is not None:
+            tts.metrics.observe('convert.synthesis_seconds', time.monotonic() - synthesis_started)
+
+        if not assembler.has_audio():
+            error_message = "No audio segments were successfully generated or collected for concatenation."
+            logging.warning(error_message)
+            return None, error_message
+        await asyncio.to_thread(encoder.write, assembler.drain())  # Trailing silence
+        await asyncio.to_thread(encoder.close)
+        final_audio = b''.join(encoded_chunks)
+        logging.info(f"Encoded final audio: {len(final_audio)} bytes of {audio_format}")
+        return final_audio, None
+    except asyncio.CancelledError:
+        logging.info("[TTS] Conversion cancelled by the client")
+        tts.scheduler.cancel_request(scheduled)
+        raise
+    except Exception as e:
+        error_message = f"Unexpected error in conversion process: {e}"
+        logging.error(error_message, exc_info=True)
+        return None, error_message
+    finally:
+        # Jobs the planning thread submits after this are dropped by the closed request
+        tts.scheduler.close_request(scheduled)
+        cancelled_again = False
+        while planning is not None and not planning.done():
+            # It may still acquire models and write to temp_dir
+            try:
+                await asyncio.wait({planning})
+            except asyncio.CancelledError:
+                cancelled_again = True
+        if encoder is not None:
+            encoder.abort()
+        for model_config in acquired_models.values():
+            tts.model_manager.release(model_config)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        if cancelled_again:
+            raise asyncio.CancelledError()
+
+
+# --- ASGI <-> WSGI plumbing -------------------------------------------------
+
+def _proxy_fix_only(environ, start_response):
+    return environ
+
+# Same trusted-proxy settings as app.wsgi_app, applied to environs built here
+_proxy_fix = flask_app.wsgi_app
+_apply_proxy_fix = ProxyFix(_proxy_fix_only, x_for=_proxy_fix.x_for, x_proto=_proxy_fix.x_proto,
+                            x_host=_proxy_fix.x_host, x_port=_proxy_fix.x_port,
+                            x_prefix=_proxy_fix.x_prefix) if isinstance(_proxy_fix, ProxyFix) else _proxy_fix_only
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope and its already received body."""
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': str(server[0]),
+        'SERVER_PORT': str(server[1]) if server[1] is not None else '80',
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'CONTENT_LENGTH':
+            key = f'HTTP_{name}'
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+async def read_body(receive):
+    """Return the request body, None if the client left, or False if it is too large."""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_BYTES:
+            return False
+        chunks.append(chunk)
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+
+async def send_wsgi(wsgi_app, environ, send):
+    """Run a WSGI callable (the Flask app or a Response) in a thread and relay its output."""
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None  # The write() callable is not used by Flask
+
+    iterable = await asyncio.to_thread(wsgi_app, environ, start_response)
+    iterator = iter(iterable)
+    try:
+        # Generator responses may only call start_response once iterated
+        chunk = await asyncio.to_thread(next, iterator, None)
+        await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+        while chunk is not None:
+            if chunk:
+                await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            chunk = await asyncio.to_thread(next, iterator, None)
+        await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            await asyncio.to_thread(close)
+
+
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body, 'more_body': False})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+# --- Conversion endpoints ---------------------------------------------------
+
+def request_context(environ):
+    """Flask request context for an environ built here; the body is re-read from the start each time."""
+    environ['wsgi.input'].seek(0)
+    return flask_app.request_context(environ)
+
+
+def _passed_security_check():
+    return None
+
+_security_gate = tts.security_check(_passed_security_check)
+
+
+def prepare_conversion(environ, stream):
+    """
+    Run the Flask security check, form parsing and (for /convert) cache and
+    task handling. Returns (response, None) when Flask already has the answer,
+    or (None, params) when the text must be synthesized here.
+    """
+    with request_context(environ):
+        early_response = _security_gate()
+        params = None
+        if early_response is None:
+            params, early_response = tts.parse_convert_request()
+        if early_response is None and not stream:
+            early_response = tts.convert_preflight(params)
+        if early_response is not None:
+            return flask_app.make_response(early_response), None
+        params['use_sse'] = tts.request.accept_mimetypes.best == 'text/event-stream'
+        return None, params
+
+
+def finish_conversion(environ, params, audio_data, error_message):
+    with request_context(environ):
+        return flask_app.make_response(tts.convert_result_response(params, audio_data, error_message))
+
+
+async def handle_convert(scope, receive, send, body):
+    environ = _apply_proxy_fix(build_environ(scope, body), None)
+    response, params = await asyncio.to_thread(prepare_conversion, environ, False)
+    if response is not None:
+        return await send_wsgi(response, environ, send)
+
+    started = time.monotonic()
+    conversion = asyncio.create_task(convert_text_to_speech_async(
+        params['text'], params['model_name'], params['settings'], params['audio_format'],
+        client_class=params['client_class']))
+    disconnect = asyncio.create_task(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({conversion, disconnect}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnect.cancel()
+        if not conversion.done():
+            # The client went away: stop synthesizing for nobody
+            conversion.cancel()
+            await asyncio.gather(conversion, return_exceptions=True)
+    if conversion.cancelled():
+        return
+    audio_data, error_message = conversion.result()
+    tts.metrics.observe('convert.total_seconds', time.monotonic() - started)
+    response = await asyncio.to_thread(finish_conversion, environ, params, audio_data, error_message)
+    await send_wsgi(response, environ, send)
+
+
+async def handle_convert_stream(scope, receive, send, body):
+    environ = _apply_proxy_fix(build_environ(scope, body), None)
+    response, params = await asyncio.to_thread(prepare_conversion, environ, True)
+    if response is not None:
+        return await send_wsgi(response, environ, send)
+
+    cache_key = params['cache_key']
+    mimetype = tts.AUDIO_MIMETYPES[params['audio_format']]
+    use_sse = params['use_sse']
+    started = time.monotonic()
+    chunks = asyncio.Queue()
+
+    async def run_conversion():
+        try:
+            cached_audio = tts.response_cache.get(cache_key) if tts.response_cache.enabled else None
+            if cached_audio:
+                chunks.put_nowait(cached_audio)
+                return
+            audio_data, error_message = await convert_text_to_speech_async(
+                params['text'], params['model_name'], params['settings'], params['audio_format'],
+                on_audio_chunk=chunks.put_nowait, client_class=params['client_class'])
+            tts.metrics.observe('convert.total_seconds', time.monotonic() - started)
+            if audio_data and tts.response_cache.enabled:
+                await asyncio.to_thread(tts.response_cache.put, cache_key, audio_data)
+            if error_message:
+                logging.error(f"Streaming conversion failed. Error: {error_message}")
+                chunks.put_nowait(RuntimeError(error_message))
+        finally:
+            chunks.put_nowait(None)
+
+    conversion = asyncio.create_task(run_conversion())
+    disconnect = asyncio.create_task(wait_for_disconnect(receive))
+    finished = False
+    try:
+        first_chunk = await chunks.get()
+        # Errors before any audio still get a proper status code
+        if first_chunk is None or isinstance(first_chunk, Exception):
+            finished = True
+            return await send_json(send, 500, {'error': str(first_chunk) if first_chunk else 'Error al convertir texto a voz'})
+        tts.metrics.observe('stream.time_to_first_byte_seconds', time.monotonic() - started)
+        content_type = 'text/event-stream' if use_sse else mimetype
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', content_type.encode('latin-1')),
+            (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no'),
+        ]})
+        chunk = first_chunk
+        index = 0
+        while chunk is not None:
+            if disconnect.done():
+                return
+            if isinstance(chunk, Exception):
+                data = tts.sse_event('error', {'error': str(chunk)}).encode('utf-8') if use_sse else b''
+            elif use_sse:
+                data = tts.sse_event('audio', {'index': index, 'audio_base64': base64.b64encode(chunk).decode('utf-8')}).encode('utf-8')
+                index += 1
+            else:
+                data = chunk
+            if data:
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            chunk = await chunks.get()
+        finished = True
+        tail = tts.sse_event('done', {'chunks': index, 'mimetype': mimetype}).encode('utf-8') if use_sse else b''
+        await send({'type': 'http.response.body', 'body': tail, 'more_body': False})
+    finally:
+        disconnect.cancel()
+        if not finished:
+            conversion.cancel()
+        await asyncio.gather(conversion, return_exceptions=True)
+
+
+ASYNC_ROUTES = {
+    ('POST', '/convert'): handle_convert,
+    ('POST', '/convert/stream'): handle_convert_stream,
+}
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Pools and warmup were started when app.py was imported
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await asyncio.to_thread(tts.stop_worker_services)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        raise ValueError(f"Unsupported ASGI scope type: {scope['type']}")
+    body = await read_body(receive)
+    if body is None:
+        return
+    if body is False:
+        return await send_json(send, 413, {'error': 'Request body too large'})
+    handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if handler is not None:
+        return await handler(scope, receive, send, body)
+    await send_wsgi(flask_app, build_environ(scope, body), send)
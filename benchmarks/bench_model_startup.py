@@ -0,0 +1,131 @@
+"""
+Time taken by load_models() at startup, with and without the model manifest.
+
+    python benchmarks/bench_model_startup.py
+    python benchmarks/bench_model_startup.py --models 50 --image-kb 400 --compare 0ccaef1
+
+Writes --models synthetic voices into a scratch folder: a placeholder .onnx
+and an .onnx.json shaped like piper's, with a phoneme map, replacements and a
+base64 modelcard image of --image-kb. Each variant is imported in a fresh
+process with that folder as working directory, then load_models() is timed:
+
+  first start  no manifest and no extracted images yet
+  restart      the same files again (best of --repeat)
+
+"no manifest" runs the current app.py with MODEL_MANIFEST_PATH empty;
+--compare also runs app.py from a git revision, before either existed.
+"""
+import argparse
+import base64
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+CHILD = """
+import logging, os, shutil, sys, time
+sys.path.insert(0, os.getcwd())
+import app
+logging.disable(logging.CRITICAL)
+repeat = int(sys.argv[1])
+
+def clear():
+    shutil.rmtree(os.path.join('static', 'model_images'), ignore_errors=True)
+    os.makedirs(os.path.join('static', 'model_images'))
+    manifest = getattr(app, 'MODEL_MANIFEST_PATH', '')
+    if manifest and os.path.exists(manifest):
+        os.remove(manifest)
+
+def timed():
+    started = time.perf_counter()
+    app.load_models()
+    return time.perf_counter() - started
+
+clear()
+first = timed()
+restart = min(timed() for _ in range(repeat))
+print(first, restart, len(app.existing_models))
+"""
+
+
+def write_models(directory, count, image_kb):
+    models = os.path.join(directory, 'models')
+    os.makedirs(models)
+    os.makedirs(os.path.join(directory, 'static', 'model_images'))
+    image = 'data:image/png;base64,' + base64.b64encode(os.urandom(image_kb * 1024)).decode()
+    symbols = "_^$ !'(),-.:;?abcdefghijklmnopqrstuvwxyzæçðøħŋœǀǁǂǃɐɑɒɓɔɕɖɗɘəɚɛɜɞɟɠɡɢɣɤɥɦɧɨɪɫɬɭɮɯɰɱɲɳɴɵɶɸɹɺɻɽɾʀʁʂʃʄʈʉʊʋʌʍʎʏʐʑʒʔʕʘʙʛʜʝʟʡʢʲˈˌːˑ˞βθχᵻⱱ"
+    for index in range(count):
+        key = f'es_MX-voz{index}-{1000 + index}'
+        with open(os.path.join(models, f'{key}.onnx'), 'wb') as f:
+            f.write(b'\0' * 1024)
+        config = {
+            "audio": {"sample_rate": 22050, "quality": "medium"},
+            "espeak": {"voice": "es-419"},
+            "inference": {"noise_scale": 0.667, "length_scale": 1, "noise_w": 0.8},
+            "phoneme_type": "espeak",
+            "phoneme_map": {},
+            "phoneme_id_map": {symbol: [i] for i, symbol in enumerate(symbols)},
+            "num_symbols": 256,
+            "num_speakers": 1,
+            "speaker_id_map": {},
+            "piper_version": "1.0.0",
+            "modelcard": {
+                "id": f'es_MX-voz{index}',
+                "name": f'Voz {index}',
+                "description": f'Voz sintética de prueba número {index}',
+                "language": 'es_MX',
+                "voiceprompt": 'Hola, ¿cómo estás?',
+                "replacements": [[f'abreviatura{i}', f'expansión{i}'] for i in range(20)],
+                "image": image,
+            },
+        }
+        with open(os.path.join(models, f'{key}.onnx.json'), 'w', encoding='utf-8') as f:
+            json.dump(config, f, ensure_ascii=False, indent=2)
+
+
+def run_variant(directory, source, repeat, env):
+    with open(os.path.join(directory, 'app.py'), 'w', encoding='utf-8') as f:
+        f.write(source)
+    output = subprocess.run([sys.executable, '-c', CHILD, str(repeat)], cwd=directory, check=True,
+                            capture_output=True, text=True, env={**os.environ, **env}).stdout
+    first, restart, loaded = output.split()[-3:]
+    return float(first), float(restart), int(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--models', type=int, default=50)
+    parser.add_argument('--image-kb', type=int, default=300, help='size of each modelcard image')
+    parser.add_argument('--repeat', type=int, default=5, help='restarts timed per variant')
+    parser.add_argument('--compare', metavar='REVISION', help='also time load_models from this revision')
+    args = parser.parse_args()
+
+    with open(os.path.join(REPO_DIR, 'app.py'), encoding='utf-8') as f:
+        current = f.read()
+    variants = []
+    if args.compare:
+        source = subprocess.run(['git', 'show', f'{args.compare}:app.py'], cwd=REPO_DIR, check=True,
+                                capture_output=True, text=True).stdout
+        variants.append((args.compare, source, {}))
+    variants += [('no manifest', current, {'MODEL_MANIFEST_PATH': ''}), ('manifest', current, {})]
+
+    directory = tempfile.mkdtemp(prefix='model_startup_')
+    try:
+        write_models(directory, args.models, args.image_kb)
+        print(f"{args.models} models, {args.image_kb} KB image each")
+        env = {'PIPER_POOL_SIZE': '0', 'SERVER_PREFORK': '1', 'MODEL_WATCH_INTERVAL': '0', 'MODEL_WARMUP': '0'}
+        for name, source, extra in variants:
+            first, restart, loaded = run_variant(directory, source, args.repeat, {**env, **extra})
+            print(f"{name:>12}: first start {first * 1000:8.1f} ms, restart {restart * 1000:8.1f} ms  ({loaded} names)")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Resident memory per worker with ONNX voices loaded, per weight-sharing mode.
+
+    python benchmarks/bench_onnx_shared_memory.py
+    python benchmarks/bench_onnx_shared_memory.py --workers 1 4 8 --voices 12 --model-mb 16
+
+Writes --voices synthetic piper-shaped models (same inputs and outputs, one
+--model-mb MatMul weight each) and forks --workers processes that each load
+every voice with app.OnnxVoice and synthesize once, like gunicorn workers
+after warmup. Memory is read from /proc/<pid>/smaps_rollup (Linux only):
+PSS splits shared pages between the processes mapping them, so it is the
+fair per-worker share; "private" is what each worker holds alone.
+
+  private  every worker builds its own sessions (ONNX_PREFORK_SESSIONS=0)
+  prefork  sessions built in the parent before fork (the gunicorn default)
+  mmap     every worker builds sessions from memory-mapped weights (ONNX_MMAP_WEIGHTS=1)
+
+Needs numpy, onnxruntime and onnx.
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+PHONEME_IDS = [1, 5, 9, 4, 12, 7, 3, 8, 2]
+
+
+def write_voice(directory, index, model_mb):
+    """A model with piper's interface whose output goes through one model_mb weight matrix."""
+    import numpy as np
+    import onnx
+    from onnx import TensorProto, helper, numpy_helper
+
+    samples_per_phoneme = 256
+    hidden = max(1, model_mb * 1024 * 1024 // (4 * samples_per_phoneme))
+    rng = np.random.RandomState(index)
+    initializers = [
+        numpy_helper.from_array(rng.rand(1, hidden).astype(np.float32), 'embed'),
+        numpy_helper.from_array((rng.rand(hidden, samples_per_phoneme) - 0.5).astype(np.float32), 'weights'),
+        numpy_helper.from_array(np.array([2], dtype=np.int64), 'axis'),
+        numpy_helper.from_array(np.array([0, 1, -1], dtype=np.int64), 'shape'),
+    ]
+    nodes = [
+        helper.make_node('Cast', ['input'], ['ids'], to=TensorProto.FLOAT),
+        helper.make_node('Unsqueeze', ['ids', 'axis'], ['column']),
+        helper.make_node('MatMul', ['column', 'embed'], ['hidden']),
+        helper.make_node('MatMul', ['hidden', 'weights'], ['frames']),
+        helper.make_node('Sin', ['frames'], ['audio']),
+        helper.make_node('Reshape', ['audio', 'shape'], ['output']),
+    ]
+    graph = helper.make_graph(nodes, f'voice_{index}', [
+        helper.make_tensor_value_info('input', TensorProto.INT64, ['B', 'N']),
+        helper.make_tensor_value_info('input_lengths', TensorProto.INT64, ['B']),
+        helper.make_tensor_value_info('scales', TensorProto.FLOAT, [3]),
+    ], [helper.make_tensor_value_info('output', TensorProto.FLOAT, ['B', 1, 'T'])], initializer=initializers)
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    model_path = os.path.join(directory, f'voice_{index}.onnx')
+    onnx.save(model, model_path)
+    config = {
+        "model_path_onnx": model_path,
+        "sample_rate": 22050,
+        "synthesis_config": {
+            "phoneme_type": 'espeak',
+            "espeak_voice": 'es',
+            "phoneme_id_map": {symbol: [i] for i, symbol in enumerate('_^$abcdefghijklmnopqrstuvwxyz')},
+            "num_speakers": 1,
+        },
+    }
+    return model_path, config
+
+
+def load_voices(app, voices):
+    loaded = [app.OnnxVoice(model_path, config) for model_path, config in voices]
+    for voice in loaded:
+        voice.synthesize_ids(PHONEME_IDS, app.DEFAULT_SYNTHESIS_SETTINGS)
+    return loaded
+
+
+def memory_kb(pid):
+    values = {}
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if rest.strip().endswith('kB'):
+                values[name] = int(rest.split()[0])
+    return values
+
+
+def run(app, mode, workers, voices):
+    app.ONNX_MMAP_WEIGHTS = mode == 'mmap'
+    shared = load_voices(app, voices) if mode == 'prefork' else None
+    ready_read, ready_write = os.pipe()
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                if shared is None:
+                    load_voices(app, voices)
+                else:
+                    for voice in shared:
+                        voice.synthesize_ids(PHONEME_IDS, app.DEFAULT_SYNTHESIS_SETTINGS)
+                os.write(ready_write, b'1')
+                time.sleep(3600)
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    try:
+        for _ in pids:
+            os.read(ready_read, 1)
+        samples = [memory_kb(pid) for pid in pids]
+    finally:
+        for pid in pids:
+            os.kill(pid, 9)
+            os.waitpid(pid, 0)
+        os.close(ready_read)
+        os.close(ready_write)
+    pss = sum(sample['Pss'] for sample in samples) / len(samples) / 1024
+    private = sum(sample['Private_Clean'] + sample['Private_Dirty'] for sample in samples) / len(samples) / 1024
+    rss = sum(sample['Rss'] for sample in samples) / len(samples) / 1024
+    return pss, private, rss
+
+
+def measure(app, mode, workers, voices):
+    """run() in a fresh child, so sessions from one mode never leak into the next."""
+    result_read, result_write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.write(result_write, json.dumps(run(app, mode, workers, voices)).encode())
+        finally:
+            os._exit(0)
+    os.close(result_write)
+    with os.fdopen(result_read) as f:
+        result = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8])
+    parser.add_argument('--voices', type=int, default=12)
+    parser.add_argument('--model-mb', type=int, default=8, help='weight size of each synthetic voice')
+    parser.add_argument('--modes', nargs='+', default=['private', 'prefork', 'mmap'], choices=['private', 'prefork', 'mmap'])
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='onnx_shared_memory_')
+    os.environ.update({'PIPER_POOL_SIZE': '0', 'SERVER_PREFORK': '1', 'MODEL_WATCH_INTERVAL': '0',
+                       'ONNX_MMAP_DIR': os.path.join(directory, 'mmap')})
+    sys.path.insert(0, REPO_DIR)
+    import app
+    logging.disable(logging.CRITICAL)
+    if app.onnxruntime is None or app.onnx is None:
+        print("numpy, onnxruntime and onnx are required")
+        return 1
+
+    voices = [write_voice(directory, index, args.model_mb) for index in range(args.voices)]
+    # Convert once up front, as the first worker to load each model would
+    for model_path, _ in voices:
+        app.mmap_model_path(model_path)
+    print(f"{args.voices} voices x {args.model_mb} MB of weights ({args.voices * args.model_mb} MB), "
+          f"onnxruntime {app.onnxruntime.__version__}")
+    for workers in args.workers:
+        for mode in args.modes:
+            pss, private, rss = measure(app, mode, workers, voices)
+            print(f"{workers} workers {mode:>8}: PSS {pss:7.1f} MB/worker  private {private:7.1f} MB/worker  "
+                  f"RSS {rss:7.1f} MB  (total PSS {pss * workers:7.1f} MB)")
+    shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Thread-only vs hybrid (process pool) preprocessing under concurrent requests.
+
+    python benchmarks/bench_preprocess_modes.py
+    python benchmarks/bench_preprocess_modes.py --concurrency 1 4 16 --workers 4
+
+Each simulated request normalizes a long text (code blocks, line breaks,
+replacements, splitting) and decodes --sentences WAV files at 16 kHz into a
+22050 Hz PcmAssembler, which is what convert_text_to_speech_concurrent does
+around synthesis. Meanwhile --executor-threads threads stand in for the
+executor threads that babysit piper: they wake every millisecond, and the
+extra delay they see ("jitter") is time spent waiting for the GIL.
+
+"thread" runs everything on the request threads; "hybrid" sends the same
+work to app.PreprocessPool.
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+WORDS = ['Hola', 'Sr.', 'García', 'tengo', '5', 'perros', 'en', 'mi', 'casa', 'grande', 'Dr.', 'Pérez',
+         'llegó', 'con', '3', 'gatos', 'y', 'el', 'día', 'de', 'hoy', 'etc.', 'muy', 'bien', '15', 'años']
+
+
+def build_text(rng, length):
+    pieces = []
+    while sum(len(piece) + 1 for piece in pieces) < length:
+        pieces.append(rng.choice(WORDS) + rng.choice(['', '', '', ',', '.', '?', '\n']))
+    return ' '.join(pieces)
+
+
+def write_wavs(app, directory, count, seconds=2.0, sample_rate=16000):
+    rng = random.Random(3)
+    paths = []
+    for i in range(count):
+        pcm = bytes(rng.getrandbits(8) for _ in range(int(seconds * sample_rate) * 2))
+        path = os.path.join(directory, f'sentence_{i}.wav')
+        app.write_wav(path, pcm, sample_rate)
+        paths.append(path)
+    return paths
+
+
+def request_thread_mode(app, text, wavs):
+    app.text_pipeline.run(text, app.TextNormalizationPipeline.replacement_engine([]))
+    assembler = app.PcmAssembler(22050)
+    for path in wavs:
+        with open(path, 'rb') as f:
+            assembler.add_wav(f.read())
+        assembler.drain()
+
+
+def request_hybrid_mode(app, text, wavs):
+    engine = app.TextNormalizationPipeline.replacement_engine([])
+    app.preprocess_pool.normalize(text, engine, app.global_replacements)
+    assembler = app.PcmAssembler(22050)
+    for path in wavs:
+        pcm, sample_rate = app.preprocess_pool.decode_wav(path, assembler.sample_rate)
+        assembler.add_pcm(pcm, sample_rate)
+        assembler.drain()
+
+
+def executor_jitter(stop, samples):
+    while not stop.is_set():
+        started = time.perf_counter()
+        time.sleep(0.001)
+        samples.append(time.perf_counter() - started - 0.001)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def run(app, handler, concurrency, texts, wavs, executor_threads):
+    stop = threading.Event()
+    jitter = []
+    waiters = [threading.Thread(target=executor_jitter, args=(stop, jitter)) for _ in range(executor_threads)]
+    for waiter in waiters:
+        waiter.start()
+    latencies = []
+
+    def one(text):
+        started = time.perf_counter()
+        handler(app, text, wavs)
+        latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(one, texts))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for waiter in waiters:
+        waiter.join()
+    return elapsed, latencies, jitter
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16])
+    parser.add_argument('--requests', type=int, default=32)
+    parser.add_argument('--chars', type=int, default=4000, help='text length per request')
+    parser.add_argument('--sentences', type=int, default=8, help='WAV files decoded per request')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1), help='preprocessing processes')
+    parser.add_argument('--executor-threads', type=int, default=8)
+    args = parser.parse_args()
+
+    os.environ.setdefault('PIPER_POOL_SIZE', '0')
+    os.environ['PREPROCESS_MODE'] = 'thread'
+    sys.path.insert(0, REPO_DIR)
+    import app
+    logging.disable(logging.CRITICAL)
+    app.PREPROCESS_MIN_CHARS = 0
+
+    rng = random.Random(5)
+    texts = [build_text(rng, args.chars) for _ in range(args.requests)]
+    pool = app.PreprocessPool(args.workers)
+    pool.start()
+    app.preprocess_pool = None  # Only the hybrid handler uses it, explicitly
+    print(f"{args.requests} requests of {args.chars} chars + {args.sentences} WAVs, "
+          f"{args.workers} preprocessing processes, {args.executor_threads} executor threads, "
+          f"numpy {'on' if app.np is not None else 'off'}")
+    with tempfile.TemporaryDirectory() as directory:
+        wavs = write_wavs(app, directory, args.sentences)
+        for concurrency in args.concurrency:
+            for name, handler in (('thread', request_thread_mode), ('hybrid', request_hybrid_mode)):
+                app.preprocess_pool = pool if name == 'hybrid' else None
+                elapsed, latencies, jitter = run(app, handler, concurrency, texts, wavs, args.executor_threads)
+                print(f"c={concurrency:<3} {name:>6}: {args.requests / elapsed:7.1f} req/s  "
+                      f"p50 {percentile(latencies, 0.5) * 1000:8.1f} ms  p95 {percentile(latencies, 0.95) * 1000:8.1f} ms  "
+                      f"executor jitter p95 {percentile(jitter, 0.95) * 1000:6.2f} ms")
+    pool.shutdown()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""
+Per-request cost of the security_check decorator.
+
+    python benchmarks/bench_security_check.py
+    python benchmarks/bench_security_check.py --compare 0ccaef1   # also time validate_user_agent from a git revision
+
+validate_user_agent is timed on a mix of browser, bot and empty User-Agents,
+mostly repeated as real traffic is. The full decorator (client IP, rate limit,
+User-Agent, headers and body checks) is then timed around a no-op view inside a
+request context, for a form POST from a public IP with a permissive limiter.
+"""
+import argparse
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 Safari/605.1.15',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:121.0) Gecko/20100101 Firefox/121.0',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) AppleWebKit/605.1.15 (KHTML, like Gecko) Mobile/15E148',
+    'Mozilla/5.0 (Linux; Android 14; Pixel 8) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Mobile Safari/537.36',
+    'curl/8.4.0',
+    'python-requests/2.31.0',
+    'Googlebot/2.1 (+http://www.google.com/bot.html)',
+    'SomeCustomClient/1.0',
+    '',
+]
+
+
+def load_revision_validator(revision):
+    """Return validate_user_agent as defined in app.py at a git revision."""
+    source = subprocess.run(['git', 'show', f'{revision}:app.py'], cwd=REPO_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    namespace = {'re': re, 'logging': logging}
+    exec('blocked_user_agents = set()', namespace)
+    for name in ('SUSPICIOUS_USER_AGENTS', 'VALID_USER_AGENTS'):
+        start = source.index(f'\n{name} = [')
+        exec(source[start:source.index('\n]', start) + 2], namespace)
+    start = source.index('def validate_user_agent(')
+    exec(source[start:source.index('\ndef ', start + 1)], namespace)
+    return namespace['validate_user_agent']
+
+
+def time_validator(validate, user_agents):
+    started = time.perf_counter()
+    for user_agent in user_agents:
+        validate(user_agent)
+    return (time.perf_counter() - started) / len(user_agents)
+
+
+def time_requests(app, view, requests, user_agent):
+    headers = {
+        'User-Agent': user_agent,
+        'X-Forwarded-For': '93.184.216.34',
+        'Accept': 'text/html',
+        'Accept-Language': 'es-MX,es;q=0.9',
+    }
+    data = {'text': 'Hola, esta es una prueba del sistema de síntesis de voz. ' * 8, 'model': 'es_MX-voz'}
+    started = time.perf_counter()
+    for _ in range(requests):
+        with app.app.test_request_context('/convert', method='POST', headers=headers, data=data):
+            view()
+    return (time.perf_counter() - started) / requests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--compare', metavar='REVISION', help='also time validate_user_agent from this revision')
+    parser.add_argument('--checks', type=int, default=200000, help='validate_user_agent calls')
+    parser.add_argument('--requests', type=int, default=5000, help='security_check calls')
+    args = parser.parse_args()
+
+    os.environ.setdefault('PIPER_POOL_SIZE', '0')
+    sys.path.insert(0, REPO_DIR)
+    import app
+    logging.disable(logging.CRITICAL)
+    app.rate_limiter = app.MemoryRateLimiter(10**9, 10**9, 0, 10000)
+
+    rng = random.Random(7)
+    user_agents = [rng.choice(USER_AGENTS) for _ in range(args.checks)]
+    validators = [('current', app.validate_user_agent)]
+    if args.compare:
+        validators.append((args.compare, load_revision_validator(args.compare)))
+    for name, validate in validators:
+        mismatches = sum(validate(user_agent) != validators[0][1](user_agent) for user_agent in USER_AGENTS)
+        print(f"validate_user_agent {name:>10}: {time_validator(validate, user_agents) * 1e6:7.2f} us/call"
+              f"{f'  ({mismatches} verdicts differ from current)' if mismatches else ''}")
+
+    bare = time_requests(app, lambda: 'ok', args.requests, USER_AGENTS[0])
+    checked = time_requests(app, app.security_check(lambda: 'ok'), args.requests, USER_AGENTS[0])
+    print(f"request context alone: {bare * 1e6:7.1f} us/request, "
+          f"security_check adds {(checked - bare) * 1e6:7.1f} us/request")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Per-request synthesis latency with and without sentence packing.
+
+    python benchmarks/bench_sentence_packing.py                      # simulated synthesis cost
+    python benchmarks/bench_sentence_packing.py --model es_MX-voz    # real synthesis with a loaded model
+
+"before" runs every sentence from split_sentences as its own job in text order.
+"after" packs them with pack_sentences and submits the longest jobs first. In
+simulated mode each job sleeps for --overhead plus --per-char seconds per
+character on a pool of --workers threads, which is how piper's cost scales.
+"""
+import argparse
+import concurrent.futures
+import logging
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+SHORT = ['Sí.', 'Claro que sí.', 'No lo sé.', '¿De verdad?', 'Bien, gracias.', 'Vale, entendido.']
+MEDIUM = [
+    'El clima de hoy es agradable y la gente sale a caminar por el parque.',
+    'Mañana tenemos una reunión importante con el equipo de diseño a primera hora.',
+    'La biblioteca abre de lunes a viernes y cierra temprano los fines de semana.',
+]
+LONG = (
+    'Durante el último año el proyecto creció de manera constante, se sumaron nuevas personas al equipo, '
+    'se reescribieron varios componentes que ya no escalaban, se mejoró la documentación para quienes llegan, '
+    'y aun así quedaron pendientes muchas tareas pequeñas que nadie tuvo tiempo de atender; por eso, '
+    'en el próximo trimestre vamos a dedicar una semana completa a cerrar esos detalles.'
+)
+
+
+def build_texts(count, seed=11):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        pieces = [rng.choice(SHORT + MEDIUM) for _ in range(rng.randint(3, 12))]
+        for _ in range(rng.randint(0, 2)):
+            pieces.insert(rng.randrange(len(pieces) + 1), LONG)
+        texts.append(' '.join(pieces))
+    return texts
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def simulated_request(pool, jobs, overhead, per_char):
+    started = time.perf_counter()
+    futures = [pool.submit(time.sleep, overhead + per_char * len(job)) for job in jobs]
+    concurrent.futures.wait(futures)
+    return time.perf_counter() - started
+
+
+def report(name, latencies, job_counts):
+    print(f"{name:>7}: p50 {percentile(latencies, 0.5) * 1000:8.1f} ms  p95 {percentile(latencies, 0.95) * 1000:8.1f} ms  "
+          f"max {max(latencies) * 1000:8.1f} ms  ({sum(job_counts) / len(job_counts):.1f} jobs/request)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=40)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--target', type=int, default=None, help='packing target in characters (default: SENTENCE_PACK_TARGET_CHARS)')
+    parser.add_argument('--overhead', type=float, default=0.02, help='simulated seconds per synthesis call')
+    parser.add_argument('--per-char', type=float, default=0.0008, help='simulated seconds per character')
+    parser.add_argument('--model', help='synthesize for real with this model instead of simulating')
+    args = parser.parse_args()
+
+    os.environ.setdefault('PIPER_POOL_SIZE', '0')
+    sys.path.insert(0, REPO_DIR)
+    import app
+    logging.disable(logging.CRITICAL)
+    target = args.target if args.target is not None else app.SENTENCE_PACK_TARGET_CHARS or 200
+    texts = build_texts(args.requests)
+
+    if args.model:
+        settings = {'speaker': 0, 'noise_scale': 0.667, 'length_scale': 1.0, 'noise_w': 0.8}
+        for name, pack_target in (('before', 0), ('after', target)):
+            app.SENTENCE_PACK_TARGET_CHARS = pack_target
+            app.sentence_cache.clear()
+            latencies = []
+            for text in texts:
+                started = time.perf_counter()
+                app.convert_text_to_speech_concurrent(text, args.model, settings)
+                latencies.append(time.perf_counter() - started)
+            report(name, latencies, [len(app.pack_sentences(app.split_sentences(text), pack_target)) for text in texts])
+        return 0
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        before, after = [], []
+        before_jobs, after_jobs = [], []
+        for text in texts:
+            sentences = app.split_sentences(text)
+            before.append(simulated_request(pool, sentences, args.overhead, args.per_char))
+            before_jobs.append(len(sentences))
+            packed = sorted(app.pack_sentences(sentences, target), key=len, reverse=True)
+            after.append(simulated_request(pool, packed, args.overhead, args.per_char))
+            after_jobs.append(len(packed))
+    print(f"{args.requests} requests, {args.workers} workers, target {target} chars")
+    report('before', before, before_jobs)
+    report('after', after, after_jobs)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Golden-output check and micro-benchmark for app.split_sentences.
+
+    python benchmarks/bench_split_sentences.py                   # verify corpus, time 5k-char inputs
+    python benchmarks/bench_split_sentences.py --compare 628681c # also time the splitter from a git revision
+    python benchmarks/bench_split_sentences.py --generate 628681c
+
+--generate rebuilds split_sentences_golden.json with the splitter taken from
+the given revision, so the corpus always records that revision's output.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+GOLDEN_FILE = os.path.join(BENCH_DIR, 'split_sentences_golden.json')
+
+ABBREVIATIONS = [
+    'Sr', 'Sra', 'Srta', 'Dr', 'Dra', 'Prof', 'Lic', 'Ing', 'etc', 'vs', 'p.ej', 'i.e', 'cf', 'vol', 'cap',
+    'art', 'núm', 'pág', 'ed', 'op.cit', 'Mr', 'Mrs', 'Ms', 'Inc', 'Co', 'e.g', 'no', 'M', 'Mme', 'p.ex',
+    'c.à.d', 'n°', 'p', 'z.B', 'd.h', 'Nr', 'S', 'Sig.ra', 'ad.es', 'ou.seja', 'n',
+]
+WORDS = [
+    'Hola', 'García', 'casa', 'perro', 'tengo', 'cinco', 'el', 'la', 'de', 'que', 'muy', 'bien', 'sí', 'no',
+    'Esto', 'es', 'una', 'prueba', 'larga', 'con', 'varias', 'palabras', 'México', 'ciudad', 'número',
+    '3.14', '$19.99', 'U.S.A.', 'www.ejemplo.com', 'uno', 'dos', '15', '2023', 'a', 'y', 'o', 'x', 'sr', 'dr',
+]
+PUNCTUATION = ['.', '. ', '!', '?', '?!', '...', '…', '¿', '¡', ',', ', ', ';', ':', '."', ' .', '.\n', '!\t']
+SPACES = [' ', ' ', ' ', '  ', '\n', '\t', '\r\n', ' ']
+
+HANDWRITTEN = [
+    '',
+    '   ',
+    'Hola.',
+    'Hola Sr. García. ¿Cómo está? ¡Muy bien!',
+    'Cuesta $19.99. Es barato.',
+    'Sr. García vino. Luego se fue a su casa.',
+    'El Dr.García llegó tarde. Nadie lo esperaba ya.',
+    'Vimos a la Sra. López, al Prof. Díaz y al Ing. Pérez en la reunión de hoy.',
+    'Trajo frutas, verduras, etc. y luego se fue. Todos comieron bien.',
+    'See e.g. the docs. Mr. Smith agreed with Mrs. Jones.',
+    'Uno. Dos. Tres. Cuatro palabras aquí ya. Cinco.',
+    '¿Qué? ¡No! Esto es increíble de verdad.',
+    'Espera… ¿en serio? Sí, en serio lo digo.',
+    'a. b. c.',
+    'Hola. Adiós.',
+    'Sr.',
+    'p.ej. esto. p.ej.no cuenta como inicio aquí.',
+    'Ver pág. 4, cap. 3 y vol. 2 del libro. Es interesante leerlo.',
+    'M. Dupont est arrivé. Mme. Curie aussi était là.',
+    'Der Hr. Müller, z.B. hier. Das ist gut so.',
+    'Il Sig.ra Rossi è qui. La Sig.na Bianchi no.',
+    'Texto sin puntuación final que sigue y sigue',
+    'Linea uno\nLinea dos\tcon tab. Y otra más aquí.',
+    '...',
+    '!!! ??? ...',
+    '1. Primero el paso uno. 2. Luego el dos.',
+    'Visita www.ejemplo.com para más información. Gracias por todo.',
+    'Los U.S.A. son grandes. Canadá también lo es.',
+]
+
+
+def long_comma_sentence(rng):
+    parts = []
+    while sum(len(part) + 2 for part in parts) < rng.randint(520, 1600):
+        parts.append(' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 12))))
+    return ', '.join(parts) + rng.choice(['.', '', '!'])
+
+
+def random_text(rng, target_length):
+    pieces = []
+    length = 0
+    while length < target_length:
+        roll = rng.random()
+        if roll < 0.12:
+            piece = rng.choice(ABBREVIATIONS) + rng.choice(['.', '. ', '.', ''])
+        elif roll < 0.30:
+            piece = rng.choice(PUNCTUATION)
+        elif roll < 0.33:
+            piece = long_comma_sentence(rng)
+        else:
+            piece = rng.choice(WORDS)
+        pieces.append(piece)
+        pieces.append(rng.choice(SPACES) if rng.random() < 0.85 else '')
+        length += len(piece) + 1
+    return ''.join(pieces)
+
+
+def build_inputs(seed=20240501):
+    rng = random.Random(seed)
+    inputs = list(HANDWRITTEN)
+    for _ in range(300):
+        inputs.append(random_text(rng, rng.choice([10, 40, 120, 300])))
+    for _ in range(20):
+        inputs.append(random_text(rng, rng.choice([800, 2000, 5000])))
+    return inputs
+
+
+def load_revision_splitter(revision):
+    """Return split_sentences as defined in app.py at a git revision."""
+    source = subprocess.run(['git', 'show', f'{revision}:app.py'], cwd=REPO_DIR, check=True,
+                            capture_output=True, text=True).stdout
+    start = source.index('def split_sentences(')
+    end = source.index('\ndef ', start + 1)
+    namespace = {'re': re, 'logging': logging}
+    exec(source[start:end], namespace)
+    return namespace['split_sentences']
+
+
+def import_app():
+    os.environ.setdefault('PIPER_POOL_SIZE', '0')
+    sys.path.insert(0, REPO_DIR)
+    import app
+    return app
+
+
+def time_splitter(split, texts, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            split(text)
+    return (time.perf_counter() - started) / (repeat * len(texts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--generate', metavar='REVISION', help='rebuild the golden corpus from this revision')
+    parser.add_argument('--compare', metavar='REVISION', help='also time the splitter from this revision')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    if args.generate:
+        split = load_revision_splitter(args.generate)
+        corpus = [{'input': text, 'output': split(text)} for text in build_inputs()]
+        with open(GOLDEN_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'revision': args.generate, 'cases': corpus}, f, ensure_ascii=False, indent=1)
+        print(f"Wrote {len(corpus)} cases from {args.generate} to {GOLDEN_FILE}")
+        return 0
+
+    app = import_app()
+    with open(GOLDEN_FILE, encoding='utf-8') as f:
+        golden = json.load(f)
+    failures = [case for case in golden['cases'] if app.split_sentences(case['input']) != case['output']]
+    print(f"Golden corpus ({golden['revision']}): {len(golden['cases']) - len(failures)}/{len(golden['cases'])} identical")
+    for case in failures[:5]:
+        print(f"  input:    {case['input'][:120]!r}")
+        print(f"  expected: {case['output'][:3]!r}")
+        print(f"  got:      {app.split_sentences(case['input'])[:3]!r}")
+
+    rng = random.Random(7)
+    texts = [random_text(rng, 5000) for _ in range(10)]
+    # Worst case for the old splitter: a long run of abbreviations that never ends a sentence
+    texts.append('Hola ' + 'Sr. ' * 1250)
+    splitters = [('current', app.split_sentences)]
+    if args.compare:
+        splitters.append((args.compare, load_revision_splitter(args.compare)))
+    for name, split in splitters:
+        per_call = time_splitter(split, texts[:-1], args.repeat)
+        worst = time_splitter(split, texts[-1:], max(1, args.repeat // 4))
+        print(f"{name:>10}: {per_call * 1000:.3f} ms per 5k-char text, {worst * 1000:.3f} ms abbreviation chain")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -18,17 +18,7 @@ else
     echo "Modelos ya descargados, omitiendo descarga."
 fi
 
-# Iniciar la aplicación principal con reinicio automático
+# Iniciar la aplicación con gunicorn; el maestro reinicia los workers que fallen
+# y SIGHUP recarga los workers sin cortar las peticiones en curso
 echo "Iniciando aplicación..."
-while true; do
-    python3 app.py
-    EXIT_CODE=$?
-    
-    if [ $EXIT_CODE -eq 0 ]; then
-        echo "Aplicación terminó normalmente."
-        break
-    else
-        echo "Aplicación terminó con error (código $EXIT_CODE). Reiniciando en 5 segundos..."
-        sleep 5
-    fi
-done
\ No newline at end of file
+exec gunicorn -c gunicorn.conf.py app:app
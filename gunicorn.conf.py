@@ -0,0 +1,59 @@
+"""
+Gunicorn configuration for the Piper TTS API.
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is preloaded in the master, so models are scanned and replacement
+lists compiled once and shared copy-on-write by every worker. With
+TTS_ENGINE=onnx the ONNX sessions are built in the master too, so workers
+share the model weights instead of loading a copy each. Each worker then
+starts its own piper pool, preprocessing pool and model warmup in post_fork;
+/health answers 503 until that warmup has finished.
+
+Graceful reload: `kill -HUP <master pid>` starts fresh workers and lets the
+old ones finish their in-flight requests for up to graceful_timeout seconds.
+Because the app is preloaded, new code needs a full restart (or USR2 + WINCH).
+"""
+import logging
+import math
+import os
+import sys
+
+# Tells app.py to leave process pools and threads to post_fork
+os.environ.setdefault('SERVER_PREFORK', '1')
+
+cores = os.cpu_count() or 1
+
+bind = f"{os.environ.get('PIPER_HOST', '0.0.0.0')}:{os.environ.get('PIPER_PORT', '7860')}"
+# Synthesis runs in piper subprocesses that already use the cores; a few workers with
+# many threads keep streaming and long requests from tying up whole processes
+workers = int(os.environ.get('WEB_CONCURRENCY', max(1, cores // 2)))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+
+# Split the synthesis thread budget (1.5 per core) between the workers
+os.environ.setdefault('MAX_WORKERS', str(max(1, math.ceil(cores * 1.5 / workers))))
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 120))
+keepalive = 5
+
+
+def post_fork(server, worker):
+    import app
+    app.start_worker_services()
+
+
+def worker_exit(server, worker):
+    import app
+    # Finishes background tasks and stops every thread and pool of this worker, which
+    # is all the app's atexit handlers would otherwise do
+    app.stop_worker_services()
+    if worker.booted and app.onnxruntime is not None:
+        # onnxruntime starts a thread when imported in the master; its static destructors
+        # then abort in forked workers. Everything is stopped, so skip interpreter teardown.
+        logging.shutdown()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(0)